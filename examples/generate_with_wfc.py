@@ -11,7 +11,11 @@ import random
 
 from terrain_generator.wfc.wfc import WFCSolver
 
-from terrain_generator.trimesh_tiles.mesh_parts.create_tiles import create_mesh_pattern, get_mesh_gen
+from terrain_generator.trimesh_tiles.mesh_parts.create_tiles import (
+    create_mesh_pattern,
+    create_mesh_from_wave,
+    get_mesh_gen,
+)
 
 # from trimesh_tiles.mesh_parts.overhanging_parts import FloorOverhangingParts
 from terrain_generator.utils.mesh_utils import visualize_mesh, compute_sdf
@@ -100,11 +104,9 @@ def create_mesh_from_cfg(
         os.makedirs(translated_parts_dir, exist_ok=True)
 
     print("Converting to mesh...")
-    # Compose the whole mesh from the tiles
-    result_mesh = trimesh.Trimesh()
-    if overhanging_cfg is not None:
-        result_terrain_mesh = trimesh.Trimesh()
-        result_overhanging_mesh = trimesh.Trimesh()
+    # Compose the whole mesh from the tiles in one step
+    result_terrain_mesh = create_mesh_from_wave(wave, wave_names, tiles, cfg.dim)
+    over_meshes = []
 
     if enable_sdf:
         sdf_dim = np.array(cfg.dim) * 3  # to merge with neighboring tiles
@@ -113,75 +115,84 @@ def create_mesh_from_cfg(
         sdf_array_dim = np.array([sdf_array_dim[0], sdf_array_dim[1], sdf_dim[2] / sdf_resolution], dtype=int)
         sdf_min = np.inf * np.ones(sdf_array_dim, dtype=np.float32)
 
-    with alive_bar(len(wave.flatten())) as bar:
-        for y in range(wave.shape[0]):
-            for x in range(wave.shape[1]):
-                terrain_mesh = tiles[wave_names[wave[y, x]]].get_mesh().copy()
-                mesh = terrain_mesh.copy()
-
-                if overhanging_cfg is not None:
+    # The per-tile pass is only needed for the overhanging parts, the SDF and the history.
+    if overhanging_cfg is not None or enable_sdf or enable_history:
+        with alive_bar(len(wave.flatten())) as bar:
+            for y in range(wave.shape[0]):
+                for x in range(wave.shape[1]):
+                    tile = tiles[wave_names[wave[y, x]]]
+                    # Shared with the tile cache, it is not modified in place.
+                    terrain_mesh = tile.get_shared_mesh()
                     over_mesh = trimesh.Trimesh()
-                    # terrain_mesh += mesh
-                    if np.random.rand() < overhanging_cfg.overhanging_prob:
+
+                    if overhanging_cfg is not None and np.random.rand() < overhanging_cfg.overhanging_prob:
                         mesh_cfg = random.choice(overhanging_cfg.overhanging_cfg_list)
-                        mesh_cfg.mesh = mesh
-                        # over_box_mesh_cfg = create_overhanging_boxes(mesh_cfg)
+                        # The overhanging generators own a copy, as they may modify it.
+                        mesh_cfg.mesh = tile.get_mesh()
                         cfg_gen = get_cfg_gen(mesh_cfg)
                         over_mesh_cfg = cfg_gen(mesh_cfg)
                         over_box_mesh = get_mesh_gen(over_mesh_cfg)(over_mesh_cfg)
                         over_mesh += over_box_mesh
-                    # over_mesh += over_tiles[over_wave_names[over_wave[y, x]]].get_mesh().copy()
-                    mesh += over_mesh
-                if enable_sdf:
-                    # Compute SDF around the mesh
-                    mesh_sdf = compute_sdf(mesh, dim=sdf_dim, resolution=0.1)
-                    x_min = int(x * cfg.dim[0] / sdf_resolution)
-                    y_min = int((wave.shape[0] - y - 1) * cfg.dim[1] / sdf_resolution)
-                    x_max = int((x + 2 + 1) * cfg.dim[0] / sdf_resolution)
-                    y_max = int((wave.shape[0] - y + 2) * cfg.dim[1] / sdf_resolution)
-                    # Update sdf_min by comparing the relevant part
-                    sdf_min[x_min:x_max, y_min:y_max, :] = np.minimum(sdf_min[x_min:x_max, y_min:y_max, :], mesh_sdf)
-
-                # save original parts for visualization
-                if enable_history:
-                    mesh.export(os.path.join(parts_dir, f"{wave[y, x]}_{y}_{x}_{wave_names[wave[y, x]]}.obj"))
-                    if overhanging_cfg is not None:
-                        over_mesh.export(
-                            os.path.join(parts_dir, f"{over_wave[y, x]}_{y}_{x}_{over_wave_names[over_wave[y, x]]}.obj")
-                        )
-                        terrain_mesh.export(
-                            os.path.join(parts_dir, f"{wave[y, x]}_{y}_{x}_{wave_names[wave[y, x]]}_terrain.obj")
+                    has_over_mesh = len(over_mesh.vertices) > 0
+                    if enable_sdf:
+                        # Compute SDF around the mesh. Tiles without overhanging parts share the cached SDF of the tile.
+                        if has_over_mesh:
+                            mesh_sdf = compute_sdf(terrain_mesh + over_mesh, dim=sdf_dim, resolution=sdf_resolution)
+                        else:
+                            mesh_sdf = tile.get_sdf(sdf_dim, sdf_resolution)
+                        x_min = int(x * cfg.dim[0] / sdf_resolution)
+                        y_min = int((wave.shape[0] - y - 1) * cfg.dim[1] / sdf_resolution)
+                        x_max = int((x + 2 + 1) * cfg.dim[0] / sdf_resolution)
+                        y_max = int((wave.shape[0] - y + 2) * cfg.dim[1] / sdf_resolution)
+                        # Update sdf_min by comparing the relevant part
+                        sdf_min[x_min:x_max, y_min:y_max, :] = np.minimum(
+                            sdf_min[x_min:x_max, y_min:y_max, :], mesh_sdf
                         )
-                # Translate to the position of the tile
-                xy_offset = np.array([x * cfg.dim[0], -y * cfg.dim[1], 0.0])
-                mesh.apply_translation(xy_offset)
-                if overhanging_cfg is not None:
-                    over_mesh.apply_translation(xy_offset)
-                    terrain_mesh.apply_translation(xy_offset)
-                if enable_history:
-                    mesh.export(
-                        os.path.join(
-                            translated_parts_dir, f"{wave[y, x]}_{y}_{x}_{wave_names[wave[y, x]]}_translated.obj"
-                        )
-                    )
-                    if overhanging_cfg is not None:
-                        over_mesh.export(
-                            os.path.join(
-                                translated_parts_dir,
-                                f"{over_wave[y, x]}_{y}_{x}_{over_wave_names[over_wave[y, x]]}_translated.obj",
+
+                    # Translate to the position of the tile
+                    xy_offset = np.array([x * cfg.dim[0], -y * cfg.dim[1], 0.0])
+                    if enable_history:
+                        # save original parts for visualization
+                        mesh = terrain_mesh + over_mesh if has_over_mesh else terrain_mesh.copy()
+                        mesh.export(os.path.join(parts_dir, f"{wave[y, x]}_{y}_{x}_{wave_names[wave[y, x]]}.obj"))
+                        if overhanging_cfg is not None:
+                            over_mesh.export(
+                                os.path.join(
+                                    parts_dir, f"{over_wave[y, x]}_{y}_{x}_{over_wave_names[over_wave[y, x]]}.obj"
+                                )
                             )
-                        )
-                        terrain_mesh.export(
+                            terrain_mesh.export(
+                                os.path.join(parts_dir, f"{wave[y, x]}_{y}_{x}_{wave_names[wave[y, x]]}_terrain.obj")
+                            )
+                        mesh.apply_translation(xy_offset)
+                        mesh.export(
                             os.path.join(
-                                translated_parts_dir,
-                                f"{wave[y, x]}_{y}_{x}_{wave_names[wave[y, x]]}_terrain_translated.obj",
+                                translated_parts_dir, f"{wave[y, x]}_{y}_{x}_{wave_names[wave[y, x]]}_translated.obj"
                             )
                         )
-                result_mesh += mesh
-                if overhanging_cfg is not None:
-                    result_terrain_mesh += terrain_mesh
-                    result_overhanging_mesh += over_mesh
-                bar()
+                        if overhanging_cfg is not None:
+                            over_mesh.copy().apply_translation(xy_offset).export(
+                                os.path.join(
+                                    translated_parts_dir,
+                                    f"{over_wave[y, x]}_{y}_{x}_{over_wave_names[over_wave[y, x]]}_translated.obj",
+                                )
+                            )
+                            terrain_mesh.copy().apply_translation(xy_offset).export(
+                                os.path.join(
+                                    translated_parts_dir,
+                                    f"{wave[y, x]}_{y}_{x}_{wave_names[wave[y, x]]}_terrain_translated.obj",
+                                )
+                            )
+                    if has_over_mesh:
+                        over_mesh.apply_translation(xy_offset)
+                        over_meshes.append(over_mesh)
+                    bar()
+
+    if overhanging_cfg is not None:
+        result_overhanging_mesh = trimesh.util.concatenate(over_meshes) if over_meshes else trimesh.Trimesh()
+        result_mesh = trimesh.util.concatenate([result_terrain_mesh] + over_meshes)
+    else:
+        result_mesh = result_terrain_mesh
 
     bbox = result_mesh.bounding_box.bounds
     print("bbox = ", bbox)
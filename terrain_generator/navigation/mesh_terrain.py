@@ -9,14 +9,18 @@ import torch.nn.functional as F
 import json
 import os
 
+from collections import OrderedDict
 from typing import Optional, Tuple, Union
 from dataclasses import dataclass, asdict
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 
 from ..utils import (
     create_2d_graph_from_height_array,
     get_height_array_of_mesh_with_resolution,
     compute_sdf,
     compute_distance_matrix,
+    compute_distance_graph,
     sample_interpolated,
     NpEncoder,
 )
@@ -39,12 +43,18 @@ class MeshTerrainCfg:
     sdf_threshold: float = 0.4
     sdf_center: Tuple[float, float, float] = (0.0, 0.0, 0.0)
     sdf_max_value: float = -10.0
+    # If set, store the sdf as bricks within this distance from the surface. See SparseSDFArray.
+    sdf_band: Optional[float] = None
+    sdf_brick_size: int = 8
     height_offset: float = 0.5
     height_map_resolution: float = 0.1
     distance_center: Tuple[float, float, float] = (0.0, 0.0, 0.0)
     graph_ratio: int = 4
     height_cost_threshold: float = 0.4
     invalid_cost: float = 1000.0
+    # If set, the distances are computed per goal from the graph instead of storing all pairs. See NavDistance.
+    lazy_distance: bool = False
+    distance_cache_size: int = 128
 
 
 class MeshTerrain(object):
@@ -79,48 +89,55 @@ class MeshTerrain(object):
 
         # Load sdf
         if self.cfg.sdf is None:
-            self.sdf = SDFArray(max_value=self.cfg.sdf_max_value)
+            self.sdf = self.create_sdf_array(device=device)
             if self.cfg.sdf_path is not None:
                 print("Loading sdf ...")
                 self.sdf.load(os.path.join(self.root_dir, self.cfg.sdf_path))
             else:
                 print("Computing sdf ...")
                 sdf = compute_sdf(self.mesh, self.cfg.mesh_dim, self.cfg.sdf_resolution)
-                self.sdf = SDFArray(
-                    sdf,
-                    np.array(self.cfg.sdf_center),
-                    self.cfg.sdf_resolution,
-                    max_value=self.cfg.sdf_max_value,
-                    device=device,
-                )
+                self.sdf = self.create_sdf_array(sdf, device)
         else:
-            self.sdf = SDFArray(
-                self.cfg.sdf,
-                np.array(self.cfg.sdf_center),
-                self.cfg.sdf_resolution,
-                max_value=self.cfg.sdf_max_value,
-                device=device,
-            )
+            self.sdf = self.create_sdf_array(self.cfg.sdf, device)
         # Load distance
         if self.cfg.distance_matrix is None:
             if self.cfg.distance_path is not None:
                 self.nav_distance = NavDistance(
-                    resolution=self.cfg.height_map_resolution * self.cfg.graph_ratio, device=device
+                    resolution=self.cfg.height_map_resolution * self.cfg.graph_ratio,
+                    device=device,
+                    cache_size=self.cfg.distance_cache_size,
                 )
                 print("Loading distance ...")
                 self.nav_distance.load(os.path.join(self.root_dir, self.cfg.distance_path))
             else:
                 print("Computing distance ...")
-                matrix, shape, center = compute_distance_matrix(
-                    self.mesh,
-                    self.cfg.graph_ratio,
-                    height_threshold=self.cfg.height_cost_threshold,
-                    invalid_cost=self.cfg.invalid_cost,
-                    height_map_resolution=self.cfg.height_map_resolution,
-                )
-                self.nav_distance = NavDistance(
-                    matrix, shape, center, self.cfg.height_map_resolution * self.cfg.graph_ratio, device=device
-                )
+                if self.cfg.lazy_distance:
+                    graph, shape, center = compute_distance_graph(
+                        self.mesh,
+                        self.cfg.graph_ratio,
+                        height_threshold=self.cfg.height_cost_threshold,
+                        invalid_cost=self.cfg.invalid_cost,
+                        height_map_resolution=self.cfg.height_map_resolution,
+                    )
+                    self.nav_distance = NavDistance(
+                        shape=shape,
+                        center=center,
+                        resolution=self.cfg.height_map_resolution * self.cfg.graph_ratio,
+                        device=device,
+                        graph=graph,
+                        cache_size=self.cfg.distance_cache_size,
+                    )
+                else:
+                    matrix, shape, center = compute_distance_matrix(
+                        self.mesh,
+                        self.cfg.graph_ratio,
+                        height_threshold=self.cfg.height_cost_threshold,
+                        invalid_cost=self.cfg.invalid_cost,
+                        height_map_resolution=self.cfg.height_map_resolution,
+                    )
+                    self.nav_distance = NavDistance(
+                        matrix, shape, center, self.cfg.height_map_resolution * self.cfg.graph_ratio, device=device
+                    )
         else:
             self.nav_distance = NavDistance(
                 self.cfg.distance_matrix,
@@ -133,6 +150,33 @@ class MeshTerrain(object):
         # self.cfg.distance_shape = shape
         # self.cfg.distance_center = distance_center
 
+    def create_sdf_array(
+        self, sdf: Optional[np.ndarray] = None, device: str = "cpu"
+    ) -> Union["SDFArray", "SparseSDFArray"]:
+        """Create a SDFArray, or a SparseSDFArray if sdf_band is set. Returns an empty array if sdf is None.
+        The SparseSDFArray is converted from the dense sdf, so it reduces the memory of the stored array but not the
+        peak memory while the dense sdf is computed.
+        """
+        if self.cfg.sdf_band is None:
+            if sdf is None:
+                return SDFArray(max_value=self.cfg.sdf_max_value)
+            return SDFArray(
+                sdf,
+                np.array(self.cfg.sdf_center),
+                self.cfg.sdf_resolution,
+                max_value=self.cfg.sdf_max_value,
+                device=device,
+            )
+        kwargs = dict(
+            max_value=self.cfg.sdf_max_value,
+            band=self.cfg.sdf_band,
+            brick_size=self.cfg.sdf_brick_size,
+            device=device,
+        )
+        if sdf is None:
+            return SparseSDFArray(**kwargs)
+        return SparseSDFArray(sdf, np.array(self.cfg.sdf_center), self.cfg.sdf_resolution, **kwargs)
+
     def load_mesh(self, mesh_path: Optional[str] = None):
         if mesh_path is None:
             raise ValueError("mesh is not set")
@@ -281,6 +325,179 @@ class SDFArray(object):
         self.__init__(data["array"], data["center"], data["resolution"])
 
 
+class SparseSDFArray(object):
+    def __init__(
+        self,
+        array: Union[np.ndarray, torch.Tensor] = torch.zeros(1, 1, 1),
+        center: Union[np.ndarray, torch.Tensor] = torch.zeros(3),
+        resolution: float = 0.1,
+        max_value: float = 1000,
+        band: float = 0.5,
+        brick_size: int = 8,
+        device: Union[str, torch.device] = torch.device("cpu"),
+    ):
+        """Narrow band SDF array stored as bricks of brick_size^3 cells.
+        Only the bricks which have a value within band of the surface are stored. Other bricks inside the array return
+        band, or -band if they are inside of the geometry, and points outside of the array return max_value.
+        Neighboring bricks share their border samples, so that the trilinear interpolation reads a single brick.
+        Args: array (np.ndarray or torch.Tensor): Dense SDF array to convert.
+            center (np.ndarray or torch.Tensor): Center of the array.
+            resolution (float): Resolution of the array.
+            max_value (float): Value outside of the array.
+            band (float): Distance from the surface to store. Should be larger than a few cells.
+            brick_size (int): Number of cells of a brick along each axis.
+            device (torch.device): Device to store the array.
+        """
+        if isinstance(array, torch.Tensor):
+            array = array.cpu().numpy()
+        if isinstance(center, np.ndarray):
+            center = torch.from_numpy(center)
+        self.center = center.to(device)
+        self.resolution = resolution
+        self.max_value = max_value
+        self.band = band
+        self.brick_size = brick_size
+        self.device = torch.device(device)
+        self.shape = tuple(array.shape)
+        brick_index, bricks = self._create_bricks(array)
+        self.brick_index = torch.from_numpy(brick_index).to(device)
+        self.bricks = torch.from_numpy(bricks).to(device)
+
+    def _create_bricks(self, array: np.ndarray):
+        """Split a dense array into bricks and keep the ones within the band.
+        Returns:
+            brick_index (np.ndarray): Index of the brick in bricks per brick cell, -1 outside and -2 inside of the
+                geometry for the bricks which are not stored.
+            bricks (np.ndarray): Stored bricks of shape (n, (brick_size + 1)^3).
+        """
+        b = self.brick_size
+        n_bricks = [max(1, int(np.ceil((s - 1) / b))) for s in array.shape]
+        pad = [(0, n * b + 1 - s) for n, s in zip(n_bricks, array.shape)]
+        array = np.pad(array.astype(np.float32), pad, mode="edge")
+        brick_index = np.zeros(n_bricks, dtype=np.int32)
+        bricks = []
+        n_stored = 0
+        # Process one slab of bricks at a time to bound the temporary memory.
+        for i in range(n_bricks[0]):
+            slab = np.lib.stride_tricks.sliding_window_view(array[i * b : i * b + b + 1], (b + 1,) * 3, axis=(0, 1, 2))
+            slab = slab[0, ::b, ::b]
+            is_near = np.abs(slab).min(axis=(-3, -2, -1)) <= self.band
+            is_inside = slab.mean(axis=(-3, -2, -1)) < 0
+            indices = np.where(is_inside, -2, -1).astype(np.int32)
+            indices[is_near] = np.arange(n_stored, n_stored + is_near.sum(), dtype=np.int32)
+            brick_index[i] = indices
+            bricks.append(slab[is_near].reshape(-1, (b + 1) ** 3))
+            n_stored += is_near.sum()
+        return brick_index, np.concatenate(bricks, 0)
+
+    @property
+    def nbytes(self) -> int:
+        return self.bricks.element_size() * self.bricks.nelement() + self.brick_index.element_size() * (
+            self.brick_index.nelement()
+        )
+
+    def to(self, device: torch.device):
+        """Move the array to a new device.
+        Args: device (torch.device): New device.
+        """
+        self.bricks = self.bricks.to(device)
+        self.brick_index = self.brick_index.to(device)
+        self.center = self.center.to(device)
+        self.device = device
+        return self
+
+    def transform(self, transformation: Union[np.ndarray, torch.Tensor]):
+        """Move the array by a transformation. Only translations are supported, as the bricks are axis-aligned.
+        Args: transformation (np.ndarray or torch.Tensor): 4x4 transformation matrix.
+        """
+        if isinstance(transformation, np.ndarray):
+            transformation = torch.from_numpy(transformation)
+        transformation = transformation.to(self.device)
+        if not torch.allclose(transformation[:3, :3].double().cpu(), torch.eye(3, dtype=torch.float64), atol=1e-6):
+            raise ValueError("SparseSDFArray only supports translations, the transformation has a rotation.")
+        self.center = transformation.matmul(torch.cat([self.center, torch.tensor([1])], 0))[:3]
+
+    def get_sdf(self, point: Union[np.ndarray, torch.Tensor]) -> Union[np.ndarray, torch.Tensor]:
+        """Get the SDF value at a point in space.
+        Args: point (np.ndarray or torch.Tensor): Points of shape (..., 3).
+        Returns: sdf (torch.Tensor): The SDF values of shape (1, 1, N, 1, 1) for N points, the same as SDFArray.
+        """
+        use_torch = isinstance(point, torch.Tensor)
+        if isinstance(point, np.ndarray):
+            point = torch.from_numpy(point)
+        point = point.to(self.device).reshape(-1, 3).float()
+        point = (point - self.center) / self.resolution
+        shape = torch.tensor(self.shape, device=self.device)
+        point += shape // 2
+        is_valid = ((point >= 0) & (point <= shape - 1)).all(-1)
+
+        b = self.brick_size
+        n_bricks = torch.tensor(self.brick_index.shape, device=self.device)
+        brick = torch.minimum(torch.div(point, b, rounding_mode="floor").long().clamp(min=0), n_bricks - 1)
+        local = (point - brick * b).clamp(0, b)
+        local_0 = local.floor().long().clamp(max=b - 1)
+        frac = local - local_0
+        index = self.brick_index[brick[:, 0], brick[:, 1], brick[:, 2]].long()
+
+        # Gather the 8 corners of the cell from the brick.
+        offsets = torch.tensor(
+            [[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)], device=self.device, dtype=torch.long
+        )
+        corners = local_0.unsqueeze(1) + offsets
+        flat = (corners[..., 0] * (b + 1) + corners[..., 1]) * (b + 1) + corners[..., 2]
+        values = self.bricks[index.clamp(min=0).unsqueeze(1), flat]
+        weights = torch.where(offsets.bool(), frac.unsqueeze(1), 1 - frac.unsqueeze(1)).prod(-1)
+        sdf = (values * weights).sum(-1)
+
+        sdf = torch.where(index == -1, torch.tensor(self.band, device=self.device), sdf)
+        sdf = torch.where(index == -2, torch.tensor(-self.band, device=self.device), sdf)
+        sdf = torch.where(is_valid, sdf, torch.tensor(self.max_value, dtype=sdf.dtype, device=self.device))
+        sdf = sdf.reshape(1, 1, -1, 1, 1)
+        if not use_torch:
+            sdf = sdf.cpu().numpy()
+        return sdf
+
+    def save(self, file_prefix):
+        """Save SDF array to file.
+        Args: file_path (str): File path to save SDF array.
+        """
+        data = {
+            "bricks": self.bricks.cpu().numpy(),
+            "brick_index": self.brick_index.cpu().numpy(),
+            "shape": self.shape,
+            "brick_size": self.brick_size,
+            "band": self.band,
+            "center": self.center.cpu().numpy(),
+            "resolution": self.resolution,
+        }
+        np.save(file_prefix + ".npy", data)
+        return file_prefix + ".npy"
+
+    def load(self, file_path):
+        """Load SDF array from file. A dense SDF array saved by SDFArray is converted to bricks.
+        Args: file_path (str): File path to load SDF array.
+        """
+        data = np.load(file_path, allow_pickle=True).item()
+        if "array" in data:
+            self.__init__(
+                data["array"],
+                data["center"],
+                data["resolution"],
+                self.max_value,
+                self.band,
+                self.brick_size,
+                self.device,
+            )
+            return
+        self.center = torch.from_numpy(data["center"]).to(self.device)
+        self.resolution = data["resolution"]
+        self.band = data["band"]
+        self.brick_size = data["brick_size"]
+        self.shape = tuple(data["shape"])
+        self.brick_index = torch.from_numpy(data["brick_index"]).to(self.device)
+        self.bricks = torch.from_numpy(data["bricks"]).to(self.device)
+
+
 class NavDistance(object):
     """Navigation distance class."""
 
@@ -292,18 +509,30 @@ class NavDistance(object):
         resolution: float = 0.1,
         max_value: float = 1000,
         device: Union[str, torch.device] = torch.device("cpu"),
+        graph: Optional[csr_matrix] = None,
+        cache_size: int = 128,
     ):
         """Navigation distance class.
         Args: matrix (np.ndarray or torch.Tensor): distance matrix.
             center (np.ndarray or torch.Tensor): Center of the distance matrix.
             resolution (float): Resolution of the array.
             device (torch.device): Device to store the array.
+            graph (csr_matrix): Adjacency matrix of the graph. If set, matrix is ignored and the distances to a goal
+                are computed with dijkstra when requested.
+            cache_size (int): Number of goals whose distances are kept when graph is set.
         """
-        if isinstance(matrix, np.ndarray):
-            matrix = torch.from_numpy(matrix)
         if isinstance(center, np.ndarray):
             center = torch.from_numpy(center)
-        self.matrix = matrix.to(device).float()
+        if graph is None:
+            if isinstance(matrix, np.ndarray):
+                matrix = torch.from_numpy(matrix)
+            self.matrix = matrix.to(device).float()
+            self.graph = None
+        else:
+            self.matrix = None
+            self.graph = csr_matrix(graph)
+        self.cache_size = cache_size
+        self.distance_cache = OrderedDict()
         self.center = center.to(device).float()[:2]
         self.resolution = resolution
         self.max_value = max_value
@@ -314,11 +543,42 @@ class NavDistance(object):
         """Move the array to a new device.
         Args: device (torch.device): New device.
         """
-        self.matrix = self.matrix.to(device)
+        if self.matrix is not None:
+            self.matrix = self.matrix.to(device)
+        for goal_idx, distances in self.distance_cache.items():
+            self.distance_cache[goal_idx] = distances.to(device)
         self.center = self.center.to(device)
         self.device = device
         return self
 
+    def get_goal_distances(self, goal_idx: torch.Tensor) -> torch.Tensor:
+        """Distances from the goal nodes to all nodes.
+        Without a distance matrix, the missing goals are solved with dijkstra and the results of the last cache_size
+        goals are kept.
+        Args: goal_idx (torch.Tensor): Node indices of shape (B,).
+        Returns: torch.Tensor: Distances of shape (B, N).
+        """
+        if self.matrix is not None:
+            return self.matrix[goal_idx, :]
+        goals = goal_idx.tolist()
+        distances = {}
+        missing = []
+        for goal in dict.fromkeys(goals):
+            if goal in self.distance_cache:
+                self.distance_cache.move_to_end(goal)
+                distances[goal] = self.distance_cache[goal]
+            else:
+                missing.append(goal)
+        if missing:
+            solved = dijkstra(self.graph, directed=False, indices=missing)
+            solved = torch.from_numpy(solved).to(self.device).float()
+            for goal, row in zip(missing, solved):
+                distances[goal] = row
+                self.distance_cache[goal] = row
+            while len(self.distance_cache) > self.cache_size:
+                self.distance_cache.popitem(last=False)
+        return torch.stack([distances[goal] for goal in goals], 0)
+
     def transform(self, transformation: Union[np.ndarray, torch.Tensor]):
         # TODO: support rotation
         if isinstance(transformation, np.ndarray):
@@ -343,7 +603,7 @@ class NavDistance(object):
         goal_pos += torch.tensor(self.shape, device=self.device) // 2
         goal_idx = (torch.round(goal_pos[:, 1]) * self.shape[0] + torch.round(goal_pos[:, 0])).long()
         goal_idx = torch.clip(goal_idx, 0, self.shape[0] * self.shape[1] - 1)
-        distance_map = self.matrix[goal_idx, :].reshape(-1, self.shape[0], self.shape[1])
+        distance_map = self.get_goal_distances(goal_idx).reshape(-1, self.shape[0], self.shape[1])
         distance_map = distance_map.transpose(1, 2)
 
         point = point.to(self.device)
@@ -375,11 +635,14 @@ class NavDistance(object):
         Args: file_path (str): File path to save SDF array.
         """
         data = {
-            "matrix": self.matrix.float().cpu().numpy(),
             "center": self.center.float().cpu().numpy(),
             "shape": self.shape,
             "resolution": self.resolution,
         }
+        if self.matrix is not None:
+            data["matrix"] = self.matrix.float().cpu().numpy()
+        else:
+            data["graph"] = self.graph
         np.save(file_prefix + ".npy", data)
         return file_prefix + ".npy"
 
@@ -388,7 +651,16 @@ class NavDistance(object):
         Args: file_path (str): File path to load SDF array.
         """
         data = np.load(file_path, allow_pickle=True).item()
-        self.__init__(data["matrix"], data["shape"], data["center"], data["resolution"])
+        if "graph" in data:
+            self.__init__(
+                shape=data["shape"],
+                center=data["center"],
+                resolution=data["resolution"],
+                graph=data["graph"],
+                cache_size=self.cache_size,
+            )
+        else:
+            self.__init__(data["matrix"], data["shape"], data["center"], data["resolution"])
 
     #
     # def get_distance(
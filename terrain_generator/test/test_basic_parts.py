@@ -67,3 +67,21 @@ def test_rail(visualize=False):
         print(capsule_cfg)
         mesh.show()
         print(get_height_array_of_mesh(capsule_mesh, capsule_cfg.dim, 5))
+
+
+def test_heightfield_to_trimesh():
+    height_field = np.random.default_rng(0).random((5, 4))
+    vertices, triangles = convert_heightfield_to_trimesh(height_field, 0.1, 2.0, return_arrays=True)
+    assert vertices.shape == (20, 3)
+    assert triangles.shape == (2 * 4 * 3, 3)
+    assert np.allclose(vertices[:, 2], height_field.flatten() * 2.0)
+    # Two triangles of the first cell.
+    assert np.array_equal(triangles[:2], [[0, 5, 1], [0, 4, 5]])
+    # All triangles face up.
+    normals = np.cross(
+        vertices[triangles[:, 1]] - vertices[triangles[:, 0]], vertices[triangles[:, 2]] - vertices[triangles[:, 0]]
+    )
+    assert np.all(normals[:, 2] > 0)
+
+    mesh = convert_heightfield_to_trimesh(height_field, 0.1, 2.0)
+    assert np.array_equal(mesh.faces, triangles)
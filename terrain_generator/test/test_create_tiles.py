@@ -0,0 +1,73 @@
+#
+# Copyright (c) 2023, Takahiro Miki. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+import os
+import numpy as np
+import trimesh
+
+from ..utils import cache
+from ..wfc.tiles import MeshTile
+from ..trimesh_tiles.mesh_parts.create_tiles import create_mesh_from_wave, create_mesh_pattern
+from ..trimesh_tiles.mesh_parts.mesh_parts_cfg import MeshPattern, PlatformMeshPartsCfg
+
+
+def test_create_mesh_from_wave():
+    box = trimesh.creation.box([1.0, 1.0, 0.5])
+    step = trimesh.creation.box([1.0, 0.5, 1.0])
+    all_tiles = MeshTile("box", box, array=np.zeros((3, 3))).get_all_tiles()
+    all_tiles += MeshTile("step", step, array=np.zeros((3, 3))).get_all_tiles(rotations=(90,))
+    tiles = {tile.name: tile for tile in all_tiles}
+    names = list(tiles.keys())
+    wave = np.random.default_rng(0).integers(0, len(names), (5, 4))
+
+    # Reference: translate and add each tile in turn.
+    expected = trimesh.Trimesh()
+    for y in range(wave.shape[0]):
+        for x in range(wave.shape[1]):
+            mesh = tiles[names[wave[y, x]]].get_mesh().copy()
+            mesh.apply_translation([x * 2.0, -y * 2.0, 0.0])
+            expected += mesh
+
+    mesh = create_mesh_from_wave(wave, names, tiles, (2.0, 2.0, 2.0))
+    assert mesh.vertices.shape == expected.vertices.shape
+    assert mesh.faces.shape == expected.faces.shape
+    assert np.isclose(mesh.volume, expected.volume)
+    assert np.allclose(mesh.bounds, expected.bounds)
+
+    # Same set of triangles.
+    def sorted_triangles(m):
+        triangles = np.round(m.triangles.reshape(len(m.faces), -1), 6)
+        return triangles[np.lexsort(triangles.T[::-1])]
+
+    assert np.allclose(sorted_triangles(mesh), sorted_triangles(expected))
+
+    meshes, transforms = create_mesh_from_wave(wave, names, tiles, (2.0, 2.0, 2.0), instanced=True)
+    assert sum(len(t) for t in transforms.values()) == wave.size
+    instances = [meshes[name].copy().apply_transform(t) for name in meshes for t in transforms[name]]
+    assert np.isclose(trimesh.util.concatenate(instances).volume, expected.volume)
+
+
+def test_create_mesh_pattern(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    array = np.array([[1.0, 0.0], [0.0, 0.0]])
+    pattern = MeshPattern(
+        mesh_parts=(
+            PlatformMeshPartsCfg(name="platform", array=array, rotations=(90,), load_from_cache=False),
+            PlatformMeshPartsCfg(name="platform_mesh", array=array * 0.5, flips=("x",), use_generator=False),
+            # Same geometry as "platform", the mesh is created once.
+            PlatformMeshPartsCfg(name="platform_copy", array=array.copy(), weight=0.5, use_generator=False),
+        )
+    )
+    serial_tiles = create_mesh_pattern(pattern, executor="serial")
+    tiles = create_mesh_pattern(pattern, executor="process", n_workers=2)
+    assert sorted(tiles.keys()) == sorted(serial_tiles.keys())
+    assert len(tiles) == 5
+    assert tiles["platform_copy"].weight == 0.5
+    assert len([f for f in os.listdir(tmp_path / "mesh_cache") if f.endswith("_vertices.npy")]) == 2
+    for name, tile in tiles.items():
+        assert tile.edges == serial_tiles[name].edges
+        assert np.allclose(tile.get_mesh().bounds, serial_tiles[name].get_mesh().bounds)
+        assert np.isclose(tile.get_mesh().volume, serial_tiles[name].get_mesh().volume)
+    # The configs are not modified.
+    assert all(mesh_cfg.edge_array is None for mesh_cfg in pattern.mesh_parts)
@@ -14,6 +14,8 @@ from ..utils import (
     visualize_sdf,
     visualize_mesh_and_sdf,
     clean_mesh,
+    create_boxes_mesh,
+    create_greedy_boxes_mesh,
 )
 
 
@@ -122,6 +124,40 @@ def test_compute_sdf(visualize=False):
         visualize_mesh_and_sdf(box, sdf, voxel_size=0.1)
 
 
+def test_compute_sdf_chunked(tmp_path):
+    box = trimesh.creation.box([0.5, 1.0, 0.5], trimesh.transformations.translation_matrix([0.3, 0.0, 0.0]))
+    sdf = compute_sdf(mesh=box, dim=[2, 3, 1], resolution=0.1)
+    assert sdf.shape == (20, 30, 10)
+    # The box is at positive x and spans y.
+    assert sdf[12, 15, 5] < 0 and sdf[2, 15, 5] > 0 and sdf[15, 2, 5] > 0
+
+    chunked = compute_sdf(mesh=box, dim=[2, 3, 1], resolution=0.1, chunk_size=500)
+    assert np.allclose(chunked, sdf)
+
+    path = str(tmp_path / "sdf.npy")
+    out = compute_sdf(mesh=box, dim=[2, 3, 1], resolution=0.1, chunk_size=500, out=path)
+    assert isinstance(out, np.memmap)
+    assert np.allclose(np.load(path), sdf)
+
+
+def test_compute_sdf_sign_method():
+    box = trimesh.creation.box([0.5, 1.0, 0.5], trimesh.transformations.translation_matrix([0.3, 0.0, 0.0]))
+    box2 = trimesh.creation.box([0.5, 0.5, 0.5], trimesh.transformations.translation_matrix([-0.5, 0.5, 0.0]))
+    mesh = box + box2
+    vertices = mesh.vertices.copy()
+    random_state = np.random.get_state()[1].copy()
+    expected = compute_sdf(mesh, dim=[2, 2, 1], resolution=0.05)
+    # The mesh and the global random state are not modified.
+    assert np.array_equal(mesh.vertices, vertices)
+    assert np.array_equal(np.random.get_state()[1], random_state)
+    for sign_method in ["signed_distance", "flood_fill"]:
+        for nsamples in [1, 3]:
+            sdf = compute_sdf(
+                mesh, dim=[2, 2, 1], resolution=0.05, chunk_size=2000, sign_method=sign_method, nsamples=nsamples
+            )
+            assert np.allclose(sdf, expected)
+
+
 def test_clean_mesh(visualize=True):
     box = trimesh.creation.box([0.5, 0.5, 0.5], trimesh.transformations.translation_matrix([0.0, 0.0, 0.0]))
     box2 = trimesh.creation.box([0.5, 0.5, 0.5], trimesh.transformations.translation_matrix([0.25, 0.0, 0.0]))
@@ -140,3 +176,80 @@ def test_clean_mesh(visualize=True):
 # def test_visualize_sdf(sdf_path):
 #     sdf = np.load(sdf_path)
 #     visualize_sdf(sdf)
+
+
+def test_create_boxes_mesh():
+    extents = np.array([[1.0, 2.0, 3.0], [0.5, 0.5, 0.5]])
+    centers = np.array([[1.0, 1.0, 1.0], [-1.0, 0.0, 0.0]])
+    mesh = create_boxes_mesh(extents, centers)
+    expected = merge_meshes(
+        [trimesh.creation.box(e, trimesh.transformations.translation_matrix(c)) for e, c in zip(extents, centers)]
+    )
+    assert len(mesh.faces) == len(expected.faces)
+    assert np.isclose(mesh.volume, expected.volume)
+    assert np.allclose(mesh.bounds, expected.bounds)
+    assert mesh.is_winding_consistent
+
+    transforms = np.stack([trimesh.transformations.rotation_matrix(0.3, [1, 1, 0], c) for c in centers])
+    mesh = create_boxes_mesh(extents, transforms=transforms)
+    expected = merge_meshes([trimesh.creation.box(e, t) for e, t in zip(extents, transforms)])
+    assert np.allclose(mesh.bounds, expected.bounds)
+
+    # 4x3 grid of unit cubes, one of them higher. Only the sides between cells of the same height are removed.
+    centers = np.array([[x, y, 0.5] for x in range(4) for y in range(3)], dtype=float)
+    extents = np.ones((12, 3))
+    mesh = create_boxes_mesh(extents, centers, cull_shared_faces=True)
+    assert len(mesh.faces) == 2 * (12 + 12 + 14)
+    assert mesh.is_watertight
+    assert np.isclose(mesh.volume, 12.0)
+    centers[0, 2] = 1.0
+    extents[0, 2] = 2.0
+    mesh = create_boxes_mesh(extents, centers, cull_shared_faces=True)
+    assert len(mesh.faces) == 2 * (12 + 12 + 14 + 4)
+    assert mesh.is_watertight
+
+    # Neighbours of different heights on the same ground only touch, they stay watertight.
+    rng = np.random.default_rng(0)
+    for _ in range(10):
+        heights = rng.integers(1, 4, (6, 6)) * 0.5
+        y, x = np.nonzero(heights > 0)
+        centers = np.stack([x, y, heights[y, x] / 2.0], axis=-1).astype(float)
+        extents = np.stack([np.ones(len(x)), np.ones(len(x)), heights[y, x]], axis=-1)
+        mesh = create_boxes_mesh(extents, centers, cull_shared_faces=True)
+        assert mesh.is_watertight
+        assert np.isclose(mesh.volume, extents.prod(-1).sum())
+
+
+def test_create_greedy_boxes_mesh():
+    # Columns of 4x4 cells of the same height on a floor.
+    heights = np.kron(np.array([[0.3, 0.6, 0.6], [0.9, 0.9, 0.6], [0.3, 0.3, 0.3]]), np.ones((4, 4)))
+    y, x = np.nonzero(heights > 0)
+    centers = np.stack([x * 0.1, -y * 0.1, heights[y, x] / 2.0], axis=-1)
+    extents = np.stack([np.full(len(x), 0.1), np.full(len(x), 0.1), heights[y, x]], axis=-1)
+    centers = np.concatenate([centers, [[0.55, -0.55, 0.05]]])
+    extents = np.concatenate([extents, [[1.2, 1.2, 0.1]]])
+
+    mesh = create_greedy_boxes_mesh(extents, centers)
+    boxes = create_boxes_mesh(extents[:-1], centers[:-1])
+    assert mesh.is_watertight
+    assert mesh.is_winding_consistent
+    assert np.isclose(mesh.volume, heights.sum() * 0.01)
+    assert np.allclose(mesh.bounds, boxes.bounds)
+    assert len(mesh.faces) < len(boxes.faces) / 10
+    # Same surface seen from above.
+    assert np.allclose(
+        get_height_array_of_mesh(mesh, (1.2, 1.2, 2.0), 12), get_height_array_of_mesh(boxes, (1.2, 1.2, 2.0), 12)
+    )
+
+    # Random heights have cells touching only along an edge, and are not worse than the boxes.
+    rng = np.random.default_rng(0)
+    for _ in range(10):
+        heights = rng.integers(1, 5, (10, 10)) * 0.1
+        y, x = np.nonzero(heights > 0)
+        centers = np.stack([x * 0.1, -y * 0.1, heights[y, x] / 2.0], axis=-1)
+        extents = np.stack([np.full(len(x), 0.1), np.full(len(x), 0.1), heights[y, x]], axis=-1)
+        mesh = create_greedy_boxes_mesh(extents, centers)
+        boxes = create_boxes_mesh(extents, centers, cull_shared_faces=True)
+        assert mesh.is_watertight
+        assert len(mesh.faces) <= len(boxes.faces)
+        assert np.isclose(mesh.volume, heights.sum() * 0.01)
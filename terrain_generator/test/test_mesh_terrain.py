@@ -3,6 +3,7 @@
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
 import numpy as np
+import pytest
 import torch
 import trimesh
 
@@ -17,7 +18,7 @@ from ..utils import (
     visualize_distance,
 )
 
-from ..navigation.mesh_terrain import MeshTerrain, MeshTerrainCfg, SDFArray, NavDistance
+from ..navigation.mesh_terrain import MeshTerrain, MeshTerrainCfg, SDFArray, SparseSDFArray, NavDistance
 
 
 def test_mesh_terrain_transform(visualize):
@@ -35,3 +36,44 @@ def test_mesh_terrain_transform(visualize):
     nav_mesh.transform(transform)
     assert np.allclose(nav_mesh.sdf.center, translation * 2, atol=1e-5)
     assert np.allclose(nav_mesh.nav_distance.center, translation[:2] * 2, rtol=1e-3, atol=1e-5)
+
+
+def test_sparse_sdf_array(tmp_path):
+    # SDF of a sphere of radius 0.5 in a grid of 4 x 4 x 2 m.
+    resolution = 0.05
+    xyz = [np.arange(n) * resolution - (n // 2) * resolution for n in (80, 80, 40)]
+    grid = np.stack(np.meshgrid(*xyz, indexing="ij"), axis=-1)
+    array = (np.linalg.norm(grid, axis=-1) - 0.5).astype(np.float32)
+    center = np.array([1.0, 2.0, 0.5])
+    dense = SDFArray(array, center, resolution, max_value=-10.0)
+    sparse = SparseSDFArray(array, center, resolution, max_value=-10.0, band=0.3, brick_size=8)
+    assert sparse.nbytes < array.nbytes / 4
+
+    points = center + np.random.uniform(-0.7, 0.7, size=(1000, 3)) * np.array([1.0, 1.0, 0.6])
+    expected = dense.get_sdf(points)
+    values = sparse.get_sdf(points)
+    # Same shape as the dense array, so that MeshTerrain.get_sdf does not depend on the type of the array.
+    assert values.shape == expected.shape == (1, 1, 1000, 1, 1)
+    is_near = np.abs(expected) < 0.3
+    assert np.allclose(values[is_near], expected[is_near], atol=1e-5)
+    assert np.all(np.abs(values[~is_near]) >= 0.3 - 1e-5)
+    assert np.all(np.sign(values[~is_near]) == np.sign(expected[~is_near]))
+
+    # Inside of a stored brick, far from the surface, and outside of the array.
+    far_points = center + np.array([[0.0, 0.0, 0.0], [1.8, 1.8, 0.0], [3.0, 0.0, 0.0]])
+    assert np.allclose(sparse.get_sdf(torch.from_numpy(far_points)).numpy().reshape(-1), [-0.5, 0.3, -10.0])
+
+    loaded = SparseSDFArray(max_value=-10.0)
+    loaded.load(sparse.save(str(tmp_path / "sdf")))
+    assert np.allclose(loaded.get_sdf(points), values)
+    # Translations move the array, rotations are not supported.
+    transform = np.eye(4)
+    transform[:3, 3] = [1.0, -1.0, 0.5]
+    loaded.transform(transform)
+    assert np.allclose(loaded.get_sdf(points + transform[:3, 3]), values, atol=1e-5)
+    with pytest.raises(ValueError):
+        loaded.transform(trimesh.transformations.rotation_matrix(np.pi / 2, [0, 0, 1]))
+    # A dense SDF file is converted on load.
+    loaded = SparseSDFArray(max_value=-10.0, band=0.3)
+    loaded.load(dense.save(str(tmp_path / "dense_sdf")))
+    assert np.allclose(loaded.get_sdf(points), values)
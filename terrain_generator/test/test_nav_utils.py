@@ -17,6 +17,7 @@ from ..utils import (
     filter_spawnable_locations_with_sdf,
     get_height_array_of_mesh_with_resolution,
     distance_matrix_from_graph,
+    adjacency_matrix_from_graph,
     create_2d_graph_from_height_array,
     visualize_distance,
 )
@@ -225,6 +226,33 @@ def test_nav_distance(visualize):
     # assert torch.allclose(distances, expected_values)
 
 
+def test_nav_lazy_distance(tmp_path):
+    height_array = np.zeros((80, 100))
+    height_array[20, :60] = 2.0
+    height_array[40, 20:] = 2.0
+    height_array[60, :50] = 2.0
+    G = create_2d_graph_from_height_array(height_array, graph_ratio=4, invalid_cost=1000)
+    nav_distance = NavDistance(distance_matrix_from_graph(G), shape=(20, 25), resolution=0.4)
+    lazy_distance = NavDistance(shape=(20, 25), resolution=0.4, graph=adjacency_matrix_from_graph(G), cache_size=2)
+    assert lazy_distance.matrix is None
+
+    points = torch.rand(2, 50, 2) * 8.0 - 4.0
+    goal_pos = torch.Tensor([[0.0, -1.5], [0.0, 1.5]])
+    assert torch.allclose(lazy_distance.get_distance(points, goal_pos), nav_distance.get_distance(points, goal_pos))
+    assert len(lazy_distance.distance_cache) == 2
+
+    # Repeated goals, and more goals than the cache size.
+    goal_pos = torch.Tensor([[0.0, -1.5], [2.0, 2.0], [0.0, -1.5], [-3.0, 1.0]])
+    expected = nav_distance.get_distance(points[0], goal_pos)
+    assert torch.allclose(lazy_distance.get_distance(points[0], goal_pos), expected)
+    assert len(lazy_distance.distance_cache) == 2
+
+    loaded = NavDistance()
+    loaded.load(lazy_distance.save(str(tmp_path / "distance")))
+    assert loaded.matrix is None
+    assert torch.allclose(loaded.get_distance(points[0], goal_pos), expected)
+
+
 def test_nav_batched_distance(visualize):
     height_array = np.zeros((80, 100))
     height_array[20, :60] = 2.0
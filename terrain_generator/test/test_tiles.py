@@ -3,10 +3,12 @@
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
 import numpy as np
+import trimesh
 
 import sys
 
-from ..wfc.tiles import Tile, ArrayTile, MeshTile
+from ..wfc.tiles import Tile, ArrayTile, MeshTile, MeshCache, SDF_CACHE
+from ..utils import flip_mesh, yaw_rotate_mesh, compute_sdf
 
 
 def test_tile():
@@ -60,3 +62,81 @@ def test_array_tile():
     assert flipped_tile.edges["right"] == tile.edges["right"][::-1]
     assert flipped_tile.edges["down"] == tile.edges["up"][::-1]
     assert flipped_tile.edges["left"] == tile.edges["left"][::-1]
+
+
+def test_array_tile_3d():
+    array = np.arange(27).reshape(3, 3, 3)
+    tile = ArrayTile(name="tile", array=array, dimension=3)
+    assert len(tile.edges) == 6
+    assert tile.edges["up"] == tuple(array[:, :, -1].flatten())
+    assert tile.edges["down"] == tuple(array[:, :, 0].flatten()[::-1])
+
+    for t in tile.get_all_tiles(rotations=(90, 180, 270), flips=("x", "y", "z")):
+        # Edges are computed from the transformed array.
+        assert t.edges == ArrayTile(name=t.name, array=t.array, dimension=3).edges
+    rotated_tile = tile.get_rotated_tile(90)
+    assert rotated_tile.name == "tile_90"
+    assert np.allclose(rotated_tile.array, np.rot90(array, 1))
+    # Rotation around the z axis keeps the top face up to the rotation.
+    assert sorted(rotated_tile.edges["up"]) == sorted(tile.edges["up"])
+
+
+def test_mesh_tile_cache():
+    n_calls = [0]
+
+    def mesh_gen():
+        n_calls[0] += 1
+        return trimesh.creation.box([1.0, 0.5, 0.2], trimesh.transformations.translation_matrix([0.2, 0.1, 0.0]))
+
+    tile = MeshTile(name="box", mesh=mesh_gen, array=np.zeros((3, 3)))
+    tiles = tile.get_all_tiles(rotations=(90, 180, 270), flips=("x", "y"))
+    for _ in range(2):
+        meshes = [t.get_mesh() for t in tiles]
+    # The root mesh is generated once and every variant is transformed once from its parent.
+    assert n_calls[0] == 1
+
+    flipped_rotated = tile.get_flipped_tile("y").get_rotated_tile(90)
+    assert flipped_rotated.transforms == (("flip", "y"), ("rotate", 90))
+    expected = yaw_rotate_mesh(flip_mesh(mesh_gen(), "y"), 90)
+    assert np.allclose(flipped_rotated.get_mesh().vertices, expected.vertices)
+
+    # Shared meshes use the cached arrays, which can not be modified in place.
+    mesh = tiles[1].get_shared_mesh()
+    assert not mesh.vertices.flags.writeable
+    mesh.apply_translation([1.0, 0.0, 0.0])
+    assert np.allclose(tiles[1].get_mesh().vertices, meshes[1].vertices)
+    # get_mesh returns a copy which can be modified in place.
+    mesh = tiles[1].get_mesh()
+    mesh.vertices += 1.0
+    assert np.allclose(tiles[1].get_shared_mesh().vertices, meshes[1].vertices)
+
+    cache = MeshCache(max_size=2)
+    for i in range(3):
+        cache.get(i, mesh_gen)
+    assert len(cache) == 2 and 0 not in cache
+
+    # Bounded by bytes, the number of meshes does not matter.
+    box_bytes = mesh_gen().vertices.nbytes + mesh_gen().faces.nbytes
+    cache = MeshCache(max_bytes=int(2.5 * box_bytes))
+    for i in range(3):
+        cache.get(i, mesh_gen)
+    assert len(cache) == 2 and 0 not in cache
+    assert cache.nbytes == 2 * box_bytes
+    cache = MeshCache(max_bytes=1000 * box_bytes)
+    for i in range(900):
+        cache.get(i, mesh_gen)
+    assert len(cache) == 900
+
+
+def test_mesh_tile_sdf():
+    box = trimesh.creation.box([0.4, 0.8, 0.6], trimesh.transformations.translation_matrix([0.5, 0.2, -0.3]))
+    tile = MeshTile(name="box", mesh=box, array=np.zeros((3, 3)))
+    variants = [tile.get_flipped_tile("y").get_rotated_tile(90)] + tile.get_all_tiles(rotations=(90, 180, 270))
+    SDF_CACHE.clear()
+    for variant in variants:
+        sdf = variant.get_sdf((2.0, 2.0, 2.0), 0.1)
+        expected = compute_sdf(variant.get_mesh(), (2.0, 2.0, 2.0), 0.1)
+        # compute_sdf moves the vertices randomly by up to 1e-4.
+        assert np.allclose(sdf, expected, atol=1e-3)
+    # Computed once for the root tile.
+    assert len(SDF_CACHE) == 1
@@ -2,12 +2,15 @@
 # Copyright (c) 2023, Takahiro Miki. All rights reserved.
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
+import os
 import numpy as np
 import torch
 import trimesh
 import time
+from dataclasses import dataclass
 
-from ..utils import sample_interpolated, sample_interpolated_bilinear
+from ..utils import utils as utils_module
+from ..utils import sample_interpolated, sample_interpolated_bilinear, get_cached_mesh_gen, cfg_to_hash, MeshStore
 
 
 def test_interpolated_sampling(visualize=True):
@@ -177,3 +180,136 @@ def test_interpolated_sampling_bilinear(visualize=False):
 
         plt.imshow(values.reshape(100, 100))
         plt.show()
+
+
+def test_cached_mesh_gen(tmp_path, monkeypatch):
+    @dataclass
+    class BoxCfg:
+        name: str = "box"
+        size: tuple = (1.0, 2.0, 3.0)
+
+    n_calls = [0]
+
+    def mesh_gen_fn(cfg):
+        n_calls[0] += 1
+        return trimesh.creation.box(cfg.size)
+
+    cfg = BoxCfg()
+    mesh = get_cached_mesh_gen(mesh_gen_fn, cfg, cache_dir=str(tmp_path))()
+    cached_mesh = get_cached_mesh_gen(mesh_gen_fn, cfg, cache_dir=str(tmp_path))()
+    assert n_calls[0] == 1
+    # Loaded without copy from the memory mapped file.
+    assert not cached_mesh.vertices.flags.owndata and not cached_mesh.vertices.flags.writeable
+    assert np.allclose(cached_mesh.vertices, mesh.vertices)
+    assert np.array_equal(cached_mesh.faces, mesh.faces)
+
+    # OBJ entries of the older cache, keyed by the MD5 hash of the config, are converted on load.
+    legacy_dir = tmp_path / "legacy"
+    os.makedirs(legacy_dir / "mesh_cache")
+    monkeypatch.setattr(utils_module, "LEGACY_CACHE_DIR", str(legacy_dir))
+    cfg = BoxCfg(size=(3.0, 2.0, 1.0))
+    obj_path = str(legacy_dir / "mesh_cache" / "box_eb15fdbc986f699f5e02e94397db5f64.obj")
+    trimesh.creation.box(cfg.size).export(obj_path)
+    mesh = get_cached_mesh_gen(mesh_gen_fn, cfg, cache_dir=str(tmp_path))()
+    assert n_calls[0] == 1
+    assert not os.path.exists(obj_path)
+    assert os.path.exists(os.path.join(str(tmp_path), "mesh_cache", f"box_{cfg_to_hash(cfg)}_vertices.npy"))
+    assert np.isclose(mesh.volume, 6.0)
+
+
+def test_mesh_store(tmp_path):
+    box = trimesh.creation.box((1.0, 1.0, 1.0))
+    entry_bytes = box.vertices.astype(np.float64).nbytes + box.faces.astype(np.int64).nbytes
+    # Header of the npy files.
+    entry_bytes += 2 * 128
+    store = MeshStore(str(tmp_path), max_bytes=int(2.5 * entry_bytes))
+
+    assert store.get("a") is None
+    mesh = store.get_or_create("a", lambda: box)
+    assert np.allclose(store.get("a").vertices, mesh.vertices)
+    # Only complete entries are visible, no temporary files are left.
+    assert sorted(os.listdir(str(tmp_path))) == ["a.lock", "a_faces.npy", "a_vertices.npy"]
+
+    # Make "b" older than "a", then add "c" to go over the size cap.
+    store.put("b", box)
+    os.utime(os.path.join(str(tmp_path), "b_vertices.npy"), (0, 0))
+    store.get("a")
+    store.put("c", box)
+    assert "a" in store and "b" not in store and "c" in store
+    # The lock file of an evicted entry is removed with it.
+    assert not os.path.exists(os.path.join(str(tmp_path), "b.lock"))
+
+    stats = store.get_stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+    assert stats["evictions"] == 1
+    assert stats["n_entries"] == 2
+    assert stats["size_bytes"] <= store.max_bytes
+    assert stats["bytes_written"] == 3 * (entry_bytes - 2 * 128)
+
+    store.clear()
+    assert os.listdir(str(tmp_path)) == []
+
+    # The directory is scanned on the first write, and then only when the size goes over the cap.
+    store = MeshStore(str(tmp_path), max_bytes=int(4.5 * entry_bytes))
+    n_scans = 0
+    list_entries = store._list_entries
+
+    def count_scans():
+        nonlocal n_scans
+        n_scans += 1
+        return list_entries()
+
+    store._list_entries = count_scans
+    for key in "abcd":
+        store.put(key, box)
+    assert n_scans == 1
+    store.put("e", box)
+    assert n_scans == 2
+    assert store.get_stats()["n_entries"] == 4
+
+
+def test_cfg_to_hash():
+    @dataclass
+    class HeightCfg:
+        name: str = "height"
+        weight: float = 1.0
+        height_map: np.ndarray = np.zeros((2, 2))
+        dim: tuple = (2.0, 2.0, 2.0)
+
+    cfg = HeightCfg(height_map=np.arange(4.0).reshape(2, 2))
+    code = cfg_to_hash(cfg)
+    # Stable across runs.
+    assert code == cfg_to_hash(HeightCfg(height_map=np.arange(4.0).reshape(2, 2)))
+    assert code == "e7bba34ffdc158679040c2288b4ccc86"
+    # Excluded keys are not hashed.
+    assert code == cfg_to_hash(HeightCfg(weight=0.5, height_map=np.arange(4.0).reshape(2, 2)))
+    assert code != cfg_to_hash(cfg, exclude_keys=[])
+    # dtype and shape are part of the hash.
+    assert code != cfg_to_hash(HeightCfg(height_map=np.arange(4.0).reshape(4, 1)))
+    assert code != cfg_to_hash(HeightCfg(height_map=np.arange(4.0, dtype=np.float32).reshape(2, 2)))
+
+    # The memoized hash is recomputed when a field is assigned.
+    cfg.dim = (1.0, 2.0, 2.0)
+    assert code != cfg_to_hash(cfg)
+    cfg.dim = (2.0, 2.0, 2.0)
+    assert code == cfg_to_hash(cfg)
+    cfg.height_map = np.ones((2, 2))
+    assert code != cfg_to_hash(cfg)
+
+    # In-place modifications of writeable arrays change the hash.
+    code = cfg_to_hash(cfg)
+    cfg.height_map[0, 0] = 2.0
+    assert code != cfg_to_hash(cfg)
+    cfg.height_map[0, 0] = 1.0
+    assert code == cfg_to_hash(cfg)
+    # A read-only view of a writeable array is not memoized either.
+    cfg.height_map = cfg.height_map.view()
+    cfg.height_map.flags.writeable = False
+    code = cfg_to_hash(cfg)
+    cfg.height_map.base[0, 0] = 2.0
+    assert code != cfg_to_hash(cfg)
+
+    # Order of dict keys does not matter.
+    assert cfg_to_hash({"a": 1, ("b", 1): [2.0]}) == cfg_to_hash({("b", 1): [2.0], "a": 1})
+    assert cfg_to_hash({"a": 1}) != cfg_to_hash({"a": "1"})
@@ -2,7 +2,22 @@
 # Copyright (c) 2023, Takahiro Miki. All rights reserved.
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
-from ..wfc.wfc import WFCCore, ConnectionManager
+import json
+import random
+
+import numpy as np
+import pytest
+
+from ..wfc.tiles import ArrayTile
+from ..wfc.wfc import (
+    WFCCore,
+    WFCSolver,
+    BatchedWFCCore,
+    ChunkedWFCSolver,
+    ConnectionManager,
+    CompiledConnections,
+    SolverStats,
+)
 
 
 def test_get_neighbours():
@@ -159,3 +174,331 @@ def test_connections():
     #
     # # Show the plot
     # plt.show()
+
+
+def test_compiled_connections(tmp_path):
+    cm = ConnectionManager(load_from_cache=False)
+    cm.register_tile("tile_1", {"up": (0, 1, 2), "down": (1, 1, 1), "left": (2, 2, 2), "right": (3, 3, 3)})
+    cm.register_tile("tile_2", {"up": (0, 1, 2), "down": (1, 1, 1), "left": (3, 3, 3), "right": (2, 2, 2)})
+    cm.register_tile("tile_3", {"up": (1, 1, 1), "down": (2, 1, 0), "left": (2, 2, 2), "right": (3, 3, 3)})
+    cm.register_tile("tile_4", {"up": (1, 1, 1), "down": (2, 1, 0), "left": (3, 3, 3), "right": (2, 2, 2)})
+
+    compiled = cm.get_compiled_connections()
+    assert compiled.compatibility.shape == (4, 4, 4)
+    d = compiled.to_dict()
+    assert d == cm.get_connection_dict()
+    assert d[0] == {(-1, 0): (2, 3), (0, -1): (1, 3), (1, 0): (2, 3), (0, 1): (1, 3)}
+    assert np.array_equal(CompiledConnections.from_dict(d, 4).compatibility, compiled.compatibility)
+
+    filename = str(tmp_path / "connections.npz")
+    compiled.save(filename)
+    loaded = CompiledConnections.load(filename)
+    assert loaded.directions == compiled.directions
+    assert np.array_equal(loaded.compatibility, compiled.compatibility)
+
+    # The solvers consume the compiled form directly.
+    wfc = WFCCore(4, compiled, [10, 10])
+    wfc.init_randomly()
+    wave = wfc.solve()
+    for idx in np.ndindex(10, 10):
+        neighbours, directions = wfc._get_neighbours(np.array(idx))
+        for neighbour, direction in zip(neighbours, directions):
+            assert wave[tuple(neighbour)] in d[wave[idx]][tuple(direction)]
+
+
+def test_connection_index():
+    # The edge type index must give the same connections as comparing every pair of edges.
+    rng = np.random.default_rng(0)
+    cm = ConnectionManager(load_from_cache=False)
+    edges = {}
+    for i in range(50):
+        edges[i] = {k: tuple(rng.integers(0, 2, 3).tolist()) for k in ["up", "down", "left", "right"]}
+        cm.register_tile(f"tile_{i}", edges[i])
+    compiled = cm._compile_connections()
+    for d, direction in enumerate(compiled.directions):
+        name = cm.edge_def.to_str(direction)
+        opposite = cm.edge_def.to_str(tuple(-x for x in direction))
+        for i in range(50):
+            for j in range(50):
+                assert compiled.compatibility[d, i, j] == (edges[i][name] == edges[j][opposite][::-1])
+
+
+def test_propagation():
+    # Tile 0 only connects to tile 0 and tile 2 only connects to tile 2. Tile 1 connects to everything.
+    directions = [(-1, 0), (0, -1), (1, 0), (0, 1)]
+    connections = {
+        0: {d: (0, 1) for d in directions},
+        1: {d: (0, 1, 2) for d in directions},
+        2: {d: (1, 2) for d in directions},
+    }
+    wfc = WFCCore(3, connections, (5, 5))
+    wfc.init((0, 0), 0)
+    wfc.init((4, 4), 1)
+    wfc.init((0, 4), 0)
+
+    # After propagation, the domain of each cell must be supported by all of its neighbours.
+    valid = wfc.wave.valid
+    assert valid[:, 0, 0].tolist() == [True, False, False]
+    assert not valid[2, 0, 1] and not valid[2, 1, 0]
+    for idx in np.ndindex(5, 5):
+        neighbours, directions = wfc._get_neighbours(np.array(idx))
+        for neighbour, direction in zip(neighbours, directions):
+            for tile_id in np.flatnonzero(valid[(slice(None),) + idx]):
+                possible_tiles = np.array(connections[tile_id][tuple(direction)])
+                assert valid[(possible_tiles,) + tuple(neighbour)].any()
+
+    wave = wfc.solve()
+    for idx in np.ndindex(5, 5):
+        neighbours, directions = wfc._get_neighbours(np.array(idx))
+        for neighbour, direction in zip(neighbours, directions):
+            assert wave[tuple(neighbour)] in connections[wave[idx]][tuple(direction)]
+
+
+def test_collapsed_contradiction():
+    # The connections are not symmetric, so propagation from a new tile can empty the domain of a collapsed cell.
+    connections = {
+        0: {(-1, 0): (0, 1), (0, -1): (0), (1, 0): (0, 1), (0, 1): (0, 1)},  # Mountain
+        1: {(-1, 0): (0, 1, 2), (0, -1): (0, 1), (1, 0): (0, 1, 2), (0, 1): (0, 1, 2)},  # Sand
+        2: {(-1, 0): (1, 2), (0, -1): (2), (1, 0): (2), (0, 1): (2)},  # Water
+    }
+    for seed in range(5):
+        np.random.seed(seed)
+        random.seed(seed)
+        wfc = WFCCore(3, connections, (8, 8))
+        wfc.init((3, 4), 1)
+        wave = wfc.solve()
+        assert np.all(wfc.wave.get_entropy() == 1)
+        for idx in np.ndindex(8, 8):
+            neighbours, directions = wfc._get_neighbours(np.array(idx))
+            for neighbour, direction in zip(neighbours, directions):
+                assert wave[tuple(neighbour)] in np.atleast_1d(connections[wave[idx]][tuple(direction)])
+
+    # Initial tiles which cannot be connected are rejected.
+    wfc = WFCCore(3, connections, (8, 8))
+    wfc.init((3, 4), 0)
+    with pytest.raises(ValueError):
+        wfc.init((3, 5), 2)
+
+
+def test_entropy_queue():
+    connections = {
+        0: {(-1, 0): (0, 1), (0, -1): (0), (1, 0): (0, 1), (0, 1): (0, 1)},  # Mountain
+        1: {(-1, 0): (0, 1, 2), (0, -1): (0, 1), (1, 0): (0, 1, 2), (0, 1): (0, 1, 2)},  # Sand
+        2: {(-1, 0): (1, 2), (0, -1): (2), (1, 0): (2), (0, 1): (2)},  # Water
+    }
+    wfc = WFCCore(3, connections, (8, 8))
+    wfc.init((3, 3), 2)
+    for _ in range(10):
+        # Incremental entropy must match the domains and the queue must return a cell with the lowest entropy.
+        entropy = wfc.wave.valid.sum(axis=0)
+        assert np.all(wfc.wave.get_entropy() == entropy)
+        cell = wfc.collapse()
+        idx = np.unravel_index(cell, (8, 8))
+        assert not wfc.wave.is_collapsed[idx]
+        assert entropy[idx] == entropy[~wfc.wave.is_collapsed].min()
+        wfc.observe(np.array(idx))
+
+
+def test_trail_backtracking():
+    connections = {
+        0: {(-1, 0): (0, 1), (0, -1): (0), (1, 0): (0, 1), (0, 1): (0, 1)},  # Mountain
+        1: {(-1, 0): (0, 1, 2), (0, -1): (0, 1), (1, 0): (0, 1, 2), (0, 1): (0, 1, 2)},  # Sand
+        2: {(-1, 0): (1, 2), (0, -1): (2), (1, 0): (2), (0, 1): (2)},  # Water
+    }
+    wfc = WFCCore(3, connections, (10, 10), backtracking="trail")
+    wfc.init((5, 5), 1)
+    snapshot = wfc.wave.copy()
+    wfc.update_history()
+    assert wfc.history == [len(wfc.trail)]
+    for _ in range(20):
+        wfc.observe(np.array(np.unravel_index(wfc.collapse(), (10, 10))))
+    assert wfc.wave.n_collapsed == 21
+
+    # Rewinding must restore the exact state at the history entry.
+    wfc._restore_history(0)
+    assert np.array_equal(wfc.wave.domains, snapshot.domains)
+    assert np.array_equal(wfc.wave.entropy, snapshot.entropy)
+    assert np.array_equal(wfc.wave.wave, snapshot.wave)
+    assert np.array_equal(wfc.wave.wave_order, snapshot.wave_order)
+    assert np.array_equal(wfc.wave.is_collapsed, snapshot.is_collapsed)
+    assert wfc.wave.n_collapsed == snapshot.n_collapsed
+
+    wfc = WFCCore(3, connections, (20, 20), backtracking="trail")
+    wfc.init_randomly()
+    wave = wfc.solve()
+    assert wfc.wave.is_collapsed.all()
+    assert all(isinstance(h, int) for h in wfc.history)
+
+
+def test_batched_wfc():
+    connections = {
+        0: {(-1, 0): (0, 1), (0, -1): (0), (1, 0): (0, 1), (0, 1): (0, 1)},  # Mountain
+        1: {(-1, 0): (0, 1, 2), (0, -1): (0, 1), (1, 0): (0, 1, 2), (0, 1): (0, 1, 2)},  # Sand
+        2: {(-1, 0): (1, 2), (0, -1): (2), (1, 0): (2), (0, 1): (2)},  # Water
+    }
+    wfc = WFCCore(3, connections, (10, 10))
+    for use_torch in [False, True]:
+        batched_wfc = BatchedWFCCore(3, connections, (10, 10), 4, seeds=[0, 1, 2, 3], use_torch=use_torch)
+        batched_wfc.init((0, 0), 2)
+        waves = batched_wfc.solve()
+        assert waves.shape == (4, 10, 10)
+        assert batched_wfc.is_collapsed.all()
+        assert np.all(waves[:, 0, 0] == 2)
+        for wave in waves:
+            for idx in np.ndindex(10, 10):
+                neighbours, directions = wfc._get_neighbours(np.array(idx))
+                for neighbour, direction in zip(neighbours, directions):
+                    assert wave[tuple(neighbour)] in np.atleast_1d(connections[wave[idx]][tuple(direction)])
+
+    # Same seeds give the same waves.
+    batched_wfc = BatchedWFCCore(3, connections, (10, 10), 4, seeds=[0, 1, 2, 3])
+    batched_wfc.init((0, 0), 2)
+    assert np.array_equal(batched_wfc.solve(), waves)
+
+    # A wave only depends on its own seed.
+    batched_wfc = BatchedWFCCore(3, connections, (10, 10), 1, seeds=[2])
+    batched_wfc.init_randomly()
+    wave = batched_wfc.solve()[0]
+    for seeds, i in [([2, 3], 0), ([3, 2], 1), ([0, 1, 2], 2)]:
+        batched_wfc = BatchedWFCCore(3, connections, (10, 10), len(seeds), seeds=seeds)
+        batched_wfc.init_randomly()
+        assert np.array_equal(batched_wfc.solve()[i], wave)
+
+    # Backtracking restarts only the failed waves from the initial tiles.
+    batched_wfc = BatchedWFCCore(3, connections, (10, 10), 2, seeds=[0, 1], max_backtracking=1)
+    batched_wfc.init((0, 0), 2)
+    waves = batched_wfc.solve()
+    batched_wfc._back_track(np.array([1]))
+    assert np.array_equal(batched_wfc.wave[0].reshape(10, 10), waves[0])
+    assert batched_wfc.n_collapsed.tolist() == [100, 1]
+    assert batched_wfc.is_collapsed[1].reshape(10, 10)[0, 0] and batched_wfc.wave[1, 0] == 2
+    assert batched_wfc.back_track_cnt.tolist() == [0, 1]
+    with pytest.raises(ValueError):
+        batched_wfc._back_track(np.array([1]))
+
+
+def register_test_tiles(solver):
+    solver.register_tile("tile_1", {"up": (0, 1, 2), "down": (1, 1, 1), "left": (2, 2, 2), "right": (3, 3, 3)})
+    solver.register_tile("tile_2", {"up": (0, 1, 2), "down": (1, 1, 1), "left": (3, 3, 3), "right": (2, 2, 2)})
+    solver.register_tile("tile_3", {"up": (1, 1, 1), "down": (2, 1, 0), "left": (2, 2, 2), "right": (3, 3, 3)})
+    solver.register_tile("tile_4", {"up": (1, 1, 1), "down": (2, 1, 0), "left": (3, 3, 3), "right": (2, 2, 2)})
+    solver.register_tile("tile_5", {"up": (1, 1, 1), "down": (1, 1, 1), "left": (2, 2, 2), "right": (2, 2, 2)})
+
+
+def assert_connected(region, compiled):
+    for d, direction in enumerate(compiled.directions):
+        for idx in np.ndindex(region.shape):
+            neighbour = np.array(idx) + direction
+            if np.all(neighbour >= 0) and np.all(neighbour < region.shape):
+                assert compiled.compatibility[d, region[idx], region[tuple(neighbour)]]
+
+
+def test_chunked_wfc():
+    def create_solver():
+        solver = ChunkedWFCSolver((6, 6), 2, seed=3)
+        register_test_tiles(solver)
+        return solver
+
+    solver = create_solver()
+    region = solver.get_region((-6, -6), (18, 18))
+    assert len(solver.chunks) == 9
+    compiled = solver.cm.get_compiled_connections()
+    assert_connected(region, compiled)
+    assert np.array_equal(region[6:12, 6:12], solver.get_chunk((0, 0)))
+
+    # Regenerating a chunk keeps its neighbours and the seams.
+    chunk = solver.get_chunk((1, 1)).copy()
+    solver.regenerate_chunk((0, 0))
+    assert np.array_equal(solver.get_chunk((1, 1)), chunk)
+    assert_connected(solver.get_region((-6, -6), (18, 18)), compiled)
+
+    # A chunk which fails to regenerate is kept. Two tiles which do not connect are placed in the halo.
+    chunk = solver.get_chunk((0, 0)).copy()
+    d = compiled.directions.index((0, 1))
+    a, b = np.argwhere(~(compiled.compatibility[d] & compiled.compatibility[compiled.directions.index((0, -1))].T))[0]
+    solver.chunks[(1, 0)][0, :2] = [a, b]
+    with pytest.raises(ValueError):
+        solver.regenerate_chunk((0, 0))
+    assert np.array_equal(solver.get_chunk((0, 0)), chunk)
+
+    # The same generation order gives the same world.
+    assert np.array_equal(create_solver().get_region((-6, -6), (18, 18)), region)
+
+
+def test_parallel_wfc():
+    solver = WFCSolver((24, 24), 2)
+    register_test_tiles(solver)
+    wave = solver.run_parallel((8, 8), n_workers=2, seed=1)
+    assert wave.shape == (24, 24)
+    assert_connected(wave, solver.cm.get_compiled_connections())
+
+    # Same result as solving the checkerboard in this process.
+    serial_solver = ChunkedWFCSolver((8, 8), 2, seed=1)
+    register_test_tiles(serial_solver)
+    assert np.array_equal(serial_solver.generate_parallel((0, 0), (24, 24), n_workers=1), wave)
+
+    # Random edges over constrain some chunks of the second color, which are repaired with a margin.
+    rng = np.random.default_rng(0)
+    solver = ChunkedWFCSolver((8, 8), 2, seed=0)
+    for i in range(40):
+        edges = {k: tuple(rng.integers(0, 2, 2).tolist()) for k in ["up", "down", "left", "right"]}
+        solver.register_tile(f"tile_{i}", edges)
+    wave = solver.generate_parallel((0, 0), (32, 32), n_workers=1)
+    assert_connected(wave, solver.cm.get_compiled_connections())
+
+
+def test_3d_solver():
+    # Voxel tiles. Touching faces of neighbouring tiles must be the same.
+    floor = np.zeros((2, 2, 2))
+    floor[:, :, 0] = 1
+    wall = floor.copy()
+    wall[0, :, :] = 1
+    wall_top = np.zeros((2, 2, 2))
+    wall_top[0, :, :] = 1
+    tiles = [ArrayTile("empty", np.zeros((2, 2, 2)), dimension=3), ArrayTile("floor", floor, dimension=3)]
+    tiles += ArrayTile("wall", wall, dimension=3).get_all_tiles(rotations=(90, 180, 270))
+    tiles += ArrayTile("wall_top", wall_top, dimension=3).get_all_tiles(rotations=(90, 180, 270))
+
+    solver = WFCSolver((4, 4, 3), 3, seed=0)
+    for tile in tiles:
+        solver.register_tile(*tile.get_dict_tile())
+    wave = solver.run(init_tiles=[("floor", (0, 0, 0))])
+    assert wave.shape == (4, 4, 3)
+    assert solver.wfc.wave.is_collapsed.all()
+
+    arrays = {tile.name: tile.array for tile in tiles}
+    voxels = np.block(
+        [[[arrays[solver.names[wave[x, y, z]]] for z in range(3)] for y in range(4)] for x in range(4)]
+    )
+    for axis in range(3):
+        for i in range(1, wave.shape[axis]):
+            # Faces on both sides of the boundary between cell i - 1 and cell i.
+            assert np.array_equal(np.take(voxels, 2 * i - 1, axis=axis), np.take(voxels, 2 * i, axis=axis))
+
+
+def test_solver_stats(tmp_path):
+    connections = {
+        0: {(-1, 0): (0, 1), (0, -1): (0), (1, 0): (0, 1), (0, 1): (0, 1)},  # Mountain
+        1: {(-1, 0): (0, 1, 2), (0, -1): (0, 1), (1, 0): (0, 1, 2), (0, 1): (0, 1, 2)},  # Sand
+        2: {(-1, 0): (1, 2), (0, -1): (2), (1, 0): (2), (0, 1): (2)},  # Water
+    }
+    for backtracking in ["snapshot", "trail"]:
+        stats = SolverStats(trace=True)
+        wfc = WFCCore(3, connections, (20, 20), backtracking=backtracking, stats=stats)
+        wfc.init_randomly()
+        wfc.solve()
+        d = stats.to_dict()
+        assert d["observations"] > 0
+        assert d["propagation_steps"] >= d["observations"]
+        assert d["eliminations"] > 0
+        assert d["backtracks"] == sum(d["backtrack_depths"].values())
+        assert 0 < d["peak_history_bytes"]
+        for name in ["solve", "select", "observe", "propagate"]:
+            assert d["times"][name] > 0
+        assert d["times"]["solve"] >= d["times"]["select"] + d["times"]["observe"]
+
+        stats.save_json(str(tmp_path / "stats.json"))
+        stats.save_chrome_trace(str(tmp_path / "trace.json"))
+        with open(tmp_path / "trace.json") as f:
+            trace = json.load(f)
+        assert len(trace["traceEvents"]) == len(stats.trace_events) > 0
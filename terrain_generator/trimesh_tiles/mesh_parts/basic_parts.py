@@ -18,6 +18,8 @@ from ...utils import (
     convert_heightfield_to_trimesh,
     merge_two_height_meshes,
     get_height_array_of_mesh,
+    create_boxes_mesh,
+    create_greedy_boxes_mesh,
     ENGINE,
 )
 
@@ -189,8 +191,9 @@ def create_platform_mesh(cfg: PlatformMeshPartsCfg, **kwargs):
     meshes = []
     min_h = 0.0
     if cfg.add_floor:
-        meshes.append(create_floor(cfg))
         min_h = cfg.floor_thickness
+        if not cfg.greedy_meshing:
+            meshes.append(create_floor(cfg))
 
     arrays = [cfg.array]
     z_dim_arrays = [cfg.z_dim_array]
@@ -201,32 +204,45 @@ def create_platform_mesh(cfg: PlatformMeshPartsCfg, **kwargs):
     if cfg.z_dim_arrays is not None:
         z_dim_arrays += cfg.z_dim_arrays
 
+    centers = []
+    extents = []
     for array, z_dim_array in zip(arrays, z_dim_arrays):
         dim_xy = [cfg.dim[0] / array.shape[0], cfg.dim[1] / array.shape[1]]
-        for y in range(array.shape[1]):
-            for x in range(array.shape[0]):
-                if array[y, x] > min_h:
-                    h = array[y, x]
-                    dim = [dim_xy[0], dim_xy[1], h]
-                    if cfg.use_z_dim_array:
-                        z = z_dim_array[y, x]
-                        if z > 0.0 and z < h:
-                            dim = np.array([dim_xy[0], dim_xy[1], z_dim_array[y, x]])
-                    pos = np.array(
-                        [
-                            x * dim[0] - cfg.dim[0] / 2.0 + dim[0] / 2.0,
-                            -y * dim[1] + cfg.dim[1] / 2.0 - dim[1] / 2.0,
-                            h - dim[2] / 2.0 - cfg.dim[2] / 2.0,
-                        ]
-                    )
-                    box_mesh = trimesh.creation.box(dim, trimesh.transformations.translation_matrix(pos))
-                    meshes.append(box_mesh)
+        y, x = np.nonzero(array > min_h)
+        h = array[y, x].astype(np.float64)
+        z_dim = h.copy()
+        if cfg.use_z_dim_array:
+            z = z_dim_array[y, x]
+            use_z = (z > 0.0) & (z < h)
+            z_dim[use_z] = z[use_z]
+        pos = np.stack(
+            [
+                x * dim_xy[0] - cfg.dim[0] / 2.0 + dim_xy[0] / 2.0,
+                -y * dim_xy[1] + cfg.dim[1] / 2.0 - dim_xy[1] / 2.0,
+                h - z_dim / 2.0 - cfg.dim[2] / 2.0,
+            ],
+            axis=-1,
+        )
+        centers.append(pos)
+        extents.append(np.stack([np.full_like(h, dim_xy[0]), np.full_like(h, dim_xy[1]), z_dim], axis=-1))
+    if cfg.greedy_meshing:
+        if cfg.add_floor:
+            floor_z = -cfg.dim[2] / 2.0 + cfg.floor_thickness / 2.0 + cfg.height_offset
+            centers.append(np.array([[0.0, 0.0, floor_z]]))
+            extents.append(np.array([[cfg.dim[0], cfg.dim[1], cfg.floor_thickness]]))
+        meshes.append(create_greedy_boxes_mesh(np.concatenate(extents), np.concatenate(centers)))
+    elif cfg.minimal_triangles:
+        # Each box is a separate body for the boolean union.
+        boxes = create_boxes_mesh(np.concatenate(extents), np.concatenate(centers))
+        meshes += boxes.split(only_watertight=False)
+    else:
+        meshes.append(create_boxes_mesh(np.concatenate(extents), np.concatenate(centers), cull_shared_faces=True))
     if cfg.wall is not None:
         wall_mesh = create_wall_mesh(cfg.wall)
         meshes.append(wall_mesh)
         # mesh = merge_meshes([mesh, wall_mesh], False)
         # mesh.fill_holes()
-    mesh = merge_meshes(meshes, cfg.minimal_triangles)
+    mesh = merge_meshes(meshes, cfg.minimal_triangles and not cfg.greedy_meshing)
     mesh.fill_holes()
     return mesh
 
@@ -291,15 +307,14 @@ def create_box_mesh(cfg: BoxMeshPartsCfg, **kwargs):
     else:
         print("not create floor")
         meshes = []
-    for i in range(len(cfg.box_dims)):
-        t = cfg.transformations[i].copy()
-        t[2, 3] -= cfg.dim[2] / 2.0
-        box = trimesh.creation.box(
-            cfg.box_dims[i],
-            t,
-        )
-        # box.apply_transform(t)
-        meshes.append(box)
+    if len(cfg.box_dims) > 0:
+        transforms = np.array(cfg.transformations, dtype=np.float64)
+        transforms[:, 2, 3] -= cfg.dim[2] / 2.0
+        boxes = create_boxes_mesh(cfg.box_dims, transforms=transforms)
+        if cfg.minimal_triangles:
+            meshes += boxes.split(only_watertight=False)
+        else:
+            meshes.append(boxes)
     mesh = merge_meshes(meshes, cfg.minimal_triangles)
     return mesh
 
@@ -2,8 +2,11 @@
 # Copyright (c) 2023, Takahiro Miki. All rights reserved.
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
+import os
+import dataclasses
 import numpy as np
-from typing import Tuple, Callable
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Tuple, Callable, Dict, List, Optional, Union
 import trimesh
 import functools
 
@@ -32,10 +35,13 @@ from .mesh_parts_cfg import (
     FloatingBoxesPartsCfg,
 )
 from ...wfc.tiles import MeshTile
-from ...utils import get_height_array_of_mesh, get_cached_mesh_gen, merge_meshes
+from ...utils import get_height_array_of_mesh, get_cached_mesh_gen, merge_meshes, cfg_to_hash
 
 # from alive_progress import alive_it
 
+# Fields of MeshPartsCfg which do not change the mesh or the edges of a tile.
+NON_GEOMETRY_KEYS = ["name", "weight", "rotations", "flips", "load_from_cache", "use_generator"]
+
 
 def get_mesh_gen(cfg: MeshPartsCfg) -> Callable:
     if isinstance(cfg, WallPartsCfg):
@@ -87,24 +93,171 @@ def create_mesh_tile(cfg: MeshPartsCfg) -> MeshTile:
         return MeshTile(name, mesh, array=cfg.edge_array, mesh_dim=cfg.dim, weight=cfg.weight)
 
 
-def create_mesh_pattern(cfg: MeshPattern) -> dict:
-    import ray
+def create_mesh_tile_arrays(cfg: MeshPartsCfg) -> Tuple[Optional[np.ndarray], Optional[np.ndarray], np.ndarray]:
+    """Create the mesh of a tile and write it to the mesh cache. Runs in the workers of create_mesh_pattern, which
+    only send back arrays, and the tile is built with create_mesh_tile_from_arrays.
+    Args:
+        cfg: Config of the tile.
+    Returns:
+        vertices, faces: (np.ndarray) of the mesh, or None if the tile loads it from the cache (cfg.use_generator).
+        edge_array: (np.ndarray) to define the edges of the tile.
+    """
+    mesh = get_cached_mesh_gen(get_mesh_gen(cfg), cfg, verbose=False, use_cache=cfg.load_from_cache)()
+    edge_array = cfg.edge_array
+    if edge_array is None:
+        edge_array = get_height_array_of_mesh(mesh, cfg.dim, 5)
+    if cfg.use_generator:
+        return None, None, edge_array
+    return np.array(mesh.vertices), np.array(mesh.faces), edge_array
+
+
+def create_mesh_tile_from_arrays(
+    cfg: MeshPartsCfg,
+    vertices: Optional[np.ndarray],
+    faces: Optional[np.ndarray],
+    edge_array: np.ndarray,
+    mesh_cfg: Optional[MeshPartsCfg] = None,
+) -> MeshTile:
+    """Build the tile from the output of create_mesh_tile_arrays.
+    Args:
+        cfg: Config of the tile.
+        vertices, faces, edge_array: Output of create_mesh_tile_arrays.
+        mesh_cfg: Config the mesh was created from, if it is not cfg. (See get_geometry_hash)
+    """
+    mesh_cfg = cfg if mesh_cfg is None else mesh_cfg
+    if cfg.use_generator or vertices is None:
+        # The cache entry was just written by create_mesh_tile_arrays.
+        mesh = get_cached_mesh_gen(get_mesh_gen(mesh_cfg), mesh_cfg, verbose=False, use_cache=True)
+        if not cfg.use_generator:
+            mesh = mesh()
+    else:
+        mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+    return MeshTile(cfg.name, mesh, array=edge_array, mesh_dim=cfg.dim, weight=cfg.weight)
+
+
+def get_geometry_hash(cfg: MeshPartsCfg) -> str:
+    """Hash of the fields of a config which define its mesh and edges. Configs with the same hash only differ in the
+    name, weight, variants or caching of the tile, and share one mesh."""
+    return cfg_to_hash(cfg, exclude_keys=NON_GEOMETRY_KEYS)
+
 
-    ray.init(ignore_reinit_error=True)
-    create_mesh_tile_remote = ray.remote(create_mesh_tile)
+def group_mesh_parts(mesh_parts: List[MeshPartsCfg]) -> List[Tuple[MeshPartsCfg, List[MeshPartsCfg]]]:
+    """Group configs by get_geometry_hash.
+    Returns:
+        list of (config to create the mesh from, configs of the tiles) for each group.
+    """
+    groups = {}
+    for mesh_cfg in mesh_parts:
+        groups.setdefault(get_geometry_hash(mesh_cfg), []).append(mesh_cfg)
+    mesh_cfgs = []
+    for group in groups.values():
+        # Regenerated if any tile does not load from cache, and returned as arrays if any tile needs the mesh.
+        mesh_cfg = dataclasses.replace(
+            group[0],
+            load_from_cache=all(c.load_from_cache for c in group),
+            use_generator=all(c.use_generator for c in group),
+        )
+        mesh_cfgs.append((mesh_cfg, group))
+    return mesh_cfgs
+
+
+def create_mesh_pattern(
+    cfg: MeshPattern, executor: Union[str, Executor] = "process", n_workers: Optional[int] = None
+) -> dict:
+    """Create the tiles of a pattern, including their rotations and flips.
+    Args:
+        cfg: Pattern config.
+        executor: "serial", "process" for a local process pool, "ray", or a concurrent.futures.Executor.
+        n_workers: Number of processes of the process pool. Defaults to the number of cpus.
+    Returns:
+        dict of the tiles by name.
+    """
+    groups = group_mesh_parts(cfg.mesh_parts)
+    mesh_parts = [mesh_cfg for mesh_cfg, _ in groups]
+    print(f"Creating mesh pattern of {len(mesh_parts)} unique meshes for {len(cfg.mesh_parts)} parts... ")
+    if isinstance(executor, Executor):
+        outputs = list(executor.map(create_mesh_tile_arrays, mesh_parts))
+    elif executor == "process":
+        n_workers = min(n_workers or os.cpu_count() or 1, len(mesh_parts))
+        if n_workers <= 1:
+            outputs = [create_mesh_tile_arrays(mesh_cfg) for mesh_cfg in mesh_parts]
+        else:
+            with ProcessPoolExecutor(n_workers) as pool:
+                outputs = list(pool.map(create_mesh_tile_arrays, mesh_parts))
+    elif executor == "serial":
+        outputs = [create_mesh_tile_arrays(mesh_cfg) for mesh_cfg in mesh_parts]
+    elif executor == "ray":
+        import ray
+
+        ray.init(ignore_reinit_error=True)
+        create_mesh_tile_arrays_remote = ray.remote(create_mesh_tile_arrays)
+        print("Waiting for parallel creation... ")
+        outputs = ray.get([create_mesh_tile_arrays_remote.remote(mesh_cfg) for mesh_cfg in mesh_parts])
+    else:
+        raise ValueError(f"Executor {executor} is not supported.")
 
-    tiles = []
-    print("Creating mesh pattern... ")
-    for mesh_cfg in cfg.mesh_parts:
-        tiles.append(create_mesh_tile_remote.remote(mesh_cfg))
-    print("Waiting for parallel creation... ")
-    tiles = ray.get(tiles)
     all_tiles = []
-    for i, tile in enumerate(tiles):
-        mesh_cfg = cfg.mesh_parts[i]
-        all_tiles += tile.get_all_tiles(rotations=mesh_cfg.rotations, flips=mesh_cfg.flips)
-        # tile = create_mesh_tile(mesh_cfg)
-        # if tile is not None:
-        #     tiles += tile.get_all_tiles(rotations=mesh_cfg.rotations, flips=mesh_cfg.flips)
+    for (mesh_cfg, group), output in zip(groups, outputs):
+        for tile_cfg in group:
+            tile = create_mesh_tile_from_arrays(tile_cfg, *output, mesh_cfg=mesh_cfg)
+            all_tiles += tile.get_all_tiles(rotations=tile_cfg.rotations, flips=tile_cfg.flips)
     tile_dict = {tile.name: tile for tile in all_tiles}
     return tile_dict
+
+
+def create_mesh_from_wave(
+    wave: np.ndarray,
+    names: List[str],
+    tiles: Dict[str, MeshTile],
+    tile_dim: Tuple[float, ...],
+    instanced: bool = False,
+) -> Union[trimesh.Trimesh, Tuple[Dict[str, trimesh.Trimesh], Dict[str, np.ndarray]]]:
+    """Compose the mesh of a solved wave in one step.
+    The tile at wave[y, x] is translated by (x * tile_dim[0], -y * tile_dim[1], 0). The vertex and face buffers are
+    allocated once from the counts of the tiles and filled for all cells of the same tile at once.
+    Args:
+        wave: (np.ndarray) of tile ids with shape (H, W).
+        names: name of each tile id.
+        tiles: dict of tiles. key: name, value: MeshTile
+        tile_dim: dimension of a tile.
+        instanced: return the unique meshes and their transforms instead of the merged mesh.
+    Returns:
+        merged mesh, or if instanced, (meshes, transforms) where meshes is a dict of the mesh of each used tile and
+        transforms is a dict of (N, 4, 4) transforms of the placements of each tile. The meshes are shared with the
+        tile cache, see MeshTile.get_shared_mesh.
+    """
+    if wave.ndim != 2:
+        raise ValueError(f"Wave must be 2D, got shape {wave.shape}.")
+    tile_ids, inverse = np.unique(wave, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    y, x = np.indices(wave.shape).reshape(2, -1)
+    offsets = np.stack([x * tile_dim[0], -y * tile_dim[1], np.zeros(len(x))], axis=1)
+    meshes = {names[tile_id]: tiles[names[tile_id]].get_shared_mesh() for tile_id in tile_ids}
+
+    if instanced:
+        transforms = {}
+        for i, tile_id in enumerate(tile_ids):
+            cell_offsets = offsets[inverse == i]
+            transform = np.tile(np.eye(4), (len(cell_offsets), 1, 1))
+            transform[:, :3, 3] = cell_offsets
+            transforms[names[tile_id]] = transform
+        return meshes, transforms
+
+    counts = np.bincount(inverse, minlength=len(tile_ids))
+    n_vertices = np.array([len(meshes[names[tile_id]].vertices) for tile_id in tile_ids])
+    n_faces = np.array([len(meshes[names[tile_id]].faces) for tile_id in tile_ids])
+    vertices = np.empty((np.sum(counts * n_vertices), 3))
+    faces = np.empty((np.sum(counts * n_faces), 3), dtype=np.int64)
+    vertex_start = 0
+    face_start = 0
+    for i, tile_id in enumerate(tile_ids):
+        mesh = meshes[names[tile_id]]
+        cell_offsets = offsets[inverse == i]
+        vertex_end = vertex_start + counts[i] * n_vertices[i]
+        face_end = face_start + counts[i] * n_faces[i]
+        vertices[vertex_start:vertex_end] = (mesh.vertices[None, :, :] + cell_offsets[:, None, :]).reshape(-1, 3)
+        index_offsets = vertex_start + np.arange(counts[i]) * n_vertices[i]
+        faces[face_start:face_end] = (mesh.faces[None, :, :] + index_offsets[:, None, None]).reshape(-1, 3)
+        vertex_start = vertex_end
+        face_start = face_end
+    return trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
@@ -65,6 +65,7 @@ class PlatformMeshPartsCfg(MeshPartsCfg):
     add_floor: bool = True
     use_z_dim_array: bool = False  # If true, the box height is determined by the z_dim_array.
     wall: Optional[WallPartsCfg] = None  # It will be used to create the walls.
+    greedy_meshing: bool = False  # If true, cells of the same height are merged into larger faces.
 
 
 @dataclass
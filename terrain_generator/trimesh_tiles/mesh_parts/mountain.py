@@ -32,7 +32,11 @@ def generate_perlin_terrain(
 
     terrain_height = base * base_scale + noise * noise_scale
 
-    terrain_mesh = convert_heightfield_to_trimesh(terrain_height, horizontal_scale, vertical_scale)
+    # The vertices of the grid are unique, the mesh does not need to be processed.
+    vertices, triangles = convert_heightfield_to_trimesh(
+        terrain_height, horizontal_scale, vertical_scale, return_arrays=True
+    )
+    terrain_mesh = trimesh.Trimesh(vertices=vertices, faces=triangles, process=False)
 
     terrain_mesh.vertices[:, 2] = trimesh.smoothing.filter_humphrey(terrain_mesh).vertices[:, 2]
 
@@ -13,6 +13,7 @@ from ...utils import (
     get_height_array_of_mesh,
     get_heights_from_mesh,
     euler_angles_to_rotation_matrix,
+    create_boxes_mesh,
 )
 from .mesh_parts_cfg import (
     OverhangingBoxesPartsCfg,
@@ -48,8 +49,9 @@ def generate_wall_from_array(cfg: WallMeshPartsCfg) -> trimesh.Trimesh:
         return trimesh.Trimesh()
 
     grid_size = cfg.dim[0] / cfg.connection_array.shape[0]
-    meshes = []
-    wall_fn = create_wall
+    # Extents and centers of the wall boxes.
+    extents = []
+    centers = []
     for y in range(cfg.connection_array.shape[1]):
         for x in range(cfg.connection_array.shape[0]):
             if cfg.connection_array[x, y] > 0:
@@ -57,13 +59,11 @@ def generate_wall_from_array(cfg: WallMeshPartsCfg) -> trimesh.Trimesh:
                 pos[:2] += grid_size / 2.0 - cfg.dim[0] / 2.0
                 pos[2] += cfg.wall_height / 2.0 - cfg.dim[2] / 2.0
                 if np.abs(pos[0]) > 1.0e-4 and np.abs(pos[1]) < 1.0e-4:
-                    mesh = wall_fn(grid_size, cfg.wall_thickness, cfg.wall_height)
-                    mesh.apply_translation(pos)
-                    meshes.append(mesh)
+                    extents.append((grid_size, cfg.wall_thickness, cfg.wall_height))
+                    centers.append(pos)
                 elif np.abs(pos[0]) < 1.0e-4 and np.abs(pos[1]) > 1.0e-4:
-                    mesh = wall_fn(cfg.wall_thickness, grid_size, cfg.wall_height)
-                    mesh.apply_translation(pos)
-                    meshes.append(mesh)
+                    extents.append((cfg.wall_thickness, grid_size, cfg.wall_height))
+                    centers.append(pos)
                 elif np.abs(pos[0]) < 1.0e-4 and np.abs(pos[1]) < 1.0e-4:
                     # Get the coordinates of the neighboring walls
                     neighbors = []
@@ -104,13 +104,14 @@ def generate_wall_from_array(cfg: WallMeshPartsCfg) -> trimesh.Trimesh:
                         else:
                             continue
 
-                        mesh = wall_fn(width, height, depth)
-                        mesh.apply_translation(p)
-                        meshes.append(mesh)
+                        extents.append((width, height, depth))
+                        centers.append(p)
                 else:
-                    mesh = wall_fn(grid_size, grid_size, cfg.wall_height)
-                    meshes.append(mesh)
-    mesh = merge_meshes(meshes, minimal_triangles=cfg.minimal_triangles, engine=ENGINE)
+                    extents.append((grid_size, grid_size, cfg.wall_height))
+                    centers.append(np.zeros(3))
+    mesh = create_boxes_mesh(extents, centers, cull_shared_faces=not cfg.minimal_triangles)
+    if cfg.minimal_triangles:
+        mesh = merge_meshes(mesh.split(only_watertight=False), minimal_triangles=True, engine=ENGINE)
     mesh = yaw_rotate_mesh(mesh, 270)  # This was required to match the connection array
     return mesh
 
@@ -1,3 +1,4 @@
+from .cache import *
 from .utils import *
 from .mesh_utils import *
 from .nav_utils import *
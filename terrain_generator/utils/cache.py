@@ -0,0 +1,309 @@
+#
+# Copyright (c) 2023, Takahiro Miki. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+import os
+import time
+import uuid
+import numpy as np
+import trimesh
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows. Writes are still atomic, but concurrent writers are not serialized.
+    fcntl = None
+
+
+def get_cache_root() -> str:
+    """Root directory of the caches.
+    Set by TERRAIN_GENERATOR_CACHE_DIR, otherwise $XDG_CACHE_HOME/terrain_generator (~/.cache/terrain_generator).
+    """
+    root = os.environ.get("TERRAIN_GENERATOR_CACHE_DIR")
+    if root:
+        return root
+    xdg_cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(xdg_cache, "terrain_generator")
+
+
+CACHE_DIR = get_cache_root()
+# Size cap of the mesh cache in bytes. Set by TERRAIN_GENERATOR_CACHE_MAX_BYTES, 0 disables eviction.
+CACHE_MAX_BYTES = int(os.environ.get("TERRAIN_GENERATOR_CACHE_MAX_BYTES", 10 * 1024**3))
+# Temporary files older than this are left over from crashed writers and are removed on eviction.
+STALE_TMP_SECONDS = 3600.0
+# The directory is rescanned after this many writes, to account for the writes of other processes.
+RESCAN_WRITES = 256
+
+
+def _save_array_atomic(filename: str, array: np.ndarray):
+    """Write an array to a temporary file next to filename and rename it into place."""
+    tmp = f"{filename}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            np.save(f, array)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def save_mesh_arrays(path: str, mesh: trimesh.Trimesh):
+    """Save the vertices and faces of a mesh as {path}_vertices.npy and {path}_faces.npy.
+    Each array is renamed into place after it is completely written, and the vertices are written last, so that a
+    mesh is only visible when both arrays are complete.
+    """
+    _save_array_atomic(f"{path}_faces.npy", np.asarray(mesh.faces, dtype=np.int64))
+    _save_array_atomic(f"{path}_vertices.npy", np.asarray(mesh.vertices, dtype=np.float64))
+
+
+def load_mesh_arrays(path: str, mmap: bool = True) -> trimesh.Trimesh:
+    """Load a mesh saved by save_mesh_arrays. With mmap, the arrays are read-only memory maps of the files."""
+    mmap_mode = "r" if mmap else None
+    vertices = np.load(f"{path}_vertices.npy", mmap_mode=mmap_mode)
+    faces = np.load(f"{path}_faces.npy", mmap_mode=mmap_mode)
+    return trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+
+
+def mesh_arrays_exist(path: str) -> bool:
+    return os.path.exists(f"{path}_vertices.npy") and os.path.exists(f"{path}_faces.npy")
+
+
+class MeshStore:
+    """Directory of meshes saved by save_mesh_arrays, shared between processes.
+    Writes are atomic and serialized by a lock file per key. When the total size exceeds max_bytes, the least
+    recently accessed entries are evicted. Accessing an entry updates the modification time of its files, which is
+    used as the access time as it does not depend on the atime mount options.
+    The size is tracked from the writes of this process, and the directory is only scanned when the tracked size
+    exceeds max_bytes, or every RESCAN_WRITES writes.
+    Args:
+        root (str): Directory of the entries.
+        max_bytes (int): Size cap of the entries. 0 disables eviction.
+    """
+
+    def __init__(self, root: str, max_bytes: int = CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+        self.reset_stats()
+        # Size of the entries at the last scan plus the writes since then. None until the first scan.
+        self._size_bytes: Optional[int] = None
+        self._writes_since_scan = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.evictions = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        """Statistics of this process, and the current size of the store on disk."""
+        entries = self._list_entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "evictions": self.evictions,
+            "n_entries": len(entries),
+            "size_bytes": sum(size for _, size, _ in entries),
+        }
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def __contains__(self, key: str) -> bool:
+        return mesh_arrays_exist(self.path(key))
+
+    @contextmanager
+    def lock(self, key: str, blocking: bool = True):
+        """Hold the lock file of a key. Yields False if blocking is False and the lock is held by another process.
+        Eviction removes the lock file of an entry while holding it, so the lock is taken again if the file was
+        replaced while waiting for it.
+        """
+        if fcntl is None:
+            yield True
+            return
+        lock_path = self.path(key) + ".lock"
+        while True:
+            f = open(lock_path, "a")
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                yield False
+                return
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(lock_path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            f.close()
+
+    def _load(self, key: str) -> Optional[trimesh.Trimesh]:
+        path = self.path(key)
+        try:
+            mesh = load_mesh_arrays(path)
+        except (FileNotFoundError, ValueError):
+            # Not written yet, or evicted between the two arrays.
+            return None
+        self.hits += 1
+        self.bytes_read += mesh.vertices.nbytes + mesh.faces.nbytes
+        self._touch(path)
+        return mesh
+
+    def _touch(self, path: str):
+        for suffix in ("_faces.npy", "_vertices.npy"):
+            try:
+                os.utime(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> Optional[trimesh.Trimesh]:
+        """Load an entry as memory mapped arrays. Returns None if it does not exist."""
+        mesh = self._load(key)
+        if mesh is None:
+            self.misses += 1
+        return mesh
+
+    def put(self, key: str, mesh: trimesh.Trimesh):
+        """Write an entry, replacing an existing one."""
+        with self.lock(key):
+            self._write(key, mesh)
+        self._evict_if_needed()
+
+    def _write(self, key: str, mesh: trimesh.Trimesh):
+        path = self.path(key)
+        save_mesh_arrays(path, mesh)
+        self.bytes_written += mesh.vertices.nbytes + mesh.faces.nbytes
+        self._writes_since_scan += 1
+        if self._size_bytes is not None:
+            # A replaced entry is counted twice until the next scan, which only makes the eviction earlier.
+            self._size_bytes += os.path.getsize(path + "_vertices.npy") + os.path.getsize(path + "_faces.npy")
+
+    def _evict_if_needed(self):
+        if not self.max_bytes:
+            return
+        if self._size_bytes is None or self._size_bytes > self.max_bytes or self._writes_since_scan >= RESCAN_WRITES:
+            self.evict()
+
+    def get_or_create(self, key: str, mesh_gen: Callable[[], trimesh.Trimesh]) -> trimesh.Trimesh:
+        """Load an entry, or create it with mesh_gen.
+        Only one process creates a missing entry, the others wait for the lock and load it.
+        """
+        mesh = self._load(key)
+        if mesh is not None:
+            return mesh
+        with self.lock(key):
+            mesh = self._load(key)
+            if mesh is not None:
+                return mesh
+            self.misses += 1
+            mesh = mesh_gen()
+            self._write(key, mesh)
+        self._evict_if_needed()
+        return mesh
+
+    def remove(self, key: str):
+        """Remove an entry. The vertices are removed first, so that readers do not see a partial entry."""
+        path = self.path(key)
+        for suffix in ("_vertices.npy", "_faces.npy"):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _remove_lock_file(self, key: str):
+        try:
+            os.remove(self.path(key) + ".lock")
+        except FileNotFoundError:
+            pass
+
+    def _list_entries(self):
+        """List of (key, size in bytes, access time) of the complete entries."""
+        entries = []
+        for filename in os.listdir(self.root):
+            if not filename.endswith("_vertices.npy"):
+                continue
+            key = filename[: -len("_vertices.npy")]
+            path = self.path(key)
+            try:
+                vertices_stat = os.stat(path + "_vertices.npy")
+                faces_stat = os.stat(path + "_faces.npy")
+            except FileNotFoundError:
+                continue
+            entries.append((key, vertices_stat.st_size + faces_stat.st_size, vertices_stat.st_mtime))
+        return entries
+
+    def _remove_stale_tmp(self):
+        now = time.time()
+        for filename in os.listdir(self.root):
+            if not filename.endswith(".tmp"):
+                continue
+            path = os.path.join(self.root, filename)
+            try:
+                if now - os.stat(path).st_mtime > STALE_TMP_SECONDS:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self, max_bytes: Optional[int] = None) -> int:
+        """Evict the least recently accessed entries until the store fits in max_bytes.
+        Entries locked by another process are skipped. Scans the directory and resets the tracked size.
+        Args:
+            max_bytes (int): Size cap. Defaults to self.max_bytes.
+        Returns:
+            int: Number of evicted entries.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if not max_bytes:
+            return 0
+        entries = self._list_entries()
+        total = sum(size for _, size, _ in entries)
+        self._writes_since_scan = 0
+        self._size_bytes = total
+        if total <= max_bytes:
+            return 0
+        self._remove_stale_tmp()
+        n_evicted = 0
+        for key, size, _ in sorted(entries, key=lambda e: e[2]):
+            if total <= max_bytes:
+                break
+            with self.lock(key, blocking=False) as locked:
+                if not locked:
+                    continue
+                self.remove(key)
+                self._remove_lock_file(key)
+            total -= size
+            n_evicted += 1
+        self._size_bytes = total
+        self.evictions += n_evicted
+        return n_evicted
+
+    def clear(self):
+        """Remove all entries and lock files."""
+        for key, _, _ in self._list_entries():
+            self.remove(key)
+        for filename in os.listdir(self.root):
+            if filename.endswith(".lock"):
+                os.remove(os.path.join(self.root, filename))
+        self._size_bytes = None
+
+
+_MESH_STORES: Dict[str, MeshStore] = {}
+
+
+def get_mesh_store(cache_dir: Optional[str] = None) -> MeshStore:
+    """Shared MeshStore of {cache_dir}/mesh_cache, so that statistics are accumulated per process."""
+    root = os.path.abspath(os.path.join(cache_dir or CACHE_DIR, "mesh_cache"))
+    if root not in _MESH_STORES:
+        _MESH_STORES[root] = MeshStore(root)
+    return _MESH_STORES[root]
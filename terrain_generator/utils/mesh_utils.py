@@ -15,6 +15,9 @@ except ImportError:
 from dataclasses import asdict, is_dataclass
 import open3d as o3d
 import matplotlib.pyplot as plt
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 from trimesh.exchange import xyz
 
@@ -29,6 +32,255 @@ def merge_meshes(
     return mesh
 
 
+# Corners of a unit box, the bits of the index are the x, y and z sides.
+BOX_CORNERS = np.array([[(i & 1) - 0.5, ((i >> 1) & 1) - 0.5, ((i >> 2) & 1) - 0.5] for i in range(8)])
+# Quads of the -x, +x, -y, +y, -z, +z sides of a box, counter-clockwise seen from outside.
+BOX_QUADS = np.array([[0, 4, 6, 2], [1, 3, 7, 5], [0, 1, 5, 4], [2, 6, 7, 3], [0, 2, 3, 1], [4, 5, 7, 6]])
+
+
+def get_shared_box_face_pairs(centers: np.ndarray, extents: np.ndarray, tolerance: float = 1e-6) -> np.ndarray:
+    """Find the pairs of sides of axis-aligned boxes which exactly coincide with the opposite side of another box.
+    Args:
+        centers (np.ndarray): (N, 3) centers of the boxes.
+        extents (np.ndarray): (N, 3) sizes of the boxes.
+        tolerance (float): Tolerance of the coordinates.
+    Returns:
+        (np.ndarray) of shape (M, 2), indices box * 6 + side of the positive and the negative side of each pair, with
+        the sides in the order of BOX_QUADS.
+    """
+    n = len(centers)
+    axis = np.tile(np.repeat(np.arange(3), 2), n)
+    sign = np.tile([-1, 1, -1, 1, -1, 1], n)
+    box = np.repeat(np.arange(n), 6)
+    lower = centers - extents / 2.0
+    upper = centers + extents / 2.0
+    plane = np.where(sign > 0, upper[box, axis], lower[box, axis])
+    # The rectangle of each side in the two other axes.
+    axis_1 = (axis + 1) % 3
+    axis_2 = (axis + 2) % 3
+    keys = np.stack(
+        [
+            plane,
+            lower[box, axis_1],
+            upper[box, axis_1],
+            lower[box, axis_2],
+            upper[box, axis_2],
+        ],
+        axis=-1,
+    )
+    keys = np.round(keys / tolerance).astype(np.int64)
+    keys = np.concatenate([axis[:, None], keys], axis=-1)
+    _, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    n_positive = np.bincount(inverse, weights=sign > 0)
+    n_negative = np.bincount(inverse, weights=sign < 0)
+    # Only pairs are removed, a side which is also duplicated by another box is kept to not open the mesh.
+    shared = np.nonzero((n_positive[inverse] == 1) & (n_negative[inverse] == 1))[0]
+    # Sort by key and then by sign, so that each pair is (negative, positive).
+    shared = shared[np.lexsort((sign[shared], inverse[shared]))]
+    return shared.reshape(-1, 2)[:, ::-1]
+
+
+def get_shared_box_faces(centers: np.ndarray, extents: np.ndarray, tolerance: float = 1e-6) -> np.ndarray:
+    """Find the sides of axis-aligned boxes which exactly coincide with the opposite side of another box.
+    Args:
+        centers (np.ndarray): (N, 3) centers of the boxes.
+        extents (np.ndarray): (N, 3) sizes of the boxes.
+        tolerance (float): Tolerance of the coordinates.
+    Returns:
+        (np.ndarray) of bool with shape (N, 6), the sides in the order of BOX_QUADS.
+    """
+    shared = np.zeros(len(centers) * 6, dtype=bool)
+    shared[get_shared_box_face_pairs(centers, extents, tolerance).reshape(-1)] = True
+    return shared.reshape(-1, 6)
+
+
+def create_boxes_mesh(
+    extents: np.ndarray,
+    centers: Optional[np.ndarray] = None,
+    transforms: Optional[np.ndarray] = None,
+    cull_shared_faces: bool = False,
+) -> trimesh.Trimesh:
+    """Create a mesh of N boxes at once.
+    Args:
+        extents (np.ndarray): (N, 3) sizes of the boxes.
+        centers (np.ndarray): (N, 3) centers of axis-aligned boxes.
+        transforms (np.ndarray): (N, 4, 4) poses of the boxes. Used instead of centers.
+        cull_shared_faces (bool): Remove the pairs of sides which exactly coincide between two adjacent axis-aligned
+            boxes, e.g. neighbouring cells of the same height. Only the corners of removed sides are merged, so boxes
+            which merely touch keep separate vertices and the result stays watertight.
+    Returns:
+        trimesh.Trimesh: One mesh of all boxes.
+    """
+    extents = np.asarray(extents, dtype=np.float64).reshape(-1, 3)
+    n = len(extents)
+    if n == 0:
+        return trimesh.Trimesh()
+    vertices = BOX_CORNERS[None, :, :] * extents[:, None, :]
+    if transforms is not None:
+        if cull_shared_faces:
+            raise ValueError("Shared faces can only be culled for axis-aligned boxes.")
+        transforms = np.asarray(transforms, dtype=np.float64).reshape(-1, 4, 4)
+        vertices = vertices @ transforms[:, :3, :3].transpose(0, 2, 1) + transforms[:, None, :3, 3]
+    elif centers is not None:
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+        vertices = vertices + centers[:, None, :]
+    else:
+        centers = np.zeros((n, 3))
+    vertices = vertices.reshape(-1, 3)
+    triangles = np.concatenate([BOX_QUADS[:, [0, 1, 2]], BOX_QUADS[:, [0, 2, 3]]], axis=1).reshape(6, 2, 3)
+    faces = triangles[None] + 8 * np.arange(n)[:, None, None, None]
+    if not cull_shared_faces:
+        return trimesh.Trimesh(vertices=vertices, faces=faces.reshape(-1, 3), process=False)
+
+    pairs = get_shared_box_face_pairs(centers, extents)
+    faces = np.delete(faces.reshape(-1, 2, 3), pairs.reshape(-1), axis=0)
+    # Glue the corners of each removed pair. The positive side of a box has the bit of its axis set in the corner
+    # indices, and the corner of the other box at the same position differs only in that bit.
+    axis = pairs[:, 0] % 6 // 2
+    corners = BOX_QUADS[pairs[:, 0] % 6]
+    positive_ids = pairs[:, :1] // 6 * 8 + corners
+    negative_ids = pairs[:, 1:] // 6 * 8 + (corners ^ (1 << axis[:, None]))
+    glue = coo_matrix(
+        (np.ones(positive_ids.size), (positive_ids.reshape(-1), negative_ids.reshape(-1))), shape=(8 * n, 8 * n)
+    )
+    _, labels = connected_components(glue, directed=False)
+    mesh = trimesh.Trimesh(
+        vertices=vertices[np.unique(labels, return_index=True)[1]], faces=labels[faces.reshape(-1, 3)], process=False
+    )
+    mesh.remove_unreferenced_vertices()
+    return mesh
+
+
+def get_greedy_rectangles(mask: np.ndarray) -> List[List[int]]:
+    """Cover the True cells of a 2D mask with rectangles. Runs of each row are merged with the same run of the
+    previous row.
+    Args:
+        mask (np.ndarray): (H, W) bool array.
+    Returns:
+        list of [row_start, row_end, col_start, col_end] (ends are exclusive).
+    """
+    steps = np.diff(np.pad(mask, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    rows, starts = np.nonzero(steps == 1)
+    _, ends = np.nonzero(steps == -1)
+    rectangles = []
+    open_rectangles = {}
+    for row, start, end in zip(rows.tolist(), starts.tolist(), ends.tolist()):
+        rectangle = open_rectangles.get((start, end))
+        if rectangle is not None and rectangle[1] == row:
+            rectangle[1] = row + 1
+        else:
+            rectangle = [row, row + 1, start, end]
+            open_rectangles[(start, end)] = rectangle
+            rectangles.append(rectangle)
+    return rectangles
+
+
+def has_edge_contacts(occupancy: np.ndarray) -> bool:
+    """Check if two occupied cells of a 3D grid touch only along an edge, i.e. a 2x2 block of cells in any plane has
+    exactly two diagonal cells occupied.
+    """
+    for axis_0, axis_1 in ((0, 1), (0, 2), (1, 2)):
+        occ = np.moveaxis(occupancy, (axis_0, axis_1), (0, 1))
+        a, b, c, d = occ[:-1, :-1], occ[1:, :-1], occ[:-1, 1:], occ[1:, 1:]
+        if ((a & d & ~b & ~c) | (b & c & ~a & ~d)).any():
+            return True
+    return False
+
+
+def create_greedy_boxes_mesh(extents: np.ndarray, centers: np.ndarray, tolerance: float = 1e-9) -> trimesh.Trimesh:
+    """Create a mesh of the union of axis-aligned boxes with greedy meshing.
+    The boxes are rasterized on the grid of their coordinates, and the sides of the occupied cells which face empty
+    cells are merged into rectangles. Hidden faces are not created, and rectangles with vertices of their neighbours on
+    their border are triangulated around their center, so that there are no T-junctions and the mesh is watertight.
+    If two cells only touch along an edge, which would be shared by four faces, or if the greedy mesh has more faces,
+    the boxes are meshed by create_boxes_mesh with culled shared faces instead.
+    Args:
+        extents (np.ndarray): (N, 3) sizes of the boxes.
+        centers (np.ndarray): (N, 3) centers of the boxes.
+        tolerance (float): Coordinates closer than this are merged.
+    Returns:
+        trimesh.Trimesh: Mesh of the union.
+    """
+    extents = np.asarray(extents, dtype=np.float64).reshape(-1, 3)
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    n = len(extents)
+    if n == 0:
+        return trimesh.Trimesh()
+    corners = np.concatenate([centers - extents / 2.0, centers + extents / 2.0])
+    levels = []
+    indices = []
+    for axis in range(3):
+        values, index = np.unique(np.round(corners[:, axis] / tolerance), return_inverse=True)
+        levels.append(values * tolerance)
+        indices.append(index.reshape(-1))
+    indices = np.stack(indices, axis=-1)
+    occupancy = np.zeros([len(level) - 1 for level in levels], dtype=bool)
+    for (x0, y0, z0), (x1, y1, z1) in zip(indices[:n], indices[n:]):
+        occupancy[x0:x1, y0:y1, z0:z1] = True
+    if has_edge_contacts(occupancy):
+        return create_boxes_mesh(extents, centers, cull_shared_faces=True)
+
+    # Rectangles of (axis, sign, plane, b0, b1, c0, c1), where b and c are the next two axes.
+    rectangles = []
+    for axis in range(3):
+        order = (axis, (axis + 1) % 3, (axis + 2) % 3)
+        occ = np.pad(np.transpose(occupancy, order), ((1, 1), (0, 0), (0, 0))).astype(np.int8)
+        steps = occ[1:] - occ[:-1]
+        for sign, step in ((1, -1), (-1, 1)):
+            for plane in np.nonzero((steps == step).any(axis=(1, 2)))[0]:
+                for rectangle in get_greedy_rectangles(steps[plane] == step):
+                    rectangles.append([axis, sign, plane] + rectangle)
+    rectangles = np.array(rectangles)
+
+    # Grid points used as corners. Points on the border of another rectangle split its edges.
+    used = np.zeros([len(level) for level in levels], dtype=bool)
+    for axis in range(3):
+        order = (axis, (axis + 1) % 3, (axis + 2) % 3)
+        r = rectangles[rectangles[:, 0] == axis]
+        used_view = np.transpose(used, order)
+        for b, c in ((3, 5), (4, 5), (3, 6), (4, 6)):
+            used_view[r[:, 2], r[:, b], r[:, c]] = True
+    vertex_ids = np.full(used.shape, -1, dtype=np.int64)
+    points = np.nonzero(used)
+    vertex_ids[points] = np.arange(len(points[0]))
+    vertices = [np.stack([levels[axis][points[axis]] for axis in range(3)], axis=-1)]
+    n_vertices = len(points[0])
+
+    faces = []
+    for axis, sign, plane, b0, b1, c0, c1 in rectangles.tolist():
+        order = (axis, (axis + 1) % 3, (axis + 2) % 3)
+        used_view = np.transpose(used, order)[plane]
+        ids = np.transpose(vertex_ids, order)[plane]
+        # Border counter-clockwise seen from the +axis side.
+        bs_0 = b0 + np.nonzero(used_view[b0 : b1 + 1, c0])[0]
+        cs_1 = c0 + np.nonzero(used_view[b1, c0 : c1 + 1])[0]
+        bs_1 = b0 + np.nonzero(used_view[b0 : b1 + 1, c1])[0]
+        cs_0 = c0 + np.nonzero(used_view[b0, c0 : c1 + 1])[0]
+        polygon = np.concatenate(
+            [ids[bs_0, c0][:-1], ids[b1, cs_1][:-1], ids[bs_1[::-1], c1][:-1], ids[b0, cs_0[::-1]][:-1]]
+        )
+        if sign < 0:
+            polygon = polygon[::-1]
+        if len(polygon) == 4:
+            faces.append(polygon[[0, 1, 2, 0, 2, 3]].reshape(2, 3))
+            continue
+        center = np.zeros(3)
+        center[list(order)] = [
+            levels[axis][plane],
+            (levels[order[1]][b0] + levels[order[1]][b1]) / 2.0,
+            (levels[order[2]][c0] + levels[order[2]][c1]) / 2.0,
+        ]
+        vertices.append(center[None])
+        faces.append(np.stack([np.full(len(polygon), n_vertices), polygon, np.roll(polygon, -1)], axis=-1))
+        n_vertices += 1
+    faces = np.concatenate(faces)
+    # Each culled pair of sides removes 4 of the 12 triangles per box.
+    if len(faces) > 12 * n - 4 * len(get_shared_box_face_pairs(centers, extents)):
+        return create_boxes_mesh(extents, centers, cull_shared_faces=True)
+    return trimesh.Trimesh(vertices=np.concatenate(vertices), faces=faces, process=False)
+
+
 def flip_mesh(mesh: trimesh.Trimesh, direction: Literal["x", "y"]):
     """Flip a mesh in a given direction."""
     new_mesh = mesh.copy()
@@ -149,6 +401,7 @@ def convert_heightfield_to_trimesh(
     horizontal_scale: float,
     vertical_scale: float,
     slope_threshold: Optional[float] = None,
+    return_arrays: bool = False,
 ):
     """
     Convert a heightfield array to a triangle mesh represented by vertices and triangles.
@@ -166,7 +419,9 @@ def convert_heightfield_to_trimesh(
         horizontal_scale (float): horizontal scale of the heightfield [meters]
         vertical_scale (float): vertical scale of the heightfield [meters]
         slope_threshold (float): the slope threshold above which surfaces are made vertical. If None no correction is applied (default: None)
+        return_arrays (bool): return the arrays without constructing (and processing) a trimesh.Trimesh.
     Returns:
+        mesh (trimesh.Trimesh): the heightfield mesh, or if return_arrays is True
         vertices (np.array(float)): array of shape (num_vertices, 3). Each row represents the location of each vertex [meters]
         triangles (np.array(int)): array of shape (num_triangles, 3). Each row represents the indices of the 3 vertices connected by this triangle.
     """
@@ -208,21 +463,19 @@ def convert_heightfield_to_trimesh(
     vertices[:, 0] = xx.flatten()
     vertices[:, 1] = yy.flatten()
     vertices[:, 2] = hf.flatten() * vertical_scale
-    triangles = -np.ones((2 * (num_rows - 1) * (num_cols - 1), 3), dtype=np.uint32)
-    for i in range(num_rows - 1):
-        ind0 = np.arange(0, num_cols - 1) + i * num_cols
-        ind1 = ind0 + 1
-        ind2 = ind0 + num_cols
-        ind3 = ind2 + 1
-        start = 2 * i * (num_cols - 1)
-        stop = start + 2 * (num_cols - 1)
-        triangles[start:stop:2, 0] = ind0
-        triangles[start:stop:2, 1] = ind3
-        triangles[start:stop:2, 2] = ind1
-        triangles[start + 1 : stop : 2, 0] = ind0
-        triangles[start + 1 : stop : 2, 1] = ind2
-        triangles[start + 1 : stop : 2, 2] = ind3
-
+    # Two triangles for each cell, ind0 is the top left corner of the cells.
+    row_starts = np.arange(num_rows - 1, dtype=np.uint32) * num_cols
+    ind0 = (row_starts[:, None] + np.arange(num_cols - 1, dtype=np.uint32)).ravel()
+    ind1 = ind0 + 1
+    ind2 = ind0 + num_cols
+    ind3 = ind2 + 1
+    triangles = np.empty((len(ind0), 2, 3), dtype=np.uint32)
+    triangles[:, 0] = np.stack([ind0, ind3, ind1], axis=-1)
+    triangles[:, 1] = np.stack([ind0, ind2, ind3], axis=-1)
+    triangles = triangles.reshape(-1, 3)
+
+    if return_arrays:
+        return vertices, triangles
     mesh = trimesh.Trimesh(vertices=vertices, faces=triangles)
     return mesh
 
@@ -284,43 +537,174 @@ def visualize_mesh(mesh: Union[trimesh.Trimesh, o3d.geometry.TriangleMesh], save
     vis.capture_screen_image(save_path)
 
 
-def compute_signed_distance_and_closest_geometry(scene: o3d.t.geometry.RaycastingScene, query_points: np.ndarray):
+def compute_signed_distance_and_closest_geometry(
+    scene: o3d.t.geometry.RaycastingScene,
+    query_points: np.ndarray,
+    sign_method: Literal["ray", "flood_fill"] = "ray",
+    nsamples: int = 1,
+):
+    """Compute the signed distance of points to a scene, negative inside of the geometry.
+    Args:
+        scene (o3d.t.geometry.RaycastingScene): Scene.
+        query_points (np.ndarray): Float32 points of shape (..., 3).
+        sign_method (str): How to test if a point is inside.
+            "ray": Count the intersections of a ray from every point.
+            "flood_fill": query_points must be a grid of shape (X, Y, Z, 3). Only the points near the surface are
+                tested, and the other points take the result of their connected region, which is tested once.
+                Assumes a watertight geometry.
+        nsamples (int): Odd number of rays per tested point for "flood_fill".
+    Returns:
+        distance (np.ndarray): Signed distance of shape (...).
+        geometry_ids (np.ndarray): Id of the closest geometry of shape (...).
+    """
     closest_points = scene.compute_closest_points(query_points)
     distance = np.linalg.norm(query_points - closest_points["points"].numpy(), axis=-1)
-    rays = np.concatenate([query_points, np.ones_like(query_points)], axis=-1)
-    intersection_counts = scene.count_intersections(rays).numpy()
-    is_inside = intersection_counts % 2 == 1
+    if sign_method == "ray":
+        rays = np.concatenate([query_points, np.ones_like(query_points)], axis=-1)
+        intersection_counts = scene.count_intersections(rays).numpy()
+        is_inside = intersection_counts % 2 == 1
+    elif sign_method == "flood_fill":
+        is_inside = flood_fill_inside(scene, query_points, distance, nsamples)
+    else:
+        raise ValueError(f"sign_method {sign_method} is not supported")
     distance[is_inside] *= -1
     return distance, closest_points["geometry_ids"].numpy()
 
 
-def compute_sdf(mesh: trimesh.Trimesh, dim=[2, 2, 2], resolution: float = 0.1) -> np.ndarray:
+def flood_fill_inside(
+    scene: o3d.t.geometry.RaycastingScene, grid_points: np.ndarray, distance: np.ndarray, nsamples: int = 1
+) -> np.ndarray:
+    """Test if the points of a grid are inside of the geometry, by testing one point per region of the grid which is
+    not separated by the surface.
+    Two neighboring points whose distances to the surface are both larger than half of the grid spacing cannot have
+    the surface between them, so the 6-connected regions of such points are either inside or outside.
+    Args:
+        scene (o3d.t.geometry.RaycastingScene): Scene.
+        grid_points (np.ndarray): Float32 points of shape (X, Y, Z, 3).
+        distance (np.ndarray): Unsigned distance of the points to the surface of shape (X, Y, Z).
+        nsamples (int): Odd number of rays per tested point.
+    Returns:
+        np.ndarray: Boolean array of shape (X, Y, Z).
+    """
+    if grid_points.ndim != 4:
+        raise ValueError(f"grid_points must have shape (X, Y, Z, 3), got {grid_points.shape}")
+    spacing = 0.0
+    for axis in range(3):
+        if grid_points.shape[axis] > 1:
+            step = np.take(grid_points, 1, axis=axis) - np.take(grid_points, 0, axis=axis)
+            spacing = max(spacing, np.linalg.norm(step.reshape(-1, 3)[0]))
+    is_free = distance > spacing / 2
+    labels, n_regions = ndimage.label(is_free)
+
+    # Test the points near the surface, and the point furthest from the surface of each region.
+    representatives = ndimage.maximum_position(distance, labels, np.arange(1, n_regions + 1))
+    representatives = np.array(representatives, dtype=np.int64).reshape(-1, 3)
+    test_points = np.concatenate([grid_points[~is_free], grid_points[tuple(representatives.T)]], axis=0)
+    is_tested_inside = scene.compute_occupancy(test_points.astype(np.float32), nsamples=nsamples).numpy() == 1
+
+    n_surface = len(test_points) - n_regions
+    is_region_inside = np.concatenate([[False], is_tested_inside[n_surface:]])
+    is_inside = is_region_inside[labels]
+    is_inside[~is_free] = is_tested_inside[:n_surface]
+    return is_inside
+
+
+def compute_sdf(
+    mesh: trimesh.Trimesh,
+    dim=[2, 2, 2],
+    resolution: float = 0.1,
+    chunk_size: int = 1 << 22,
+    out: Optional[Union[np.ndarray, str]] = None,
+    sign_method: Literal["ray", "signed_distance", "flood_fill"] = "ray",
+    nsamples: int = 1,
+    seed: Optional[int] = 0,
+) -> np.ndarray:
+    """Compute the SDF of a mesh on a grid centered at the origin.
+    The grid is processed in slabs along x of at most chunk_size points, so the peak memory is the output plus the
+    queries of one slab.
+    Args:
+        mesh (trimesh.Trimesh): Mesh.
+        dim: Size of the grid.
+        resolution (float): Distance between the grid points.
+        chunk_size (int): Maximum number of points per query. At least one yz slice is queried at once.
+        out (np.ndarray or str): Preallocated float32 output of the grid shape, e.g. a np.memmap. If a path is given,
+            the output is written to a memory mapped .npy file at the path.
+        sign_method (str): Inside test, see compute_signed_distance_and_closest_geometry. "flood_fill" fills each
+            slab separately. "signed_distance" uses RaycastingScene.compute_signed_distance, which skips the closest
+            geometry ids. Both assume a watertight mesh.
+        nsamples (int): Odd number of rays per tested point for "signed_distance" and "flood_fill". More rays make
+            the inside test robust to rays which graze an edge.
+        seed (int): Seed of the jitter of the vertices. The same seed gives the same SDF. None for a random jitter.
+    Returns:
+        np.ndarray: SDF indexed by (x, y, z). Returns out if it is given.
+    """
 
-    # To prevent weird behavior when two surfaces are exactly at the same positions
-    mesh.vertices += np.random.uniform(-1e-4, 1e-4, size=mesh.vertices.shape)
-    # Convert mesh to Open3D TriangleMesh
-    mesh_o3d = mesh.as_open3d
-    mesh_o3d = o3d.t.geometry.TriangleMesh.from_legacy(mesh_o3d)
+    # To prevent weird behavior when two surfaces are exactly at the same positions. The mesh is not modified, and
+    # a local generator is used to not change the global random state.
+    rng = np.random.default_rng(seed)
+    vertices = mesh.vertices + rng.uniform(-1e-4, 1e-4, size=mesh.vertices.shape)
 
     # Create RaycastingScene and add mesh
     scene = o3d.t.geometry.RaycastingScene()
-    _ = scene.add_triangles(mesh_o3d)
+    _ = scene.add_triangles(
+        o3d.core.Tensor(vertices.astype(np.float32)), o3d.core.Tensor(np.asarray(mesh.faces, dtype=np.uint32))
+    )
 
-    # Compute grid coordinates and query points
-    bbox = mesh.bounds
+    # Compute grid coordinates
     dim = np.array(dim)
-    num_elements = np.ceil(np.array(dim) / resolution).astype(int)
+    num_elements = tuple(np.ceil(np.array(dim) / resolution).astype(int))
     xyz_range = [np.linspace(-dim[i] / 2, dim[i] / 2, num=num_elements[i]) for i in range(len(dim))]
-    query_points = np.stack(np.meshgrid(*xyz_range), axis=-1).astype(np.float32)
 
-    # Compute signed distance and occupancy
-    sdf, _ = compute_signed_distance_and_closest_geometry(scene, query_points)
+    if out is None:
+        sdf = np.empty(num_elements, dtype=np.float32)
+    elif isinstance(out, str):
+        sdf = np.lib.format.open_memmap(out, mode="w+", dtype=np.float32, shape=num_elements)
+    else:
+        if out.shape != num_elements:
+            raise ValueError(f"out has shape {out.shape}, expected {num_elements}")
+        sdf = out
+
+    # Compute signed distance and occupancy per slab
+    slab_size = max(1, chunk_size // (num_elements[1] * num_elements[2]))
+    for i in range(0, num_elements[0], slab_size):
+        query_points = np.stack(
+            np.meshgrid(xyz_range[0][i : i + slab_size], xyz_range[1], xyz_range[2], indexing="ij"), axis=-1
+        ).astype(np.float32)
+        if sign_method == "signed_distance":
+            distance = scene.compute_signed_distance(query_points, nsamples=nsamples).numpy()
+        else:
+            distance, _ = compute_signed_distance_and_closest_geometry(scene, query_points, sign_method, nsamples)
+        sdf[i : i + slab_size] = distance
+
+    if isinstance(sdf, np.memmap):
+        sdf.flush()
+    return sdf
 
-    # Reshape to a 3D grid
-    sdf = sdf.reshape(*num_elements)
-    sdf = sdf.transpose(1, 0, 2)
-    sdf = sdf[:, :, :]
 
+def transform_sdf_array(sdf: np.ndarray, transforms: Iterable[Tuple[str, Any]]) -> np.ndarray:
+    """Apply flips and yaw rotations of a mesh to its SDF computed by compute_sdf, by permuting the indices.
+    The grid of compute_sdf is symmetric around the origin, so the result equals the SDF of the transformed mesh.
+    Rotations by 90 or 270 degrees require the same number of cells in x and y.
+    Args:
+        sdf (np.ndarray): SDF indexed by (x, y, z).
+        transforms: ("flip", "x" or "y") or ("rotate", degrees) in the order they were applied to the mesh.
+    Returns:
+        np.ndarray: View of the transformed SDF.
+    """
+    for transform, value in transforms:
+        if transform == "flip":
+            if value == "x":
+                sdf = sdf[::-1]
+            elif value == "y":
+                sdf = sdf[:, ::-1]
+            else:
+                raise ValueError(f"Direction {value} is not defined.")
+        elif transform == "rotate":
+            if value % 180 != 0 and sdf.shape[0] != sdf.shape[1]:
+                raise ValueError(f"Cannot rotate an SDF of shape {sdf.shape} by {value} degrees.")
+            sdf = np.rot90(sdf, value // 90, axes=(0, 1))
+        else:
+            raise ValueError(f"Transform {transform} is not defined.")
     return sdf
 
 
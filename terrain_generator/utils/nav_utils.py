@@ -265,30 +265,53 @@ def create_2d_graph_from_height_array(
     return G
 
 
+def adjacency_matrix_from_graph(graph: nx.Graph) -> csr_matrix:
+    """Sparse adjacency matrix of a graph, with the nodes in the order of graph.nodes()."""
+    return csr_matrix(nx.adjacency_matrix(graph))
+
+
 def distance_matrix_from_graph(graph: nx.Graph):
     # Compute adjacency matrix
-    adj_mtx = nx.adjacency_matrix(graph)
-
-    g_mat = csr_matrix(adj_mtx)
+    g_mat = adjacency_matrix_from_graph(graph)
 
     # Compute shortest path distances using Dijkstra's algorithm
     dist_matrix, _ = shortest_path(csgraph=g_mat, directed=False, return_predecessors=True)
     return dist_matrix
 
 
-def compute_distance_matrix(
+def compute_distance_graph(
     mesh: trimesh.Trimesh,
     graph_ratio: int = 4,
     height_threshold: float = 0.4,
     invalid_cost: float = 1000.0,
     height_map_resolution: float = 0.1,
 ):
+    """Same as compute_distance_matrix, but returns the sparse adjacency matrix of the graph instead of the distances
+    between all pairs of nodes. A row of the distance matrix is given by dijkstra(graph, directed=False, indices=i).
+    Returns:
+        graph (csr_matrix): Adjacency matrix of shape (N, N).
+        shape (np.ndarray): Shape of the graph grid.
+        center (np.ndarray): Center of the height array.
+    """
     height_array, center = get_height_array_of_mesh_with_resolution(mesh, resolution=height_map_resolution)
     G = create_2d_graph_from_height_array(
         height_array, graph_ratio=graph_ratio, invalid_cost=invalid_cost, height_threshold=height_threshold
     )
-    dist_matrix = distance_matrix_from_graph(G)
     shape = (np.array(height_array.shape) // graph_ratio).astype(int)
+    return adjacency_matrix_from_graph(G), shape, center
+
+
+def compute_distance_matrix(
+    mesh: trimesh.Trimesh,
+    graph_ratio: int = 4,
+    height_threshold: float = 0.4,
+    invalid_cost: float = 1000.0,
+    height_map_resolution: float = 0.1,
+):
+    graph, shape, center = compute_distance_graph(
+        mesh, graph_ratio, height_threshold, invalid_cost, height_map_resolution
+    )
+    dist_matrix = shortest_path(csgraph=graph, directed=False)
     return dist_matrix, shape, center
 
 
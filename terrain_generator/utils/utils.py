@@ -7,20 +7,19 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 import trimesh
-from typing import Callable, Any, Optional, Union, Tuple
-from dataclasses import asdict, is_dataclass
+from typing import Callable, Any, Dict, Optional, Union, Tuple
+from dataclasses import asdict, fields, is_dataclass
 from itertools import product
-import copy
+import hashlib
 import json
+import weakref
 from scipy.spatial.transform import Rotation
 
+from .cache import CACHE_DIR, get_mesh_store, save_mesh_arrays, load_mesh_arrays, mesh_arrays_exist
 
 ENGINE = "blender"
-# Cache dir is in the above directory as this file.
-# CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__cache__/mesh_cache")
-CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__cache__")
-# print("CACHE_DIR", CACHE_DIR)
-# CACHE_DIR =
+# Cache directory of the older versions, which cached the meshes as OBJ files keyed by an MD5 hash of the config.
+LEGACY_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__cache__")
 # ENGINE = "scad"
 
 
@@ -37,37 +36,170 @@ class NpEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+# Digests of dataclasses and read-only arrays memoized per object identity, {id: {exclude_keys: (state, digest)}}.
+_HASH_MEMO: Dict[int, Dict[Tuple[str, ...], Tuple[Any, bytes]]] = {}
+
+
+def _tagged(h, tag: bytes, data: bytes):
+    h.update(tag + len(data).to_bytes(8, "little") + data)
+
+
+def _is_dataclass_instance(obj) -> bool:
+    return is_dataclass(obj) and not isinstance(obj, type)
+
+
+def _is_read_only(array: np.ndarray) -> bool:
+    """Whether the data of an array cannot be modified through it or any array it is a view of."""
+    while isinstance(array, np.ndarray):
+        if array.flags.writeable:
+            return False
+        array = array.base
+    return True
+
+
+def _memo_state(obj):
+    """State an object's digest depends on, besides the contents of its fields."""
+    if isinstance(obj, np.ndarray):
+        return (obj.__array_interface__["data"][0], obj.shape, obj.strides, obj.dtype.str)
+    return tuple(getattr(obj, f.name) for f in fields(obj))
+
+
+def _is_unchanged(value) -> bool:
+    """Whether a value still has the digest memoized for it. Lists, dicts and sets are never memoized."""
+    if value is None or isinstance(value, (bool, int, float, str, bytes, np.generic)):
+        return True
+    if isinstance(value, (tuple, frozenset)):
+        return all(_is_unchanged(v) for v in value)
+    if isinstance(value, np.ndarray) or _is_dataclass_instance(value):
+        return _lookup_memo(value, ()) is not None
+    return False
+
+
+def _lookup_memo(obj, exclude_keys: Tuple[str, ...]) -> Optional[bytes]:
+    entry = _HASH_MEMO.get(id(obj), {}).get(exclude_keys)
+    if entry is None:
+        return None
+    state, digest = entry
+    if isinstance(obj, np.ndarray):
+        return digest if state == _memo_state(obj) else None
+    values = _memo_state(obj)
+    if any(a is not b for a, b in zip(values, state)) or not all(_is_unchanged(v) for v in values):
+        return None
+    return digest
+
+
+def _store_memo(obj, exclude_keys: Tuple[str, ...], digest: bytes):
+    key = id(obj)
+    if key not in _HASH_MEMO:
+        try:
+            weakref.finalize(obj, _HASH_MEMO.pop, key, None)
+        except TypeError:
+            # Not weak referenceable, the digest cannot be invalidated when the object is deleted.
+            return
+        _HASH_MEMO[key] = {}
+    _HASH_MEMO[key][exclude_keys] = (_memo_state(obj), digest)
+
+
+def _digest(obj, exclude_keys: Tuple[str, ...] = ()) -> bytes:
+    """Canonical digest of a config value. Dataclasses and read-only arrays are memoized per object."""
+    memoize = _is_dataclass_instance(obj) or (
+        isinstance(obj, np.ndarray) and not obj.dtype.hasobject and _is_read_only(obj)
+    )
+    if memoize:
+        digest = _lookup_memo(obj, exclude_keys)
+        if digest is not None:
+            return digest
+    h = hashlib.blake2b(digest_size=16)
+    _update_hash(h, obj, exclude_keys)
+    digest = h.digest()
+    if memoize:
+        _store_memo(obj, exclude_keys, digest)
+    return digest
+
+
+def _update_hash(h, obj, exclude_keys: Tuple[str, ...] = ()):
+    """Feed a config value into a hash. Every value is prefixed with a type tag, so that different types with the
+    same serialization (e.g. 1 and "1") do not collide."""
+    if obj is None:
+        h.update(b"N")
+    elif isinstance(obj, (bool, np.bool_)):
+        h.update(b"T" if obj else b"F")
+    elif isinstance(obj, (int, np.integer)):
+        _tagged(h, b"i", str(int(obj)).encode())
+    elif isinstance(obj, (float, np.floating)):
+        _tagged(h, b"f", repr(float(obj)).encode())
+    elif isinstance(obj, str):
+        _tagged(h, b"s", obj.encode())
+    elif isinstance(obj, bytes):
+        _tagged(h, b"y", obj)
+    elif isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            _tagged(h, b"o", str(obj.shape).encode())
+            _update_hash(h, obj.ravel().tolist())
+        else:
+            _tagged(h, b"a", f"{obj.dtype.str}{obj.shape}".encode())
+            h.update(np.ascontiguousarray(obj).data)
+    elif _is_dataclass_instance(obj):
+        _tagged(h, b"D", type(obj).__name__.encode())
+        for f in fields(obj):
+            if f.name not in exclude_keys:
+                _tagged(h, b"k", f.name.encode())
+                h.update(_digest(getattr(obj, f.name)))
+    elif isinstance(obj, dict):
+        # Sort by the digest of the keys, so that the order of insertion and the type of the keys do not matter.
+        items = sorted(((_digest(k), v) for k, v in obj.items() if k not in exclude_keys), key=lambda item: item[0])
+        _tagged(h, b"d", str(len(items)).encode())
+        for key_digest, v in items:
+            h.update(key_digest + _digest(v))
+    elif isinstance(obj, (list, tuple)):
+        _tagged(h, b"l", str(len(obj)).encode())
+        for v in obj:
+            h.update(_digest(v))
+    elif isinstance(obj, (set, frozenset)):
+        _tagged(h, b"e", str(len(obj)).encode())
+        for v in sorted(_digest(v) for v in obj):
+            h.update(v)
+    elif isinstance(obj, trimesh.Trimesh):
+        h.update(b"m" + _digest(np.asarray(obj.vertices)) + _digest(np.asarray(obj.faces)))
+    else:
+        raise ValueError(f"Cannot hash a config value of type {type(obj).__name__}.")
+
+
 def cfg_to_hash(cfg, exclude_keys=["weight", "load_from_cache"]):
-    """MD5 hash of a config."""
-    import hashlib
+    """Hash of a config, stable across runs.
+    Values are fed into blake2b without serialization, arrays as their dtype, shape and raw bytes. The digests of
+    dataclasses and read-only arrays are memoized per object, and recomputed when a field is assigned. Writeable
+    arrays can be modified in place, so they and the dataclasses holding them are hashed again on every call.
+    Args:
+        cfg (dict or dataclass): Config to hash.
+        exclude_keys (list): Top level keys which are not hashed.
+    Returns:
+        str: Hex digest.
+    """
+    if not (isinstance(cfg, dict) or _is_dataclass_instance(cfg)):
+        raise ValueError("cfg must be a dict or dataclass.")
+    return _digest(cfg, tuple(exclude_keys)).hex()
+
+
+def _legacy_cfg_to_hash(cfg, exclude_keys=["weight", "load_from_cache"]) -> Optional[str]:
+    """MD5 hash of a config used by the older versions for the OBJ cache. None if the config cannot be serialized."""
 
     def tuple_to_str(d):
         new_d = {}
         for k, v in d.items():
             if isinstance(v, dict):
                 v = tuple_to_str(v)
-            if isinstance(k, tuple):
-                new_d[str(k)] = v
-            else:
-                new_d[k] = v
+            new_d[str(k) if isinstance(k, tuple) else k] = v
         return new_d
 
-    if isinstance(cfg, dict):
-        cfg_dict = copy.deepcopy(cfg)
-    elif is_dataclass(cfg):
-        cfg_dict = asdict(cfg)
-    else:
-        raise ValueError("cfg must be a dict or dataclass.")
+    cfg_dict = dict(cfg) if isinstance(cfg, dict) else asdict(cfg)
     for key in exclude_keys:
         cfg_dict.pop(key, None)
-    cfg_dict = tuple_to_str(cfg_dict)
-    encoded = json.dumps(cfg_dict, sort_keys=True, cls=NpEncoder).encode()
-    dhash = hashlib.md5()
-    # We need to sort arguments so {'a': 1, 'b': 2} is
-    # the same as {'b': 2, 'a': 1}
-    # encoded = json.dumps(cfg, sort_keys=True).encode()
-    dhash.update(encoded)
-    return dhash.hexdigest()
+    try:
+        encoded = json.dumps(tuple_to_str(cfg_dict), sort_keys=True, cls=NpEncoder).encode()
+    except TypeError:
+        return None
+    return hashlib.md5(encoded).hexdigest()
 
 
 def get_cached_mesh_gen(
@@ -75,29 +207,48 @@ def get_cached_mesh_gen(
     cfg,
     verbose=False,
     use_cache=True,
+    cache_dir: Optional[str] = None,
 ) -> Callable[[], trimesh.Trimesh]:
-    """Generate a mesh if there's no cache. If there's cache, load from cache."""
+    """Generate a mesh if there's no cache. If there's cache, load from cache.
+    Meshes are cached as raw vertex and face arrays in a MeshStore, which are memory mapped when loaded. OBJ files
+    of the older cache in LEGACY_CACHE_DIR are converted on a miss and removed after the arrays are written.
+    """
     code = cfg_to_hash(cfg)
-    mesh_cache_dir = os.path.join(CACHE_DIR, "mesh_cache")
-    os.makedirs(mesh_cache_dir, exist_ok=True)
+    store = get_mesh_store(cache_dir)
     if hasattr(cfg, "name"):
         name = cfg.name
     else:
         name = ""
 
-    mesh_name = f"{name}_{code}.obj"
+    mesh_name = f"{name}_{code}"
+    converted_paths = []
 
-    def mesh_gen() -> trimesh.Trimesh:
-        if os.path.exists(os.path.join(mesh_cache_dir, mesh_name)) and use_cache:
+    def create_mesh() -> trimesh.Trimesh:
+        legacy_code = _legacy_cfg_to_hash(cfg)
+        obj_path = os.path.join(LEGACY_CACHE_DIR, "mesh_cache", f"{name}_{legacy_code}.obj")
+        if legacy_code is not None and os.path.exists(obj_path):
             if verbose:
-                print(f"Loading mesh {name} from cache {mesh_name} ...")
-            mesh = trimesh.load_mesh(os.path.join(mesh_cache_dir, mesh_name))
-        else:
-            # if verbose:
-            if use_cache:
-                print(f"{name} does not exist in cache, creating {mesh_name} ...")
+                print(f"Converting mesh {name} in cache {obj_path} ...")
+            converted_paths.append(obj_path)
+            return trimesh.load_mesh(obj_path)
+        print(f"{name} does not exist in cache, creating {mesh_name} ...")
+        return mesh_gen_fn(cfg)
+
+    def mesh_gen() -> trimesh.Trimesh:
+        if not use_cache:
             mesh = mesh_gen_fn(cfg)
-            mesh.export(os.path.join(mesh_cache_dir, mesh_name))
+            store.put(mesh_name, mesh)
+            return mesh
+        if verbose and mesh_name in store:
+            print(f"Loading mesh {name} from cache {mesh_name} ...")
+        mesh = store.get_or_create(mesh_name, create_mesh)
+        if converted_paths:
+            # The converted OBJ file is removed after the arrays are written. Another process may remove it first.
+            with store.lock(mesh_name):
+                try:
+                    os.remove(converted_paths.pop())
+                except FileNotFoundError:
+                    pass
         return mesh
 
     return mesh_gen
@@ -5,10 +5,11 @@
 import numpy as np
 import trimesh
 import functools
+from collections import OrderedDict
 from typing import Dict, Optional, Any, Callable, Tuple, Union
 
 from .wfc import Direction2D, Direction3D
-from ..utils import flip_mesh, yaw_rotate_mesh, get_height_array_of_mesh
+from ..utils import flip_mesh, yaw_rotate_mesh, get_height_array_of_mesh, compute_sdf, transform_sdf_array
 
 
 class Tile:
@@ -71,7 +72,7 @@ class ArrayTile(Tile):
     """Class to manage the tiles.
     Args:
         name (str): Name of the tile.
-        array (np.ndarray): Array of the tile.
+        array (np.ndarray): Array of the tile. 2D array for dimension 2, 3D array indexed as [x, y, z] for dimension 3.
         edges (Optional[Dict[str, str]]): Dictionary of the edges of the tile. The keys are the directions and the values are the name of the edge.
     Example:
         tile = ArrayTile(name="tile", array=np.array([[1, 1, 1], [1, 0, 1], [1, 1, 1]]))
@@ -86,7 +87,8 @@ class ArrayTile(Tile):
         weight: float = 1.0,
     ):
         self.array = array
-        self.directions = Direction2D()
+        self.dimension = dimension
+        self.directions = Direction2D() if dimension == 2 else Direction3D()
         if edges is None:
             edges = self.create_edges_from_array(array)
         super().__init__(name, edges, dimension, weight)
@@ -105,8 +107,14 @@ class ArrayTile(Tile):
             array = np.flip(self.array, 1)
         elif direction == "y":
             array = np.flip(self.array, 0)
+        elif direction == "z" and self.dimension == 3:
+            array = np.flip(self.array, 2)
         else:
             raise ValueError(f"Direction {direction} is not defined.")
+        if self.dimension == 3:
+            # Faces of a 3D tile are flipped or rotated as well, so the edges are computed from the new array.
+            name = f"{self.name}_{direction}"
+            return ArrayTile(name=name, array=array, dimension=self.dimension, weight=self.weight)
         tile = super().get_flipped_tile(direction)
         return ArrayTile(name=tile.name, array=array, edges=tile.edges, dimension=self.dimension, weight=tile.weight)
 
@@ -115,11 +123,16 @@ class ArrayTile(Tile):
             raise ValueError(f"Rotation degree {deg} is not defined.")
         a = deg // 90
         array = np.rot90(self.array, a)
+        if self.dimension == 3:
+            name = f"{self.name}_{deg}"
+            return ArrayTile(name=name, array=array, dimension=self.dimension, weight=self.weight)
         tile = super().get_rotated_tile(deg)
         return ArrayTile(name=tile.name, array=array, edges=tile.edges, dimension=self.dimension, weight=tile.weight)
 
     def create_edges_from_array(self, array):
         """Create a hash for each edge of the tile."""
+        if self.dimension == 3:
+            return self._create_faces_from_array(array)
         edges = {}
         for direction in self.directions.base_directions:
             if direction == "up":
@@ -134,10 +147,119 @@ class ArrayTile(Tile):
                 raise ValueError(f"Direction {direction} is not defined.")
         return edges
 
+    def _create_faces_from_array(self, array):
+        """Create a hash for each face of a 3D tile.
+        The face in the positive direction of an axis is flattened and the face in the negative direction is flattened
+        and reversed, so that touching faces match when one edge is the flipped other.
+        """
+        faces = {
+            "front": array[0, :, :],
+            "back": array[-1, :, :],
+            "left": array[:, 0, :],
+            "right": array[:, -1, :],
+            "down": array[:, :, 0],
+            "up": array[:, :, -1],
+        }
+        edges = {}
+        for direction in self.directions.base_directions:
+            edge = tuple(np.round(faces[direction].flatten(), 1))
+            if min(getattr(self.directions, direction)) < 0:
+                edge = edge[::-1]
+            edges[direction] = edge
+        return edges
+
     def __str__(self):
         return super().__str__() + f"\n {self.array}"
 
 
+class MeshCache:
+    """Bounded LRU cache of the vertices and faces of tile meshes.
+    Each mesh is stored once as read-only arrays and handed out as a new Trimesh which shares them, so getting a mesh
+    does not copy it. Operations of trimesh which transform a mesh assign new arrays and do not modify the cache.
+    The cache is bounded by the bytes of the arrays, so that it holds all variants of a pattern regardless of their
+    number. The most recent mesh is always kept.
+    Args:
+        max_bytes (int): Size cap of the arrays in bytes.
+        max_size (int): Optional cap of the number of meshes.
+    """
+
+    def __init__(self, max_bytes: int = 1024**3, max_size: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.max_size = max_size
+        self.nbytes = 0
+        self._meshes = OrderedDict()  # key: cache key, value: (vertices, faces)
+
+    def __len__(self):
+        return len(self._meshes)
+
+    def __contains__(self, key):
+        return key in self._meshes
+
+    def get(self, key, mesh_gen: Callable[[], trimesh.Trimesh]) -> trimesh.Trimesh:
+        """Mesh of the key. mesh_gen is called if it is not cached."""
+        if key in self._meshes:
+            self._meshes.move_to_end(key)
+            vertices, faces = self._meshes[key]
+        else:
+            mesh = mesh_gen()
+            vertices = np.array(mesh.vertices, dtype=np.float64)
+            faces = np.array(mesh.faces, dtype=np.int64)
+            vertices.flags.writeable = False
+            faces.flags.writeable = False
+            self._meshes[key] = (vertices, faces)
+            self.nbytes += vertices.nbytes + faces.nbytes
+            self._evict()
+        return trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+
+    def _evict(self):
+        while len(self._meshes) > 1 and (
+            self.nbytes > self.max_bytes or (self.max_size is not None and len(self._meshes) > self.max_size)
+        ):
+            _, (vertices, faces) = self._meshes.popitem(last=False)
+            self.nbytes -= vertices.nbytes + faces.nbytes
+
+    def clear(self):
+        self._meshes.clear()
+        self.nbytes = 0
+
+
+# Shared by all mesh tiles. Keys are (root token, transforms) of the tiles.
+MESH_CACHE = MeshCache()
+
+
+class SDFCache:
+    """Bounded LRU cache of SDF blocks of tile meshes. The arrays are read-only."""
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self._sdfs = OrderedDict()
+
+    def __len__(self):
+        return len(self._sdfs)
+
+    def __contains__(self, key):
+        return key in self._sdfs
+
+    def get(self, key, sdf_gen: Callable[[], np.ndarray]) -> np.ndarray:
+        """SDF of the key. sdf_gen is called if it is not cached."""
+        if key in self._sdfs:
+            self._sdfs.move_to_end(key)
+        else:
+            sdf = np.asarray(sdf_gen())
+            sdf.flags.writeable = False
+            self._sdfs[key] = sdf
+            while len(self._sdfs) > self.max_size:
+                self._sdfs.popitem(last=False)
+        return self._sdfs[key]
+
+    def clear(self):
+        self._sdfs.clear()
+
+
+# Keys are (root token, transforms, dim, resolution). Variants are derived from the block of the root tile.
+SDF_CACHE = SDFCache()
+
+
 class MeshTile(ArrayTile):
     def __init__(
         self,
@@ -161,21 +283,17 @@ class MeshTile(ArrayTile):
         """
         # self.mesh_gen = mesh_gen
         self.mesh_gen = lambda: mesh() if callable(mesh) else mesh
+        # Transformations from the root tile in the order they are applied. ex. (("flip", "x"), ("rotate", 90))
+        self.transforms = ()
+        self._root_token = object()
+        self._root_mesh_gen = self.mesh_gen
         if array is None:
-            array = get_height_array_of_mesh(self.mesh_gen(), mesh_dim, array_sample_size)
+            array = get_height_array_of_mesh(self.get_shared_mesh(), mesh_dim, array_sample_size)
         super().__init__(name, array, edges, dimension, weight=weight)
 
-    def get_flipped_tile(self, direction):
-        # flip array
-        if direction == "x":
-            mesh_gen = lambda: flip_mesh(self.mesh_gen(), "x")
-        elif direction == "y":
-            mesh_gen = lambda: flip_mesh(self.mesh_gen(), "y")
-        else:
-            raise ValueError(f"Direction {direction} is not defined.")
-        # Apply the transformation to the mesh
-        tile = super().get_flipped_tile(direction)
-        return MeshTile(
+    def _create_variant(self, tile, mesh_gen, transform):
+        """MeshTile of a transformed variant which shares the mesh cache of this tile."""
+        new_tile = MeshTile(
             name=tile.name,
             array=tile.array,
             mesh=mesh_gen,
@@ -183,23 +301,63 @@ class MeshTile(ArrayTile):
             dimension=self.dimension,
             weight=self.weight,
         )
+        new_tile.transforms = self.transforms + (transform,)
+        new_tile._root_token = self._root_token
+        new_tile._root_mesh_gen = self._root_mesh_gen
+        return new_tile
+
+    def get_flipped_tile(self, direction):
+        # flip array
+        if direction not in ["x", "y"]:
+            raise ValueError(f"Direction {direction} is not defined.")
+        # The variant is transformed from the cached mesh of this tile.
+        mesh_gen = lambda: flip_mesh(self.get_shared_mesh(), direction)
+        tile = super().get_flipped_tile(direction)
+        return self._create_variant(tile, mesh_gen, ("flip", direction))
 
     def get_rotated_tile(self, deg):
         if deg not in self.directions.directions:
             raise ValueError(f"Rotation degree {deg} is not defined.")
-        mesh_gen = lambda: yaw_rotate_mesh(self.mesh_gen(), deg)
+        mesh_gen = lambda: yaw_rotate_mesh(self.get_shared_mesh(), deg)
         tile = super().get_rotated_tile(deg)
-        return MeshTile(
-            name=tile.name,
-            array=tile.array,
-            mesh=mesh_gen,
-            edges=tile.edges,
-            dimension=self.dimension,
-            weight=self.weight,
-        )
+        return self._create_variant(tile, mesh_gen, ("rotate", deg))
+
+    @property
+    def cache_key(self):
+        return (self._root_token, self.transforms)
 
     def get_mesh(self):
-        return self.mesh_gen()
+        """Mesh of the tile with its own writeable copy of the vertices and faces."""
+        mesh = self.get_shared_mesh()
+        return trimesh.Trimesh(vertices=np.array(mesh.vertices), faces=np.array(mesh.faces), process=False)
+
+    def get_shared_mesh(self):
+        """Mesh of the tile without a copy. The vertices and faces are shared with MESH_CACHE and are read-only, so
+        the mesh must not be modified in place. Transforms of trimesh assign new arrays and are allowed.
+        """
+        return MESH_CACHE.get(self.cache_key, self.mesh_gen)
+
+    def get_sdf(self, dim: Tuple[float, float, float], resolution: float = 0.1) -> np.ndarray:
+        """SDF of the tile mesh computed by compute_sdf, cached in SDF_CACHE.
+        The SDF is computed once for the root tile, and the flips and rotations of the variants are applied in index
+        space. Variants rotated by 90 or 270 degrees on a non-square grid are computed from their own mesh.
+        Args:
+            dim: Size of the SDF block, centered at the tile.
+            resolution: Size of the cells.
+        Returns:
+            np.ndarray: Read-only SDF indexed by (x, y, z).
+        """
+        dim = tuple(float(d) for d in dim)
+        num_elements = np.ceil(np.array(dim) / resolution).astype(int)
+        rotated = any(t == "rotate" and v % 180 != 0 for t, v in self.transforms)
+        if rotated and num_elements[0] != num_elements[1]:
+            key = (self._root_token, self.transforms, dim, resolution)
+            return SDF_CACHE.get(key, lambda: compute_sdf(self.get_shared_mesh(), dim, resolution))
+        root_mesh_gen = lambda: MESH_CACHE.get((self._root_token, ()), self._root_mesh_gen)
+        sdf = SDF_CACHE.get(
+            (self._root_token, (), dim, resolution), lambda: compute_sdf(root_mesh_gen(), dim, resolution)
+        )
+        return transform_sdf_array(sdf, self.transforms)
 
     def __str__(self):
         return "MeshTile: " + super().__str__()
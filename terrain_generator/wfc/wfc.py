@@ -3,43 +3,298 @@
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
 import os
-import pickle
+import json
+import time
 import random
 import copy
+import heapq
 
 import numpy as np
 
+from collections import deque, Counter
+from contextlib import contextmanager
+
 from dataclasses import dataclass
-from typing import Literal, Tuple, Dict, List
+from typing import Literal, Tuple, Dict, List, Optional, Union
 
 from alive_progress import alive_bar, alive_it
 from ..utils import cfg_to_hash, CACHE_DIR
 
 
+# Number of set bits for every byte value. Used to count the size of packed domains.
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int32)
+
+
+def pack_domains(valid: np.ndarray) -> np.ndarray:
+    """Pack a boolean array along the last axis into a bitset of uint8.
+    Args:
+        valid: (np.ndarray) of shape (..., n_tiles).
+    Returns:
+        (np.ndarray) of shape (..., ceil(n_tiles / 8)). Bit i is set if tile i is valid.
+    """
+    return np.packbits(valid, axis=-1, bitorder="little")
+
+
+def unpack_domains(domains: np.ndarray, n_tiles: int) -> np.ndarray:
+    """Unpack bitset domains into a boolean array of shape (..., n_tiles)."""
+    return np.unpackbits(domains, axis=-1, count=n_tiles, bitorder="little").astype(bool)
+
+
+@dataclass
+class CompiledConnections:
+    """Compiled form of the connections between tiles.
+    compatibility[d, i, j] is True if tile j can be placed next to tile i in directions[d].
+    """
+
+    directions: Tuple[tuple, ...]
+    compatibility: np.ndarray  # (n_directions, n_tiles, n_tiles) bool
+
+    @property
+    def n_tiles(self) -> int:
+        return self.compatibility.shape[1]
+
+    @property
+    def packed(self) -> np.ndarray:
+        """Compatibility rows as packed bitsets of shape (n_directions, n_tiles, n_bytes)."""
+        return pack_domains(self.compatibility)
+
+    @classmethod
+    def from_dict(cls, connections: dict, n_tiles: int) -> "CompiledConnections":
+        """Compile a connection dict. ex. {0: {(-1, 0): (0, 1), ...}, ...}"""
+        directions = tuple(tuple(d) for d in connections[0].keys())
+        compatibility = np.zeros((len(directions), n_tiles, n_tiles), dtype=bool)
+        for tile_id in range(n_tiles):
+            for d, direction in enumerate(directions):
+                possible_tiles = np.array(connections[tile_id][direction], dtype=int).reshape(-1)
+                # Ids which are not registered tiles can never be placed.
+                possible_tiles = possible_tiles[possible_tiles < n_tiles]
+                compatibility[d, tile_id, possible_tiles] = True
+        return cls(directions, compatibility)
+
+    def to_dict(self) -> dict:
+        """Connection dict of sorted tuples. ex. {0: {(-1, 0): (0, 1), ...}, ...}"""
+        connections = {}
+        for tile_id in range(self.n_tiles):
+            connections[tile_id] = {}
+            for d, direction in enumerate(self.directions):
+                connections[tile_id][direction] = tuple(np.flatnonzero(self.compatibility[d, tile_id]).tolist())
+        return connections
+
+    def save(self, filename: str):
+        np.savez_compressed(
+            filename,
+            directions=np.array(self.directions, dtype=int),
+            compatibility=self.packed,
+            n_tiles=self.n_tiles,
+        )
+
+    @classmethod
+    def load(cls, filename: str) -> "CompiledConnections":
+        data = np.load(filename)
+        directions = tuple(tuple(int(x) for x in d) for d in data["directions"])
+        compatibility = unpack_domains(data["compatibility"], int(data["n_tiles"]))
+        return cls(directions, compatibility)
+
+
+def compile_connections(connections: Union[dict, CompiledConnections], n_tiles: int):
+    """Packed compatibility rows of the connections.
+    Args:
+        connections: CompiledConnections or dictionary of connections for each tile.
+        n_tiles: number of tiles
+    Returns:
+        directions: tuple of the directions in the order of the compatibility rows.
+        compatibility: (np.ndarray) of shape (n_directions, n_tiles, n_bytes).
+            compatibility[d, i] is the packed set of tiles which can be placed next to tile i in direction d.
+            A pair of tiles is only compatible if both tiles accept each other, so that the propagation from either
+            cell removes every tile which has no support on the other side.
+    """
+    if not isinstance(connections, CompiledConnections):
+        connections = CompiledConnections.from_dict(connections, n_tiles)
+    elif connections.n_tiles != n_tiles:
+        raise ValueError(f"Connections are compiled for {connections.n_tiles} tiles, got n_tiles={n_tiles}.")
+    directions = connections.directions
+    compatibility = connections.compatibility.copy()
+    for d, direction in enumerate(directions):
+        opposite = tuple(-x for x in direction)
+        if opposite in directions:
+            compatibility[d] &= connections.compatibility[directions.index(opposite)].T
+    return directions, pack_domains(compatibility)
+
+
+def compute_neighbour_table(shape: list, directions: Tuple[tuple, ...]) -> np.ndarray:
+    """Flat index of the neighbour of each cell in each direction. -1 if out of bounds.
+    Returns:
+        (np.ndarray) of shape (n_cells, n_directions).
+    """
+    cells = np.indices(shape).reshape(len(shape), -1).T
+    table = -np.ones((len(cells), len(directions)), dtype=np.int64)
+    for d, direction in enumerate(directions):
+        neighbours = cells + np.array(direction)
+        is_inside = np.all(neighbours >= 0, axis=1) & np.all(neighbours < shape, axis=1)
+        table[is_inside, d] = np.ravel_multi_index(tuple(neighbours[is_inside].T), shape)
+    return table
+
+
 class Wave:
     def __init__(self, n_tiles: int, shape: list, dimensions: int = 2):
         self.n_tiles = n_tiles
         self.shape = shape
         self.dimensions = dimensions
         self.wave = np.zeros(shape, dtype=np.int32)  # first dimension is for the tile, second is for the orientation
-        self.valid = np.ones((self.n_tiles, *shape), dtype=bool)
+        self.n_cells = int(np.prod(shape))
+        # Possible tiles of each cell as a packed bitset. shape: (n_cells, n_bytes)
+        self.domains = pack_domains(np.ones((self.n_cells, n_tiles), dtype=bool))
+        # Number of possible tiles of each cell. Kept in sync with domains.
+        self.entropy = np.full(self.n_cells, n_tiles, dtype=np.int32)
         self.is_collapsed = np.zeros(shape, dtype=bool)
+        self.n_collapsed = 0
         self.wave_order = np.zeros_like(self.wave)
 
+    @property
+    def valid(self) -> np.ndarray:
+        """Boolean array of possible tiles with shape (n_tiles, *shape)."""
+        valid = unpack_domains(self.domains, self.n_tiles).reshape(*self.shape, self.n_tiles)
+        return np.moveaxis(valid, -1, 0)
+
+    def get_entropy(self) -> np.ndarray:
+        """Number of possible tiles of each cell."""
+        return self.entropy.reshape(self.shape).copy()
+
+    def get_valid_tiles(self, idx) -> np.ndarray:
+        """Ids of the possible tiles at the given index."""
+        cell = np.ravel_multi_index(tuple(idx), self.shape)
+        return np.flatnonzero(unpack_domains(self.domains[cell], self.n_tiles))
+
     def substitute(self, obj: "Wave"):
         self.wave = copy.deepcopy(obj.wave)
-        self.valid = copy.deepcopy(obj.valid)
+        self.domains = copy.deepcopy(obj.domains)
+        self.entropy = copy.deepcopy(obj.entropy)
         self.is_collapsed = copy.deepcopy(obj.is_collapsed)
+        self.n_collapsed = obj.n_collapsed
         self.wave_order = copy.deepcopy(obj.wave_order)
 
     def copy(self):
         new_wave = Wave(self.n_tiles, self.shape, self.dimensions)
         new_wave.wave = copy.deepcopy(self.wave)
-        new_wave.valid = copy.deepcopy(self.valid)
+        new_wave.domains = copy.deepcopy(self.domains)
+        new_wave.entropy = copy.deepcopy(self.entropy)
         new_wave.is_collapsed = copy.deepcopy(self.is_collapsed)
+        new_wave.n_collapsed = self.n_collapsed
         new_wave.wave_order = copy.deepcopy(self.wave_order)
         return new_wave
 
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.wave, self.domains, self.entropy, self.is_collapsed, self.wave_order)
+        return sum(a.nbytes for a in arrays)
+
+
+class SolverStats:
+    """Counters and timers of a WFC solve. Pass an instance to WFCCore or WFCSolver to collect them.
+    Args:
+        trace: record every timed section as a Chrome trace event.
+    """
+
+    def __init__(self, trace: bool = False):
+        self.trace = trace
+        self.propagation_steps = 0  # number of cells taken from the propagation worklist
+        self.eliminations = 0  # number of tiles removed from the domains
+        self.observations = 0
+        self.contradictions = 0
+        self.backtracks = 0
+        self.backtrack_depths = Counter()  # key: number of history entries which are rolled back, value: count
+        self.peak_history_bytes = 0
+        self.times = Counter()  # key: section name, value: total seconds
+        self.trace_events = []
+        self._start_time = time.perf_counter()
+
+    @contextmanager
+    def timer(self, name: str):
+        """Add the time spent in the block to times[name]."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.times[name] += end - start
+            if self.trace:
+                self.trace_events.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self._start_time) * 1e6,
+                        "dur": (end - start) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": 0,
+                    }
+                )
+
+    def to_dict(self) -> dict:
+        return {
+            "propagation_steps": self.propagation_steps,
+            "eliminations": self.eliminations,
+            "observations": self.observations,
+            "contradictions": self.contradictions,
+            "backtracks": self.backtracks,
+            "backtrack_depths": {str(k): v for k, v in sorted(self.backtrack_depths.items())},
+            "peak_history_bytes": self.peak_history_bytes,
+            "times": dict(self.times),
+        }
+
+    def save_json(self, filename: str):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def save_chrome_trace(self, filename: str):
+        """Save the trace events in the Chrome trace format. Open with chrome://tracing or Perfetto."""
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": self.trace_events, "displayTimeUnit": "ms"}, f)
+
+
+class Trail:
+    """Undo log of a wave.
+    Stores the previous domain of every cell before it is changed, so that the wave can be rewound to any earlier
+    point without keeping a full copy of the wave.
+    """
+
+    def __init__(self, n_bytes: int, capacity: int = 1024):
+        self.cells = np.zeros(capacity, dtype=np.int64)
+        self.domains = np.zeros((capacity, n_bytes), dtype=np.uint8)
+        self.is_collapse = np.zeros(capacity, dtype=bool)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return self.cells.nbytes + self.domains.nbytes + self.is_collapse.nbytes
+
+    def push(self, cell: int, domain: np.ndarray, is_collapse: bool = False):
+        """Record the domain of a cell before it is changed."""
+        if self.size == len(self.cells):
+            self.cells = np.concatenate([self.cells, np.zeros_like(self.cells)])
+            self.domains = np.concatenate([self.domains, np.zeros_like(self.domains)])
+            self.is_collapse = np.concatenate([self.is_collapse, np.zeros_like(self.is_collapse)])
+        self.cells[self.size] = cell
+        self.domains[self.size] = domain
+        self.is_collapse[self.size] = is_collapse
+        self.size += 1
+
+    def undo(self, wave: Wave, mark: int):
+        """Rewind the wave to the state when the trail had the length of mark."""
+        cells = self.cells[mark : self.size]
+        # The oldest record of each cell holds its domain at the mark.
+        unique_cells, first = np.unique(cells, return_index=True)
+        wave.domains[unique_cells] = self.domains[mark : self.size][first]
+        wave.entropy[unique_cells] = POPCOUNT[wave.domains[unique_cells]].sum(axis=-1)
+        collapsed_cells = cells[self.is_collapse[mark : self.size]]
+        wave.wave.flat[collapsed_cells] = 0
+        wave.wave_order.flat[collapsed_cells] = 0
+        wave.is_collapsed.flat[collapsed_cells] = False
+        wave.n_collapsed -= len(collapsed_cells)
+        self.size = mark
+
 
 class WFCCore:
     """Wave Function Collapse algorithm implementation."""
@@ -47,19 +302,24 @@ class WFCCore:
     def __init__(
         self,
         n_tiles: int,
-        connections: dict,
+        connections: Union[dict, CompiledConnections],
         shape: list,
         tile_weights: list = [],
         dimensions: int = 2,
         observation_mode: str = "random",
         max_backtracking: int = 10000,
+        backtracking: Literal["snapshot", "trail"] = "snapshot",
+        stats: Optional[SolverStats] = None,
     ):
         """Initialize the WFC algorithm.
         Args:
             n_tiles: number of tiles
-            connections: dictionary of connections for each tile
+            connections: CompiledConnections or dictionary of connections for each tile
             shape: shape of the wave
             dimensions: number of dimensions of the wave
+            backtracking: "snapshot" keeps a copy of the wave in the history for every progress step.
+                "trail" only records the changed domains in an undo log and keeps the trail length in the history.
+            stats: SolverStats to collect counters and timers. Nothing is collected if None.
         """
 
         self.n_tiles = n_tiles
@@ -78,6 +338,18 @@ class WFCCore:
         self.total_back_track_cnt = 0
         self.observation_mode = observation_mode
         self.max_backtracking = max_backtracking
+        if backtracking not in ("snapshot", "trail"):
+            raise ValueError(f"Backtracking mode {backtracking} is not defined.")
+        self.backtracking = backtracking
+        self.trail = Trail(self.wave.domains.shape[-1]) if backtracking == "trail" else None
+        self.stats = stats
+
+        # Packed compatibility rows used by the propagation.
+        self.directions, self.compatibility = compile_connections(connections, n_tiles)
+        self.full_support = np.bitwise_or.reduce(self.compatibility, axis=1)
+        self.tile_bits = pack_domains(np.eye(n_tiles, dtype=bool))
+        self.neighbour_table = compute_neighbour_table(shape, self.directions)
+        self._reset_entropy_queue()
 
     def _get_neighbours(self, idx):
         """Get the neighbours of a given tile."""
@@ -89,39 +361,105 @@ class WFCCore:
         directions = neighbours - idx
         return neighbours, directions
 
-    def _get_possible_tiles(self, tile_id, directions):
-        """Get the constraints of a given tile.
-        Based on the tile's connections and the directions of the neighbours."""
-        possible_tiles = []
-        for direction in directions:
-            d = tuple(direction)
-            possible_tiles.append(self.connections[tile_id][d])
-        return possible_tiles
-
-    def _update_wave(self, idx: np.ndarray, tile_id: int):
+    def _reset_entropy_queue(self):
+        """Rebuild the entropy queue from the current wave.
+        The queue is a heap of (entropy, random tie break, cell). Entries are not removed when the entropy of a
+        cell changes, a new entry is pushed instead and the outdated one is skipped when it reaches the top.
+        """
+        cells = np.flatnonzero(~self.wave.is_collapsed.reshape(-1))
+        tie_breaks = np.random.random(len(cells))
+        self.entropy_queue = list(zip(self.wave.entropy[cells].tolist(), tie_breaks.tolist(), cells.tolist()))
+        heapq.heapify(self.entropy_queue)
+
+    def _set_domain(self, cell: int, domain: np.ndarray, is_collapse: bool = False):
+        """Set the domain of a cell and update its entropy."""
+        if self.trail is not None:
+            self.trail.push(cell, self.wave.domains[cell], is_collapse)
+        self.wave.domains[cell] = domain
+        entropy = int(POPCOUNT[domain].sum())
+        if self.stats is not None:
+            self.stats.eliminations += int(self.wave.entropy[cell]) - entropy
+        self.wave.entropy[cell] = entropy
+        if not self.wave.is_collapsed.flat[cell]:
+            heapq.heappush(self.entropy_queue, (entropy, random.random(), cell))
+
+    def _update_wave(self, idx: np.ndarray, tile_id: int) -> bool:
+        """Collapse a cell to a tile and propagate.
+        Returns:
+            False if the tile is not in the domain of the cell or the propagation empties a domain, True otherwise.
+        """
+        cell = np.ravel_multi_index(tuple(idx), self.shape)
+        is_valid = bool(np.any(self.wave.domains[cell] & self.tile_bits[tile_id]))
+        self._set_domain(cell, self.tile_bits[tile_id], is_collapse=True)
         self.wave.wave[tuple(idx)] = tile_id
-        self.wave.wave_order[tuple(idx)] = self.wave.is_collapsed.sum()
+        self.wave.wave_order[tuple(idx)] = self.wave.n_collapsed
         self.wave.is_collapsed[tuple(idx)] = True
-        self.wave.valid[(slice(None),) + tuple(idx)] = False
-        self.wave.valid[(tile_id,) + tuple(idx)] = True
-        self._update_validity(idx, tile_id)
-
-    def _update_validity(self, new_idx: np.ndarray, tile_id: int):
-        neighbours, directions = self._get_neighbours(new_idx)
-        possible_tiles = self._get_possible_tiles(tile_id, directions)
-        non_possible_tiles = [np.setdiff1d(np.arange(self.n_tiles), pt) for pt in possible_tiles]
-        for neighbor, tiles in zip(neighbours, non_possible_tiles):
-            self.wave.valid[(tiles,) + tuple(neighbor)] = False
-
-    def _random_collapse(self, entropy):
-        """Choose the indices of the tiles to be observed."""
-        indices = np.argwhere(entropy == np.min(entropy))
-        return np.array(random.choice(indices))
-
-    def collapse(self, entropy):
-        """Collapse the wave."""
-        # Choose a tile with lowest entropy. If there are multiple, choose randomly.
-        return self._random_collapse(entropy)
+        self.wave.n_collapsed += 1
+        if not is_valid:
+            return False
+        return self._propagate([cell])
+
+    def _propagate(self, cells: List[int]) -> bool:
+        """Propagate the domain reduction of the given cells until a fixpoint is reached.
+        Args:
+            cells: flat indices of the cells whose domain has changed.
+        Returns:
+            False if a domain became empty (contradiction), True otherwise.
+        """
+        if self.stats is None:
+            return self._propagate_domains(cells)[0]
+        with self.stats.timer("propagate"):
+            is_consistent, steps = self._propagate_domains(cells)
+        self.stats.propagation_steps += steps
+        self.stats.contradictions += int(not is_consistent)
+        return is_consistent
+
+    def _propagate_domains(self, cells: List[int]) -> Tuple[bool, int]:
+        """AC-3 style worklist. Every cell whose domain shrinks is queued again to propagate to its own neighbours.
+        Returns:
+            False if a domain became empty, True otherwise, and the number of cells taken from the worklist.
+        """
+        steps = 0
+        domains = self.wave.domains
+        queue = deque(cells)
+        is_queued = np.zeros(len(domains), dtype=bool)
+        is_queued[cells] = True
+        while queue:
+            cell = queue.popleft()
+            is_queued[cell] = False
+            steps += 1
+            tiles = np.flatnonzero(unpack_domains(domains[cell], self.n_tiles))
+            for d, neighbour in enumerate(self.neighbour_table[cell]):
+                if neighbour < 0:
+                    continue
+                if len(tiles) == self.n_tiles:
+                    support = self.full_support[d]
+                else:
+                    support = np.bitwise_or.reduce(self.compatibility[d, tiles], axis=0)
+                domain = domains[neighbour]
+                new_domain = domain & support
+                if np.array_equal(new_domain, domain):
+                    continue
+                self._set_domain(neighbour, new_domain)
+                if not new_domain.any():
+                    return False, steps
+                if not is_queued[neighbour]:
+                    queue.append(neighbour)
+                    is_queued[neighbour] = True
+        return True, steps
+
+    def collapse(self) -> Optional[int]:
+        """Choose the cell to be observed.
+        Returns the flat index of a non-collapsed cell with the lowest entropy. If there are multiple, one of them
+        is chosen randomly. Returns None if all cells are collapsed.
+        """
+        while len(self.entropy_queue) > 0:
+            entropy, _, cell = self.entropy_queue[0]
+            if self.wave.is_collapsed.flat[cell] or self.wave.entropy[cell] != entropy:
+                heapq.heappop(self.entropy_queue)
+                continue
+            return cell
+        return None
 
     def init_randomly(self):
         """Initialize the wave randomly."""
@@ -134,71 +472,99 @@ class WFCCore:
         if idx is None or tile_id is None:
             self.init_randomly()
         else:
-            self._update_wave(idx, tile_id)
+            if not self._update_wave(idx, tile_id):
+                raise ValueError("The initial tiles cannot be connected.", idx, tile_id)
             self.new_idx = idx
             print("Init wave with idx and tile number", self.wave.wave)
 
     def random_observe(self, idx):
         """Observe a random tile."""
-        tile_id = np.random.choice(np.arange(self.n_tiles)[self.wave.valid[(slice(None),) + tuple(idx)]])
+        tile_id = np.random.choice(self.wave.get_valid_tiles(idx))
         return tile_id
 
     def weighted_random_observe(self, idx):
         """Observe a random tile."""
-        valid_tiles = np.arange(self.n_tiles)[self.wave.valid[(slice(None),) + tuple(idx)]].astype(int)
+        valid_tiles = self.wave.get_valid_tiles(idx)
         valid_tile_weights = self.tile_weights[valid_tiles]
         tile_id = np.random.choice(valid_tiles, p=valid_tile_weights / np.sum(valid_tile_weights))
         return tile_id
 
-    def observe(self, idx):
-        """Observe a tile."""
+    def observe(self, idx) -> bool:
+        """Observe a tile.
+        Returns:
+            False if the observation leads to a contradiction, True otherwise.
+        """
+        if self.stats is None:
+            tile_id = self._choose_tile(idx)
+        else:
+            with self.stats.timer("observe"):
+                tile_id = self._choose_tile(idx)
+            self.stats.observations += 1
+        return self._update_wave(idx, tile_id)
+
+    def _choose_tile(self, idx):
         if self.observation_mode == "random":
-            tile_id = self.random_observe(idx)
+            return self.random_observe(idx)
         elif self.observation_mode == "weighted":
-            tile_id = self.weighted_random_observe(idx)
+            return self.weighted_random_observe(idx)
         else:
             raise NotImplementedError
-        self._update_wave(idx, tile_id)
 
     def solve(self):
         """Solve the WFC problem."""
+        if self.stats is None:
+            return self._solve()
+        with self.stats.timer("solve"):
+            return self._solve()
+
+    def _solve(self):
         # self.update_history()
         with alive_bar(manual=True) as bar:
             while True:
                 # Find a tile with lowest entropy
-                entropy = np.sum(self.wave.valid, axis=0)
-                entropy[self.wave.is_collapsed] = self.n_tiles + 1
-                idx = self.collapse(entropy)
-                # print("Entropy:\n", entropy)
-                # print("wave:\n", self.wave.wave)
-                # print("wave_order:\n", self.wave.wave_order)
-                if entropy[tuple(idx)] == self.n_tiles + 1:
+                if self.stats is None:
+                    cell = self.collapse()
+                else:
+                    with self.stats.timer("select"):
+                        cell = self.collapse()
+                if cell is None:
                     break
-                if entropy[tuple(idx)] == 0:
+                if self.wave.entropy[cell] == 0:
                     self._back_track()
                     continue
                 else:
-                    if (
-                        np.sum(self.wave.is_collapsed == False) < self.prev_remaining_grid_num
-                        or np.sum(self.wave.is_collapsed == False) <= 1
-                    ):
-                        # print("prev_remaining_grid_num: ", self.prev_remaining_grid_num)
-                        # self.prev_remaining_grid_num = min(
-                        #     self.prev_remaining_grid_num, np.sum(self.wave.is_collapsed == False)
-                        # )
-                        self.prev_remaining_grid_num = np.sum(self.wave.is_collapsed == False)
+                    remaining_grid_num = self.wave.n_cells - self.wave.n_collapsed
+                    if remaining_grid_num < self.prev_remaining_grid_num or remaining_grid_num <= 1:
+                        self.prev_remaining_grid_num = remaining_grid_num
                         self.back_track_cnt = 0
                         self.update_history()
-                    self.observe(idx)
-                bar(np.sum(self.wave.is_collapsed) / (self.wave.shape[0] * self.wave.shape[1]))
-
-            # print("wave ", self.history[0].is_collapsed)
-            # break
+                    if not self.observe(np.array(np.unravel_index(cell, self.shape))):
+                        self._back_track()
+                bar(self.wave.n_collapsed / self.wave.n_cells)
 
         return self.wave.wave
 
     def update_history(self):
-        self.history.append(self.wave.copy())
+        if self.trail is not None:
+            self.history.append(len(self.trail))
+        else:
+            self.history.append(self.wave.copy())
+        if self.stats is not None:
+            self.stats.peak_history_bytes = max(self.stats.peak_history_bytes, self.history_nbytes)
+
+    @property
+    def history_nbytes(self) -> int:
+        """Memory used by the history."""
+        if self.trail is not None:
+            return self.trail.nbytes
+        return len(self.history) * self.wave.nbytes
+
+    def _restore_history(self, i: int):
+        """Restore the wave to the i-th entry of the history."""
+        if self.trail is not None:
+            self.trail.undo(self.wave, self.history[i])
+        else:
+            self.wave = self.history[i].copy()
 
     def _back_track(self):
         """Backtrack the wave."""
@@ -213,21 +579,216 @@ class WFCCore:
         #     raise ValueError("Too many backtracks.", self.back_track_cnt, len(self.history))
         if self.total_back_track_cnt > self.max_backtracking:
             raise ValueError("Too many total backtracks.", self.total_back_track_cnt)
-        if ((look_back + 1) > len(self.history)) or (len(self.history) <= 1):
-            self.wave = self.history[0].copy()
+        if len(self.history) == 0:
+            raise ValueError("The initial tiles cannot be connected.")
+        is_reset = ((look_back + 1) > len(self.history)) or (len(self.history) <= 1)
+        if self.stats is not None:
+            self.stats.backtracks += 1
+            self.stats.backtrack_depths[len(self.history) - 1 if is_reset else look_back] += 1
+        if is_reset:
+            self._restore_history(0)
             self.history = [self.history[0]]
-            self.prev_remaining_grid_num = np.sum(self.wave.is_collapsed == False)
+            self.prev_remaining_grid_num = self.wave.n_cells - self.wave.n_collapsed
             # print(
             # f"reset back tracking. look_back: {look_back}, back_track: {self.back_track_cnt}, history: {len(self.history)}"
             # )
             self.back_track_cnt = 0
         else:
-            self.wave = self.history[-1 - look_back].copy()
+            self._restore_history(-1 - look_back)
             self.history = self.history[: -1 - look_back]
-        if look_back == len(self.history) - 1:
-            # print("wave ", self.wave.is_collapsed)
-            entropy = np.sum(self.wave.valid, axis=0)
-            # print("Entropy:\n", entropy)
+        self._reset_entropy_queue()
+
+
+class BatchedWFCCore:
+    """Wave Function Collapse solver for a batch of independent waves.
+    All waves are solved at the same time with a leading batch dimension on the domains, so that the per step
+    overhead is shared by the whole batch. One cell is observed in every unfinished wave per step and the
+    propagation is done for the whole batch at once.
+    Every wave has its own random generator, so a wave gives the same result for its seed in any batch.
+    There is no decision history. A wave which reaches a contradiction is restarted from the state after the initial
+    tiles, and max_backtracking limits the number of restarts of a wave. Use WFCCore for tile sets which need many
+    local backtracks.
+    """
+
+    def __init__(
+        self,
+        n_tiles: int,
+        connections: Union[dict, CompiledConnections],
+        shape: list,
+        batch_size: int,
+        tile_weights: list = [],
+        dimensions: int = 2,
+        observation_mode: str = "random",
+        max_backtracking: int = 10000,
+        seeds: Optional[List[int]] = None,
+        use_torch: bool = False,
+    ):
+        """Initialize the batched WFC algorithm.
+        Args:
+            n_tiles: number of tiles
+            connections: CompiledConnections or dictionary of connections for each tile
+            shape: shape of each wave
+            batch_size: number of waves to solve
+            dimensions: number of dimensions of the wave
+            max_backtracking: maximum number of restarts of a single wave
+            seeds: one seed per wave. A wave is reproducible from its own seed. Random if None.
+            use_torch: use torch (cpu) for the matrix products of the propagation.
+        """
+        self.n_tiles = n_tiles
+        self.shape = shape
+        self.dimensions = dimensions
+        self.batch_size = batch_size
+        self.n_cells = int(np.prod(shape))
+        if len(tile_weights) > 0:
+            self.tile_weights = np.array(tile_weights, dtype=np.float64)
+        else:
+            self.tile_weights = np.ones(n_tiles)
+        if observation_mode not in ("random", "weighted"):
+            raise NotImplementedError
+        self.observation_mode = observation_mode
+        self.max_backtracking = max_backtracking
+        if seeds is None:
+            seeds = np.random.SeedSequence().spawn(batch_size)
+        elif len(seeds) != batch_size:
+            raise ValueError(f"Got {len(seeds)} seeds for a batch of {batch_size} waves.")
+        self.rngs = [np.random.default_rng(seed) for seed in seeds]
+        self.use_torch = use_torch
+
+        self.directions, compatibility = compile_connections(connections, n_tiles)
+        self.compatibility = unpack_domains(compatibility, n_tiles).astype(np.float32)
+        if use_torch:
+            import torch
+
+            self.compatibility = torch.from_numpy(self.compatibility)
+        self.neighbour_table = compute_neighbour_table(shape, self.directions)
+
+        self.valid = np.ones((batch_size, self.n_cells, n_tiles), dtype=bool)
+        self.entropy = np.full((batch_size, self.n_cells), n_tiles, dtype=np.int32)
+        self.wave = np.zeros((batch_size, self.n_cells), dtype=np.int32)
+        self.wave_order = np.zeros((batch_size, self.n_cells), dtype=np.int32)
+        self.is_collapsed = np.zeros((batch_size, self.n_cells), dtype=bool)
+        self.n_collapsed = np.zeros(batch_size, dtype=np.int32)
+        self.is_failed = np.zeros(batch_size, dtype=bool)
+        self.back_track_cnt = np.zeros(batch_size, dtype=int)
+        self.initial_state = None
+
+    @property
+    def total_back_track_cnt(self):
+        return int(self.back_track_cnt.sum())
+
+    def _support(self, valid: np.ndarray, d: int) -> np.ndarray:
+        """Tiles which are allowed in direction d of cells with the given valid tiles. (K, n_tiles) -> (K, n_tiles)"""
+        if self.use_torch:
+            import torch
+
+            return (torch.from_numpy(valid.astype(np.float32)) @ self.compatibility[d]).numpy() > 0
+        return valid.astype(np.float32) @ self.compatibility[d] > 0
+
+    def _propagate(self, is_dirty: np.ndarray):
+        """Propagate the domain reduction of the dirty cells of all waves until a fixpoint is reached.
+        Args:
+            is_dirty: (batch_size, n_cells) cells whose domain has changed.
+        """
+        while is_dirty.any():
+            b, cells = np.nonzero(is_dirty)
+            valid = self.valid[b, cells]
+            is_dirty = np.zeros_like(is_dirty)
+            for d in range(len(self.directions)):
+                neighbours = self.neighbour_table[cells, d]
+                is_inside = neighbours >= 0
+                if not is_inside.any():
+                    continue
+                nb, neighbours = b[is_inside], neighbours[is_inside]
+                domain = self.valid[nb, neighbours]
+                new_domain = domain & self._support(valid[is_inside], d)
+                is_changed = np.any(new_domain != domain, axis=1)
+                nb, neighbours, new_domain = nb[is_changed], neighbours[is_changed], new_domain[is_changed]
+                self.valid[nb, neighbours] = new_domain
+                self.entropy[nb, neighbours] = new_domain.sum(axis=1)
+                self.is_failed[nb[~new_domain.any(axis=1)]] = True
+                is_dirty[nb, neighbours] = True
+            # Failed waves are restarted, no need to propagate further.
+            is_dirty[self.is_failed] = False
+
+    def _update_wave(self, b: np.ndarray, cells: np.ndarray, tile_ids: np.ndarray):
+        self.wave[b, cells] = tile_ids
+        self.wave_order[b, cells] = self.n_collapsed[b]
+        self.is_collapsed[b, cells] = True
+        self.n_collapsed[b] += 1
+        self.valid[b, cells] = False
+        self.valid[b, cells, tile_ids] = True
+        self.entropy[b, cells] = 1
+        is_dirty = np.zeros((self.batch_size, self.n_cells), dtype=bool)
+        is_dirty[b, cells] = True
+        self._propagate(is_dirty)
+
+    def init_randomly(self):
+        """Initialize every wave with a random tile at a random position."""
+        b = np.arange(self.batch_size)
+        cells = np.array([rng.integers(0, self.n_cells) for rng in self.rngs])
+        tile_ids = np.array([rng.integers(0, self.n_tiles) for rng in self.rngs])
+        self._update_wave(b, cells, tile_ids)
+
+    def init(self, idx, tile_id):
+        """Place the same tile at the same position of every wave."""
+        b = np.arange(self.batch_size)
+        cells = np.full(self.batch_size, np.ravel_multi_index(tuple(idx), self.shape))
+        self._update_wave(b, cells, np.full(self.batch_size, tile_id))
+
+    def collapse(self, b: np.ndarray) -> np.ndarray:
+        """Choose a non-collapsed cell with the lowest entropy for each given wave. Ties are broken randomly."""
+        entropy = self.entropy[b].astype(np.float64)
+        entropy[self.is_collapsed[b]] = np.inf
+        entropy += np.stack([self.rngs[i].random(self.n_cells) for i in b]) * 0.5
+        return np.argmin(entropy, axis=1)
+
+    def observe(self, b: np.ndarray, cells: np.ndarray):
+        """Observe a random valid tile in the given cells."""
+        weights = self.valid[b, cells].astype(np.float64)
+        if self.observation_mode == "weighted":
+            weights *= self.tile_weights
+        cumulative = np.cumsum(weights, axis=1)
+        u = np.array([self.rngs[i].random() for i in b]) * cumulative[:, -1]
+        tile_ids = np.minimum(np.sum(cumulative <= u[:, None], axis=1), self.n_tiles - 1)
+        self._update_wave(b, cells, tile_ids)
+
+    def _back_track(self, b: np.ndarray):
+        """Restart the given waves from the initial state."""
+        self.back_track_cnt[b] += 1
+        if np.any(self.back_track_cnt > self.max_backtracking):
+            raise ValueError("Too many total backtracks.", self.total_back_track_cnt)
+        valid, entropy, wave, wave_order, is_collapsed = self.initial_state
+        self.valid[b] = valid[b]
+        self.entropy[b] = entropy[b]
+        self.wave[b] = wave[b]
+        self.wave_order[b] = wave_order[b]
+        self.is_collapsed[b] = is_collapsed[b]
+        self.n_collapsed[b] = is_collapsed[b].sum(axis=1)
+        self.is_failed[b] = False
+
+    def solve(self) -> np.ndarray:
+        """Solve all waves.
+        Returns:
+            (np.ndarray) of shape (batch_size, *shape) with the tile ids.
+        """
+        self.initial_state = (
+            self.valid.copy(),
+            self.entropy.copy(),
+            self.wave.copy(),
+            self.wave_order.copy(),
+            self.is_collapsed.copy(),
+        )
+        with alive_bar(manual=True) as bar:
+            while True:
+                if self.is_failed.any():
+                    self._back_track(np.flatnonzero(self.is_failed))
+                b = np.flatnonzero(self.n_collapsed < self.n_cells)
+                if len(b) == 0:
+                    break
+                cells = self.collapse(b)
+                self.observe(b, cells)
+                bar(self.n_collapsed.sum() / (self.batch_size * self.n_cells))
+        return self.wave.reshape(self.batch_size, *self.shape)
 
 
 @dataclass
@@ -353,7 +914,7 @@ class ConnectionManager:
         self.names = []
 
         # self.directions = Direction2D() if dimension == 2 else Direction3D()
-        self.edge_def = Edge()
+        self.edge_def = Edge(dimension=dimension)
         # self.n_directions = 4 if dimension == 2 else 6
 
         self.edges = {}
@@ -398,84 +959,51 @@ class ConnectionManager:
             self.all_tiles_of_edge_type[edge].append((direction, tile_id))
 
     def get_connection_dict(self):
-        connections = self._load_from_cache()
-        # print(connections)
-        return connections
-
-    def _compute_connection_dict(self):
-        print("Computing connections...")
-        connections = {}
-        readable_connections = {}
-
-        for edge_type, edges in self.edges.items():
-            self.edges[edge_type] = np.array(edges)
-        for edge_type, edges in self.flipped_edges.items():
-            self.flipped_edges[edge_type] = np.array(edges)
-
-        # print("new edges ", self.edges)
+        """Connections as a dict of sorted tuples. ex. {0: {(-1, 0): (0, 1), ...}, ...}"""
+        return self.get_compiled_connections().to_dict()
 
-        connectivities = {}
+    def get_compiled_connections(self) -> CompiledConnections:
+        """Connections as one compatibility matrix per direction."""
+        return self._load_from_cache()
 
-        for edge_dir, edges in self.edges.items():
-            # print("edge_dir ", edge_dir)
-            opposite_edge_dir = tuple(-np.array(edge_dir))
-            opposite = np.array(self.flipped_edges[opposite_edge_dir])
-            connectivity = np.array(np.all((edges[:, None, :] == opposite[None, :, :]), axis=-1))
-            # print("connected ", connectivity)
-            indices = np.array(connectivity.nonzero()).T
-            # print("indices ", indices)
-            connectivities[edge_dir] = connectivity
+    def _compute_connection_dict(self):
+        return self._compile_connections().to_dict()
 
-        connections = {}
+    def _compile_connections(self) -> CompiledConnections:
+        """Compute the connections from an index of the tiles of each edge type.
+        A tile connects to another tile in a direction if its edge matches the flipped edge of the other tile in the
+        opposite direction, so only the tiles sharing an edge type are compared.
+        """
+        print("Computing connections...")
+        directions = tuple(self.edges.keys())
+        direction_ids = {direction: d for d, direction in enumerate(directions)}
         n_tiles = len(self.names)
-        for i in range(n_tiles):
-            connections[i] = {}
-            for edge_dir, connectivity in connectivities.items():
-                # print("edge_dir ", edge_dir)
-                # print("connectivity ", connectivity)
-                indices = connectivity[i].nonzero()[0].tolist()
-                # print("indices ", indices)
-                connections[i][edge_dir] = tuple(sorted(indices))
-        # print(connections)
-
-        # for tile_id in alive_it(range(len(self.names))):
-        #     # name = self.names.index(str_name)
-        #     print("name ", tile_id)
-        #     edge_types = self.edge_types_of_tiles[tile_id]
-        #     print("edge types ", edge_types)
-        #     local_connections = {}
-        #     local_readable_connections = {}
-        #     for direction_1, edge_type in edge_types.items():
-        #         local_connections[direction_1] = set()
-        #         local_readable_connections[self.edge_def.to_str(direction_1)] = set()
-        #         another_edge_type = edge_type[::-1]
-        #         print("another_edge_type ", another_edge_type)
-        #         if another_edge_type in self.all_tiles_of_edge_type:
-        #             for direction_2, name_2 in self.all_tiles_of_edge_type[another_edge_type]:
-        #                 if (np.array(direction_1) + np.array(direction_2) == 0).all():
-        #                     local_connections[direction_1].add(name_2)
-        #                     local_readable_connections[self.edge_def.to_str(direction_1)].add(name_2)
-        #     connections[tile_id] = local_connections
-        #     readable_connections[self.names[tile_id]] = local_readable_connections
-        # self.readable_connections = readable_connections
-        # print("connections : ", connections)
-        # print("Replace names with number...")
-        return connections
-        # return self._replace_name_with_number(connections)
 
-    def _load_from_cache(self):
+        # key: (direction, edge_type), value: tile ids with the edge type in the direction
+        tiles_of_edge = {}
+        for edge_type, tiles in self.all_tiles_of_edge_type.items():
+            for direction, tile_id in tiles:
+                tiles_of_edge.setdefault((direction, edge_type), []).append(tile_id)
+
+        compatibility = np.zeros((len(directions), n_tiles, n_tiles), dtype=bool)
+        for (direction, edge_type), tiles in tiles_of_edge.items():
+            opposite_direction = tuple(-x for x in direction)
+            matches = tiles_of_edge.get((opposite_direction, edge_type[::-1]))
+            if matches is not None:
+                compatibility[direction_ids[direction]][np.ix_(tiles, matches)] = True
+        return CompiledConnections(directions, compatibility)
+
+    def _load_from_cache(self) -> CompiledConnections:
         d = self.edge_types_of_tiles
         code = cfg_to_hash(d)
         os.makedirs(self.cache_dir, exist_ok=True)
-        filename = os.path.join(self.cache_dir, code + ".pkl")
+        filename = os.path.join(self.cache_dir, code + ".npz")
         if os.path.exists(filename) and self.load_from_cache:
-            with open(filename, "rb") as handle:
-                connections = pickle.load(handle)
+            connections = CompiledConnections.load(filename)
         else:
-            connections = self._compute_connection_dict()
+            connections = self._compile_connections()
             print(f"Saving cache as {filename} ...")
-            with open(filename, "wb") as handle:
-                pickle.dump(connections, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            connections.save(filename)
         return connections
 
     def _replace_name_with_number(self, d: dict):
@@ -510,7 +1038,15 @@ class ConnectionManager:
 class WFCSolver(object):
     """Class to solve the WFC problem."""
 
-    def __init__(self, shape, dimensions, seed=None, observation_mode="weighted"):
+    def __init__(
+        self,
+        shape,
+        dimensions,
+        seed=None,
+        observation_mode="weighted",
+        backtracking="snapshot",
+        stats: Optional[SolverStats] = None,
+    ):
         if seed is not None:
             np.random.seed(seed)
             random.seed(seed)
@@ -518,6 +1054,8 @@ class WFCSolver(object):
         self.shape = shape
         self.dimensions = dimensions
         self.observation_mode = observation_mode
+        self.backtracking = backtracking
+        self.stats = stats
         self.tile_weights = {}
 
     def register_tile(self, name, edge_types, weight=1):
@@ -530,7 +1068,7 @@ class WFCSolver(object):
             init_tiles: List of tuples. Each tuple contains the name of the tile and the position index of the tile.
         """
         print("Get connection definition.")
-        connections = self.cm.get_connection_dict()
+        connections = self.cm.get_compiled_connections()
         tile_weights = [self.tile_weights[name] for name in self.cm.names]
         self.wfc = WFCCore(
             len(self.cm.names),
@@ -540,6 +1078,8 @@ class WFCSolver(object):
             dimensions=self.dimensions,
             observation_mode=self.observation_mode,
             max_backtracking=max_steps,
+            backtracking=self.backtracking,
+            stats=self.stats,
         )
         print("Start solving...")
         if len(init_tiles) > 0:
@@ -554,9 +1094,360 @@ class WFCSolver(object):
         print("Finished solving.")
         return wave
 
+    def run_batch(
+        self,
+        seeds: List[int],
+        init_tiles: List[Tuple[str, Tuple[int, ...]]] = [],
+        max_steps=1000,
+        use_torch: bool = False,
+    ):
+        """Solve one wave per seed in a single vectorized pass.
+        Args:
+            seeds: List of seeds. One wave is solved for each seed.
+            init_tiles: List of tuples. Each tuple contains the name of the tile and the position index of the tile.
+                The same initial tiles are used for every wave.
+            max_steps: Maximum number of restarts of a single wave.
+            use_torch: Use torch (cpu) for the propagation.
+        Returns:
+            (np.ndarray) of shape (len(seeds), *shape) with the tile ids.
+        """
+        print("Get connection definition.")
+        connections = self.cm.get_compiled_connections()
+        tile_weights = [self.tile_weights[name] for name in self.cm.names]
+        self.batched_wfc = BatchedWFCCore(
+            len(self.cm.names),
+            connections,
+            self.shape,
+            len(seeds),
+            tile_weights=tile_weights,
+            dimensions=self.dimensions,
+            observation_mode=self.observation_mode,
+            max_backtracking=max_steps,
+            seeds=seeds,
+            use_torch=use_torch,
+        )
+        print("Start solving...")
+        if len(init_tiles) > 0:
+            for (name, index) in init_tiles:
+                self.batched_wfc.init(index, self.cm.names.index(name))
+        else:
+            self.batched_wfc.init_randomly()
+        waves = self.batched_wfc.solve()
+        print("Finished solving.")
+        return waves
+
+    def run_parallel(self, region_shape, n_workers=None, seed=0, max_steps=1000):
+        """Solve the wave by splitting it into regions which are solved in worker processes.
+        Args:
+            region_shape: shape of a region. The regions are solved with ChunkedWFCSolver.generate_parallel.
+            n_workers: number of worker processes. Defaults to the number of cpus.
+            seed: seed of the regions.
+            max_steps: Maximum number of backtracking steps of a region.
+        Returns:
+            (np.ndarray) of tile ids with self.shape.
+        """
+        solver = ChunkedWFCSolver(
+            region_shape,
+            self.dimensions,
+            seed=seed,
+            observation_mode=self.observation_mode,
+            backtracking=self.backtracking,
+        )
+        solver.cm = self.cm
+        solver.tile_weights = self.tile_weights
+        return solver.generate_parallel([0] * self.dimensions, self.shape, n_workers=n_workers, max_steps=max_steps)
+
     @property
     def names(self):
         return self.cm.names
 
     def get_history(self):
+        """History of the solver. List of waves, or trail lengths if backtracking is "trail"."""
         return self.wfc.history
+
+
+def solve_region(
+    connections: CompiledConnections,
+    shape: list,
+    fixed_tiles: List[Tuple[Tuple[int, ...], int]],
+    seeds: List[int],
+    tile_weights: list = [],
+    dimensions: int = 2,
+    observation_mode: str = "weighted",
+    backtracking: str = "trail",
+    max_backtracking: int = 1000,
+) -> np.ndarray:
+    """Solve a region with some of its tiles fixed. Defined at module level so that it can run in a worker process.
+    Args:
+        connections: compiled connections of the tiles.
+        shape: shape of the region.
+        fixed_tiles: list of tuples of (index, tile id) which are fixed before solving.
+        seeds: seeds which are tried in order until the region is solved.
+    Returns:
+        (np.ndarray) of tile ids with the given shape.
+    """
+    for seed in seeds:
+        np.random.seed(seed)
+        random.seed(seed)
+        wfc = WFCCore(
+            connections.n_tiles,
+            connections,
+            shape,
+            tile_weights=tile_weights,
+            dimensions=dimensions,
+            observation_mode=observation_mode,
+            max_backtracking=max_backtracking,
+            backtracking=backtracking,
+        )
+        for idx, tile_id in fixed_tiles:
+            if not wfc._update_wave(np.array(idx), tile_id):
+                raise ValueError("The fixed tiles cannot be connected.")
+        if len(fixed_tiles) == 0:
+            wfc.init_randomly()
+        try:
+            return wfc.solve()
+        except ValueError:
+            continue
+    raise ValueError(f"Failed to solve the region with {len(seeds)} seeds.")
+
+
+class ChunkedWFCSolver(WFCSolver):
+    """Solve an unbounded world chunk by chunk.
+    The world is split into chunks of chunk_shape which are generated lazily when they are requested. Each chunk is
+    solved with a halo of one cell around it. The halo cells which belong to already generated chunks are fixed to
+    their tiles, so that the new chunk connects to its neighbours. Only one chunk is solved at a time.
+    A chunk depends on the neighbours which exist when it is generated. Generating the chunks in the same order with
+    the same seed gives the same world.
+    """
+
+    def __init__(
+        self,
+        chunk_shape,
+        dimensions,
+        seed=0,
+        observation_mode="weighted",
+        backtracking="trail",
+        max_retries=5,
+    ):
+        """Initialize the chunked solver.
+        Args:
+            chunk_shape: shape of a chunk in cells.
+            dimensions: number of dimensions of the world.
+            seed: seed of the world. The seed of each chunk is derived from it and the chunk index.
+            max_retries: number of times a chunk is solved again with another seed when it fails.
+        """
+        super().__init__(chunk_shape, dimensions, observation_mode=observation_mode, backtracking=backtracking)
+        self.seed = seed
+        self.max_retries = max_retries
+        self.chunks = {}  # key: chunk index, value: (np.ndarray) of tile ids with chunk_shape
+        self._connections = None
+
+    def _get_connections(self):
+        if self._connections is None or self._connections.n_tiles != len(self.cm.names):
+            self._connections = self.cm.get_compiled_connections()
+        return self._connections
+
+    def _chunk_seed(self, chunk_idx, attempt=0):
+        """Seed of a chunk. Chunk indices can be negative, so they are mapped to non negative integers first."""
+        entropy = [self.seed] + [2 * i if i >= 0 else -2 * i - 1 for i in chunk_idx] + [attempt]
+        return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+    def _get_fixed_tiles(self, start, shape):
+        """Tiles of the halo cells of a box which belong to generated chunks.
+        Only the halo cells facing the box are used. The other halo cells (corners) do not touch the box.
+        Args:
+            start: index of the first cell of the box in world coordinates.
+            shape: shape of the box in cells.
+        Returns:
+            List of tuples of (index in the box with halo, tile id).
+        """
+        chunk_shape = np.array(self.shape)
+        origin = np.array(start) - 1
+        halo_shape = tuple(np.array(shape) + 2)
+        fixed_tiles = []
+        for idx in np.ndindex(halo_shape):
+            if sum(i == 0 or i == s - 1 for i, s in zip(idx, halo_shape)) != 1:
+                continue
+            world_idx = origin + idx
+            neighbour_idx = tuple((world_idx // chunk_shape).tolist())
+            if neighbour_idx in self.chunks:
+                local_idx = tuple(world_idx - np.array(neighbour_idx) * chunk_shape)
+                fixed_tiles.append((idx, self.chunks[neighbour_idx][local_idx]))
+        return fixed_tiles
+
+    def _get_region_args(self, start, shape, seeds, max_steps=1000):
+        """Arguments of solve_region for a box and its halo."""
+        return dict(
+            connections=self._get_connections(),
+            shape=[s + 2 for s in shape],
+            fixed_tiles=self._get_fixed_tiles(start, shape),
+            seeds=seeds,
+            tile_weights=[self.tile_weights[name] for name in self.cm.names],
+            dimensions=self.dimensions,
+            observation_mode=self.observation_mode,
+            backtracking=self.backtracking,
+            max_backtracking=max_steps,
+        )
+
+    def _get_chunk_args(self, chunk_idx, seed=None, max_steps=1000):
+        """Arguments of solve_region for a chunk and its halo."""
+        if seed is None:
+            seeds = [self._chunk_seed(chunk_idx, attempt) for attempt in range(self.max_retries + 1)]
+        else:
+            seeds = [(seed + attempt) % 2**32 for attempt in range(self.max_retries + 1)]
+        chunk_shape = np.array(self.shape)
+        return self._get_region_args(np.array(chunk_idx) * chunk_shape, chunk_shape, seeds, max_steps)
+
+    def _crop_halo(self, wave):
+        return wave[tuple(slice(1, -1) for _ in self.shape)].copy()
+
+    def _solve_chunk(self, chunk_idx, seed=None, max_steps=1000):
+        """Solve a chunk with the tiles of its generated neighbours as constraints."""
+        try:
+            wave = solve_region(**self._get_chunk_args(chunk_idx, seed, max_steps))
+        except ValueError as e:
+            raise ValueError(f"Failed to solve chunk {chunk_idx}.") from e
+        return self._crop_halo(wave)
+
+    def _repair_chunk(self, chunk_idx, max_steps=1000):
+        """Solve a chunk which cannot connect to its neighbours.
+        The chunk is solved together with a margin around it which grows until it is solved. The margin overwrites
+        the cells of the generated neighbours, which stay connected to the rest of the world through the halo.
+        """
+        chunk_shape = np.array(self.shape)
+        margin = 1
+        while True:
+            start = np.array(chunk_idx) * chunk_shape - margin
+            shape = chunk_shape + 2 * margin
+            seeds = [
+                self._chunk_seed(chunk_idx, margin * (self.max_retries + 1) + attempt)
+                for attempt in range(self.max_retries + 1)
+            ]
+            try:
+                wave = solve_region(**self._get_region_args(start, shape, seeds, max_steps))
+                break
+            except ValueError as e:
+                if margin >= chunk_shape.max():
+                    raise ValueError(f"Failed to solve chunk {chunk_idx}.") from e
+                margin *= 2
+        self.chunks[chunk_idx] = np.zeros(self.shape, dtype=np.int32)
+        self._set_region(start, self._crop_halo(wave))
+
+    def _set_region(self, start, region):
+        """Write a region into the generated chunks which it overlaps."""
+        chunk_shape = np.array(self.shape)
+        end = np.array(start) + np.array(region.shape)
+        first_chunk = np.array(start) // chunk_shape
+        last_chunk = (end - 1) // chunk_shape
+        for offset in np.ndindex(tuple(last_chunk - first_chunk + 1)):
+            chunk_idx = tuple((first_chunk + offset).tolist())
+            if chunk_idx not in self.chunks:
+                continue
+            chunk_start = np.array(chunk_idx) * chunk_shape
+            lo = np.maximum(start, chunk_start)
+            hi = np.minimum(end, chunk_start + chunk_shape)
+            self.chunks[chunk_idx][tuple(slice(l, h) for l, h in zip(lo - chunk_start, hi - chunk_start))] = region[
+                tuple(slice(l, h) for l, h in zip(lo - start, hi - start))
+            ]
+
+    def get_chunk(self, chunk_idx, max_steps=1000):
+        """Tile ids of a chunk. The chunk is generated if it does not exist yet."""
+        chunk_idx = tuple(int(i) for i in chunk_idx)
+        if chunk_idx not in self.chunks:
+            self.chunks[chunk_idx] = self._solve_chunk(chunk_idx, max_steps=max_steps)
+        return self.chunks[chunk_idx]
+
+    def regenerate_chunk(self, chunk_idx, seed=None, max_steps=1000):
+        """Solve a chunk again while keeping its neighbours fixed.
+        The chunk is not changed if it cannot be solved.
+        Args:
+            chunk_idx: index of the chunk.
+            seed: seed of the new chunk. If None, the next seed of the chunk is used.
+        """
+        chunk_idx = tuple(int(i) for i in chunk_idx)
+        if seed is None:
+            seed = self._chunk_seed(chunk_idx, self.max_retries + 1)
+        # The halo only covers the neighbours, so the chunk is kept until the new one is solved.
+        self.chunks[chunk_idx] = self._solve_chunk(chunk_idx, seed=seed, max_steps=max_steps)
+        return self.chunks[chunk_idx]
+
+    def get_region(self, start, shape, max_steps=1000):
+        """Tile ids of a region of the world. Missing chunks are generated.
+        Args:
+            start: index of the first cell of the region in world coordinates.
+            shape: shape of the region in cells.
+        Returns:
+            (np.ndarray) of tile ids with the given shape.
+        """
+        start = np.array(start)
+        end = start + np.array(shape)
+        chunk_shape = np.array(self.shape)
+        first_chunk = start // chunk_shape
+        last_chunk = (end - 1) // chunk_shape
+        region = np.zeros(shape, dtype=np.int32)
+        for offset in np.ndindex(tuple(last_chunk - first_chunk + 1)):
+            chunk_idx = first_chunk + offset
+            chunk = self.get_chunk(chunk_idx, max_steps=max_steps)
+            chunk_start = chunk_idx * chunk_shape
+            lo = np.maximum(start, chunk_start)
+            hi = np.minimum(end, chunk_start + chunk_shape)
+            region[tuple(slice(l, h) for l, h in zip(lo - start, hi - start))] = chunk[
+                tuple(slice(l, h) for l, h in zip(lo - chunk_start, hi - chunk_start))
+            ]
+        return region
+
+    def generate_parallel(self, start, shape, n_workers=None, max_steps=1000):
+        """Generate the missing chunks of a region in worker processes and return the region.
+        The chunks are generated in two phases of a checkerboard pattern. The chunks of the same color do not share
+        a face, so they are solved independently in parallel. The first color only depends on chunks which already
+        exist and the second color is solved with the chunks of the first color around it as constraints.
+        The chunks which fail are solved again in this process with a margin into their neighbours.
+        Args:
+            start: index of the first cell of the region in world coordinates.
+            shape: shape of the region in cells.
+            n_workers: number of worker processes. Defaults to the number of cpus. Solved in this process if 1.
+        Returns:
+            (np.ndarray) of tile ids with the given shape.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        chunk_shape = np.array(self.shape)
+        first_chunk = np.array(start) // chunk_shape
+        last_chunk = (np.array(start) + np.array(shape) - 1) // chunk_shape
+        missing = []
+        for offset in np.ndindex(tuple(last_chunk - first_chunk + 1)):
+            chunk_idx = tuple((first_chunk + offset).tolist())
+            if chunk_idx not in self.chunks:
+                missing.append(chunk_idx)
+
+        if n_workers == 1:
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(n_workers)
+        failed = []
+        try:
+            for color in range(2):
+                chunk_ids = [chunk_idx for chunk_idx in missing if sum(chunk_idx) % 2 == color]
+                if executor is None:
+                    for chunk_idx in chunk_ids:
+                        try:
+                            self.chunks[chunk_idx] = self._solve_chunk(chunk_idx, max_steps=max_steps)
+                        except ValueError:
+                            failed.append(chunk_idx)
+                    continue
+                futures = {
+                    chunk_idx: executor.submit(solve_region, **self._get_chunk_args(chunk_idx, max_steps=max_steps))
+                    for chunk_idx in chunk_ids
+                }
+                for chunk_idx, future in futures.items():
+                    try:
+                        self.chunks[chunk_idx] = self._crop_halo(future.result())
+                    except ValueError:
+                        failed.append(chunk_idx)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        # Chunks of the second color can be over constrained by their neighbours.
+        for chunk_idx in failed:
+            self._repair_chunk(chunk_idx, max_steps=max_steps)
+        return self.get_region(start, shape, max_steps=max_steps)